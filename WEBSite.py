@@ -5,12 +5,23 @@ from datetime import datetime, timedelta
 import math
 import asyncio
 import os
+import threading
+import atexit
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
+import hashlib
+from typing import Dict
 from dotenv import load_dotenv
-from database import db as async_db
+from database import db as async_db, SERIES_METRICS
 from tgbot import BusinessBot # Импортируем бота
+from webhook_queue import WebhookQueue
+from ai import llm_gateway, conversation_memory
+from message_classifier import message_classifier
+import data_extractor
+from llm_cache import llm_cache
+from conversation_manager import conv_manager
+from benchmark_engine import benchmark_engine
 from env_utils import is_production # Импортируем утилиту окружения
 load_dotenv()
 
@@ -42,18 +53,45 @@ print(f"Static folder exists: {os.path.exists('static')}")
 if os.path.exists('templates'):
     print(f"Files in templates: {os.listdir('templates')}")
 
-# Инициализируем новую БД (async) один раз при старте процесса
+# Долгоживущий event loop в отдельном потоке: потоки Flask отправляют в него корутины
+# и ждут только свой результат, поэтому запросы выполняются параллельно
 _event_loop = asyncio.new_event_loop()
-asyncio.set_event_loop(_event_loop)
+_loop_thread = threading.Thread(target=_event_loop.run_forever, name='asyncio-loop', daemon=True)
+_loop_thread.start()
+
+# Сколько поток Flask ждёт результат корутины
+LOOP_CALL_TIMEOUT = float(os.getenv('LOOP_CALL_TIMEOUT', '30'))
+
+def run_on_loop(coro, timeout: float = None):
+    """Выполнить корутину на общем event loop и дождаться результата из текущего потока."""
+    future = asyncio.run_coroutine_threadsafe(coro, _event_loop)
+    try:
+        return future.result(timeout)
+    except Exception:
+        future.cancel()
+        raise
+
+def _supersede_llm_turn(user_key: str, update_json: Dict):
+    """Новое текстовое сообщение пользователя отменяет LLM-запросы, ждущие ответа на предыдущее"""
+    if user_key.startswith('user:') and 'message' in update_json:
+        llm_gateway.cancel_user(user_key.split(':', 1)[1])
+
+# Очередь входящих обновлений: /webhook отвечает сразу, обработка идёт воркерами на общем loop
+webhook_queue = WebhookQueue(bot_instance.process_update, on_superseded=_supersede_llm_turn) if bot_instance else None
+
+# Инициализируем новую БД (async) один раз при старте процесса
 try:
-    _event_loop.run_until_complete(async_db.init_db())
+    run_on_loop(async_db.init_db())
     print("Database initialized successfully")
+    # Бенчмарки из собственных данных считаются в фоне, до первого запроса пользователя
+    _event_loop.call_soon_threadsafe(benchmark_engine.ensure_fresh)
     
     # Инициализируем бота для работы через вебхуки
     if bot_instance:
         print("🤖 Инициализация бота...")
-        _event_loop.run_until_complete(bot_instance.app.initialize())
-        _event_loop.run_until_complete(bot_instance.app.start())
+        run_on_loop(bot_instance.app.initialize())
+        run_on_loop(bot_instance.app.start())
+        run_on_loop(webhook_queue.start())
         print("✅ Бот инициализирован")
 
         # Установка вебхука в продакшене
@@ -62,7 +100,7 @@ try:
             if domain:
                 webhook_url = f"https://{domain}/webhook"
                 print(f"🔗 Настройка вебхука на: {webhook_url}")
-                _event_loop.run_until_complete(bot_instance.set_webhook(webhook_url))
+                run_on_loop(bot_instance.set_webhook(webhook_url))
             else:
                 print("⚠️ RAILWAY_PUBLIC_DOMAIN не найден, вебхук не установлен")
 
@@ -70,69 +108,24 @@ except Exception as e:
     print(f"Warning: Database or Bot initialization failed: {e}")
     print(f"Traceback: {traceback.format_exc()}")
 
+def _flush_message_log_on_exit():
+    """При остановке процесса дописываем буфер журнала сообщений"""
+    try:
+        run_on_loop(async_db.flush_message_log(), LOOP_CALL_TIMEOUT)
+    except Exception as e:
+        print(f"Warning: message log flush failed: {e}")
+
+atexit.register(_flush_message_log_on_exit)
+
 def await_db(coro):
     """Выполнить async-вызов к БД в синхронном Flask обработчике."""
     try:
-        return _event_loop.run_until_complete(coro)
+        return run_on_loop(coro, LOOP_CALL_TIMEOUT)
     except Exception as e:
         print(f"Database error: {e}")
         return None
 
 # Подготовка данных для 22+ метрик на основе снимков новой БД
-def prepare_multi_metric_data(snapshots):
-    def get_sort_key(s):
-        """Получаем ключ для сортировки с учетом времени"""
-        dt = s.get('created_at')
-        if dt:
-            try:
-                from datetime import datetime
-                if isinstance(dt, str):
-                    # Парсим строку в datetime для правильной сортировки
-                    if 'T' in dt:
-                        return datetime.fromisoformat(dt.replace('Z', '+00:00'))
-                    elif ':' in dt:
-                        return datetime.strptime(dt, '%Y-%m-%d %H:%M:%S')
-                    else:
-                        return datetime.strptime(dt, '%Y-%m-%d')
-                return dt
-            except Exception:
-                return datetime.min
-        pd = s.get('period_date')
-        if pd:
-            try:
-                return datetime.strptime(str(pd), '%Y-%m-%d')
-            except:
-                return datetime.min
-        return datetime.min
-    
-    # Отсортируем по дате и времени по возрастанию
-    snapshots_sorted = sorted(snapshots, key=get_sort_key)
-    
-    def fmt_dt(s):
-        dt = s.get('created_at')
-        if dt:
-            try:
-                from datetime import datetime
-                if isinstance(dt, str):
-                    # Оставим как есть, если уже содержит время
-                    return dt if (':' in dt) else dt + ' 00:00'
-                # datetime -> строка с временем
-                return dt.strftime('%Y-%m-%d %H:%M')
-            except Exception:
-                return str(dt)
-        pd = s.get('period_date')
-        return pd if isinstance(pd, str) else str(pd)
-    dates = [fmt_dt(s) for s in snapshots_sorted]
-    metric_keys = [
-        'revenue', 'expenses', 'profit', 'clients', 'average_check', 'investments', 'marketing_costs', 'employees',
-        'profit_margin', 'break_even_clients', 'safety_margin', 'roi', 'profitability_index',
-        'ltv', 'cac', 'ltv_cac_ratio', 'customer_profit_margin', 'sgr', 'revenue_growth_rate',
-        'asset_turnover', 'roe', 'months_to_bankruptcy',
-        'financial_health_score', 'growth_health_score', 'efficiency_health_score', 'overall_health_score'
-    ]
-    series = {k: [float(s.get(k) or 0) for s in snapshots_sorted] for k in metric_keys}
-    return {'dates': dates, 'series': series}
-
 def get_data_summary(chart_data):
     """Получение сводки по данным"""
     if not chart_data or not chart_data['revenue']:
@@ -175,16 +168,48 @@ def index():
 @app.route('/webhook', methods=['POST'])
 def telegram_webhook():
     if bot_instance and is_production():
-        # Запускаем обработку обновления в асинхронном цикле
+        # Кладём обновление в очередь и сразу отвечаем Telegram; обработка идёт в фоне
         try:
-            # _event_loop определен на строке 37
-            _event_loop.run_until_complete(bot_instance.process_update(request.get_json()))
-            return jsonify({'status': 'ok'})
+            status = run_on_loop(webhook_queue.submit(request.get_json()), LOOP_CALL_TIMEOUT)
+            if status == WebhookQueue.REJECTED:
+                # Очередь переполнена: Telegram доставит обновление повторно
+                return jsonify({'status': 'busy'}), 503, {'Retry-After': '5'}
+            return jsonify({'status': status})
         except Exception as e:
             app.logger.error(f"Error processing webhook: {e}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
     return jsonify({'status': 'ignored'}), 200
 
+# Метрики очереди вебхуков (глубина, ретраи, время ожидания)
+@app.route('/api/webhook-stats')
+def get_webhook_stats():
+    if not webhook_queue:
+        return jsonify({'success': False, 'error': 'Бот не инициализирован'}), 404
+    return jsonify({'success': True, 'stats': webhook_queue.get_stats()})
+
+# Метрики LLM: шлюз (таймауты, отмены) и локальные быстрые пути (доля решений без LLM)
+@app.route('/api/llm-stats')
+def get_llm_stats():
+    return jsonify({
+        'success': True,
+        'gateway': llm_gateway.get_stats(),
+        'classifier': message_classifier.get_stats(),
+        'extractor': data_extractor.get_stats(),
+        'cache': llm_cache.get_stats(),
+        'history': conversation_memory.get_stats(),
+        'sessions': conv_manager.get_stats(),
+    })
+
+@app.route('/api/db-stats')
+def get_db_stats():
+    return jsonify({
+        'success': True,
+        'cache': async_db.get_cache_stats() if hasattr(async_db, 'get_cache_stats') else {'enabled': False},
+        'message_log': async_db.get_message_log_stats(),
+        'recent_messages': async_db.get_recent_messages_stats(),
+        'benchmarks': benchmark_engine.get_stats(),
+    })
+
 # Страница дашборда
 @app.route('/dashboard')
 def dashboard():
@@ -212,14 +237,76 @@ def get_businesses(user_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Сколько последних снимков отдают графики (окно ряда)
+SERIES_DEFAULT_LIMIT = 120
+SERIES_MAX_LIMIT = 180
+
+def _series_etag(business_id: int, version: Dict, metrics, limit: int) -> str:
+    """
+    ETag колоночного ряда: версия истории и набор метрик. since в него не входит — если
+    версия не изменилась с прошлого ответа, клиенту нечего догружать при любом курсоре.
+    """
+    key = (f"{business_id}:{version['last_snapshot_id']}:{version['points']}:{version['rewritten_at']}:"
+           f"{','.join(metrics or [])}:{limit}")
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _parse_series_metrics(metrics_arg):
+    """Метрики из ?metrics=: проверяются до запроса к БД (await_db проглатывает исключения)"""
+    if not metrics_arg:
+        return None
+    metrics = [m for m in metrics_arg.split(',') if m]
+    unknown = [m for m in metrics if m not in SERIES_METRICS]
+    if unknown:
+        raise ValueError(f"Неизвестные метрики: {', '.join(unknown)}")
+    return metrics or None
+
+def _db_unavailable():
+    return jsonify({'success': False, 'error': 'База данных недоступна'}), 503
+
+def _latest_point(data: Dict) -> Dict:
+    """Последние значения рядов (карточки метрик)"""
+    return {metric: values[-1] for metric, values in data['series'].items() if values}
+
+# Колоночные ряды для графиков: ?metrics=revenue,profit&since=<cursor>&limit=N, с ETag/304
+@app.route('/api/business-series/<int:business_id>')
+def get_business_series(business_id):
+    try:
+        try:
+            metrics = _parse_series_metrics(request.args.get('metrics'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        since = request.args.get('since', type=int)
+        limit = min(request.args.get('limit', SERIES_DEFAULT_LIMIT, type=int), SERIES_MAX_LIMIT)
+
+        version = await_db(async_db.get_business_series_version(business_id))
+        if version is None:
+            return _db_unavailable()
+        etag = _series_etag(business_id, version, metrics, limit)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            # Снимки переписаны (backfill) после прошлого ответа — догрузка по курсору их не вернет
+            if since is not None and request.args.get('rewritten', type=float) != version['rewritten_at']:
+                since = None
+            data = await_db(async_db.get_business_series(business_id, metrics, since=since, limit=limit))
+            if data is None:
+                return _db_unavailable()
+            response = jsonify({'success': True, 'data': data, 'latest': _latest_point(data),
+                                'incremental': since is not None, 'rewritten_at': version['rewritten_at']})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # Новый API: история снимков по бизнесу (включая все метрики)
 @app.route('/api/business-history/<int:business_id>')
 def get_business_history(business_id):
     try:
-        snapshots = await_db(async_db.get_business_history(business_id, limit=120))
-        data = prepare_multi_metric_data(snapshots)
-        latest = snapshots[-1] if snapshots else None
-        return jsonify({'success': True, 'data': data, 'latest': latest})
+        data = await_db(async_db.get_business_series(business_id, limit=SERIES_DEFAULT_LIMIT))
+        if data is None:
+            return _db_unavailable()
+        return jsonify({'success': True, 'data': data, 'latest': _latest_point(data)})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -227,8 +314,9 @@ def get_business_history(business_id):
 @app.route('/api/fullscreen-chart/<int:business_id>')
 def get_fullscreen_chart(business_id):
     try:
-        snapshots = await_db(async_db.get_business_history(business_id, limit=180))
-        data = prepare_multi_metric_data(snapshots)
+        data = await_db(async_db.get_business_series(business_id, limit=SERIES_MAX_LIMIT))
+        if data is None:
+            return _db_unavailable()
         return jsonify({'success': True, 'data': data})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -237,11 +325,13 @@ def get_fullscreen_chart(business_id):
 @app.route('/api/business-kpi/<int:business_id>')
 def get_business_kpi(business_id):
     try:
-        snapshots = await_db(async_db.get_business_history(business_id, limit=2))
-        if not snapshots:
+        # Последний и предыдущий снимок — одна строка сводки business_rollups
+        latest = await_db(async_db.get_business_rollup(business_id))
+        if not latest:
             return jsonify({'success': False, 'error': 'Нет данных'}), 404
-        latest = snapshots[0]
-        previous = snapshots[1] if len(snapshots) > 1 else None
+        previous = {
+            column: latest.get(f'prev_{column}') for column in ('revenue', 'expenses', 'profit', 'clients')
+        } if latest.get('prev_snapshot_id') is not None else None
         def calc_change(curr, prev):
             prev = float(prev or 0)
             curr = float(curr or 0)
@@ -271,7 +361,7 @@ def get_user_ai_analysis(user_id):
                 'error': 'Данные не найдены. Выберите профиль с данными.'
             })
         business_id = businesses[0]['business_id']
-        snapshots = await_db(async_db.get_business_history(business_id, limit=12))
+        snapshots = await_db(async_db.get_business_history(business_id, limit=12, columns='analysis'))
         if not snapshots:
             return jsonify({'success': False, 'error': 'Нет данных'}), 404
         latest = snapshots[0]
@@ -292,7 +382,7 @@ def get_user_ai_analysis(user_id):
 @app.route('/api/business-ai-analysis/<int:business_id>')
 def get_business_ai_analysis(business_id):
     try:
-        snapshots = await_db(async_db.get_business_history(business_id, limit=12))
+        snapshots = await_db(async_db.get_business_history(business_id, limit=12, columns='analysis'))
         
         if not snapshots:
             return jsonify({'success': False, 'error': 'Нет данных для аналитики'}), 404
@@ -368,7 +458,7 @@ def get_advice():
 @app.route('/api/business-advice/<int:business_id>')
 def get_business_advice(business_id):
     try:
-        snapshots = await_db(async_db.get_business_history(business_id, limit=1))
+        snapshots = await_db(async_db.get_business_history(business_id, limit=1, columns='advice'))
         if not snapshots:
             return jsonify({'success': True, 'advice': []})
         latest = snapshots[0]
@@ -475,4 +565,4 @@ if __name__ == '__main__':
     import os
     port = int(os.environ.get('PORT', 8080))
     print(f"Flask running on port {port}")
-    app.run(debug=True, host='0.0.0.0', port=port)
+    app.run(debug=True, host='0.0.0.0', port=port, threaded=True)
@@ -1,9 +1,19 @@
 import g4f
 import re
+import os
+import time
 import logging
 import asyncio
-from typing import Dict, List, Tuple
+import contextvars
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List, Set, Tuple
 from database import db
+from message_classifier import message_classifier, LABEL_SOURCE_LOCAL, LABEL_SOURCE_LLM, LABEL_SOURCE_FALLBACK
+import data_extractor
+from llm_cache import llm_cache
+from history_store import ConversationHistoryStore
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,10 +21,267 @@ logger = logging.getLogger(__name__)
 
 g4f.debug.logging = False
 
-# Глобальная память (теперь дублируется в базе данных)
-conversation_memory = {}
+# История диалогов для LLM: ограниченная по памяти, вытесненные пользователи подгружаются из БД
+conversation_memory = ConversationHistoryStore()
 SIMPLE_MODEL = g4f.models.gpt_4
 
+# Все вызовы g4f синхронные: LLMGateway выполняет их в собственном пуле потоков
+# (не в default executor-е loop-а), ограничивает параллельность семафором,
+# обрывает ожидание по таймауту своего типа промпта и отменяет устаревшие запросы,
+# когда пользователь уже прислал новое сообщение
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# Таймауты по типу промпта, секунды (переопределяются LLM_TIMEOUT_<ТИП>)
+LLM_TIMEOUTS = {
+    'classification': 20.0,
+    'extraction': 45.0,
+    'missing_data': 45.0,
+    'question': 90.0,
+    'chat': 90.0,
+    'analysis': 120.0,
+}
+
+# Ответы на эти промпты нужны только для текущей реплики пользователя — их можно отменять.
+# Извлечение данных и анализ бизнеса доводим до конца, чтобы не потерять собранные данные.
+CANCELLABLE_PROMPT_TYPES = {'classification', 'question', 'chat'}
+
+class LLMTimeoutError(Exception):
+    """Провайдер не ответил за отведённое типу промпта время"""
+
+class LLMCancelledError(Exception):
+    """Запрос отменён: пользователь прислал новое сообщение"""
+
+# Текущая реплика пользователя (user_id, поколение) в контексте обработчика
+_current_turn: contextvars.ContextVar = contextvars.ContextVar('llm_turn', default=None)
+
+def _provider_create(model, messages: List[Dict]) -> str:
+    """Синхронный вызов провайдера (выполняется только в потоке LLMGateway.executor)"""
+    return g4f.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        stream=False
+    )
+
+def _provider_stream(model, messages: List[Dict]) -> Iterator[str]:
+    """Синхронный потоковый вызов провайдера (итерируется только в потоке LLMGateway.executor)"""
+    return g4f.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        stream=True
+    )
+
+class LLMGateway:
+    """Единая неблокирующая точка вызова LLM"""
+
+    def __init__(self, max_concurrency: int = None, timeouts: Dict[str, float] = None):
+        self.max_concurrency = max_concurrency or LLM_MAX_CONCURRENCY
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="llm")
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.timeouts = dict(timeouts or {
+            prompt_type: float(os.getenv(f"LLM_TIMEOUT_{prompt_type.upper()}", str(default)))
+            for prompt_type, default in LLM_TIMEOUTS.items()
+        })
+
+        # user_id -> номер последней реплики; запросы старых реплик считаются устаревшими.
+        # Номера берутся из общего счётчика и не повторяются, поэтому запись удаляется, когда
+        # у пользователя не остаётся начатых реплик: отсутствующий номер (0) не совпадёт ни с одной
+        self._generations: Dict[str, int] = {}
+        self._turn_numbers = itertools.count(1)
+        # user_id -> число начатых и не завершённых реплик
+        self._active_turns: Dict[str, int] = {}
+        # user_id -> выполняющиеся отменяемые запросы
+        self._inflight: Dict[str, Set[asyncio.Task]] = {}
+        self._superseded: Set[asyncio.Task] = set()
+
+        self.stats = {
+            'calls': 0,
+            'completed': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'errors': 0,
+            'latency_ms_total': 0.0,
+            'streams': 0,
+            'first_chunk_ms_total': 0.0,
+        }
+
+    def begin_turn(self, user_id: str) -> contextvars.Token:
+        """
+        Новая реплика пользователя: отменяет его незавершённые отменяемые запросы
+        и привязывает последующие вызовы в этом контексте к новой реплике.
+        """
+        self._active_turns[user_id] = self._active_turns.get(user_id, 0) + 1
+        self.cancel_user(user_id)
+        return _current_turn.set((user_id, self._generations[user_id]))
+
+    def end_turn(self, token: contextvars.Token):
+        user_id, _ = _current_turn.get()
+        _current_turn.reset(token)
+        active = self._active_turns.pop(user_id, 1) - 1
+        if active:
+            self._active_turns[user_id] = active
+        else:
+            self._generations.pop(user_id, None)
+
+    def cancel_user(self, user_id: str) -> int:
+        """Отменить отменяемые запросы пользователя. Возвращает число прерванных вызовов."""
+        if user_id in self._active_turns:
+            self._generations[user_id] = next(self._turn_numbers)
+        else:
+            # Начатых реплик нет — помечать устаревшими нечего, запись не нужна
+            self._generations.pop(user_id, None)
+        calls = self._inflight.pop(user_id, set())
+        for call in calls:
+            if not call.done():
+                self._superseded.add(call)
+                call.cancel()
+        return len(calls)
+
+    def _is_stale(self, turn) -> bool:
+        user_id, generation = turn
+        return self._generations.get(user_id, 0) != generation
+
+    async def complete(self, messages: List[Dict], prompt_type: str = 'chat', model=SIMPLE_MODEL) -> str:
+        """Вызов LLM; ответы детерминированных типов промптов берутся из кэша"""
+        if not llm_cache.is_cacheable(prompt_type):
+            return await self._call_provider(messages, prompt_type, model)
+
+        key = llm_cache.make_key(prompt_type, model, messages)
+        cached = await llm_cache.get(key, prompt_type)
+        if cached is not None:
+            return cached
+        response = await self._call_provider(messages, prompt_type, model)
+        await llm_cache.set(key, prompt_type, response)
+        return response
+
+    async def _call_provider(self, messages: List[Dict], prompt_type: str, model) -> str:
+        """Вызов провайдера с таймаутом типа промпта; для отменяемых типов — с привязкой к реплике пользователя"""
+        timeout = self.timeouts.get(prompt_type, LLM_TIMEOUTS['chat'])
+        turn = _current_turn.get() if prompt_type in CANCELLABLE_PROMPT_TYPES else None
+        self.stats['calls'] += 1
+
+        async with self.semaphore:
+            if turn is not None and self._is_stale(turn):
+                self.stats['cancelled'] += 1
+                raise LLMCancelledError(f"{prompt_type}: пользователь {turn[0]} прислал новое сообщение")
+
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            response = await self._await_tracked(
+                loop.run_in_executor(self.executor, _provider_create, model, messages),
+                turn, prompt_type, timeout
+            )
+            self.stats['completed'] += 1
+            self.stats['latency_ms_total'] += (time.monotonic() - started) * 1000
+            return response
+
+    async def stream(self, messages: List[Dict], prompt_type: str = 'chat', model=SIMPLE_MODEL) -> AsyncIterator[str]:
+        """
+        Потоковый вызов LLM: фрагменты ответа отдаются по мере генерации.
+        Таймаут типа промпта ограничивает всю генерацию, отмена — как у complete.
+        """
+        timeout = self.timeouts.get(prompt_type, LLM_TIMEOUTS['chat'])
+        turn = _current_turn.get() if prompt_type in CANCELLABLE_PROMPT_TYPES else None
+        self.stats['calls'] += 1
+
+        async with self.semaphore:
+            if turn is not None and self._is_stale(turn):
+                self.stats['cancelled'] += 1
+                raise LLMCancelledError(f"{prompt_type}: пользователь {turn[0]} прислал новое сообщение")
+
+            loop = asyncio.get_running_loop()
+            chunks: asyncio.Queue = asyncio.Queue()
+            stop = threading.Event()
+
+            def produce():
+                # Поток провайдера: читает синхронный генератор g4f и передаёт фрагменты в loop
+                try:
+                    for chunk in _provider_stream(model, messages):
+                        if stop.is_set():
+                            break
+                        if chunk:
+                            loop.call_soon_threadsafe(chunks.put_nowait, ('chunk', str(chunk)))
+                    loop.call_soon_threadsafe(chunks.put_nowait, ('done', None))
+                except Exception as e:
+                    loop.call_soon_threadsafe(chunks.put_nowait, ('error', e))
+
+            started = time.monotonic()
+            deadline = started + timeout
+            first_chunk = True
+            self.executor.submit(produce)
+            try:
+                while True:
+                    kind, payload = await self._await_tracked(
+                        chunks.get(), turn, prompt_type, max(deadline - time.monotonic(), 0.0)
+                    )
+                    if kind == 'done':
+                        break
+                    if kind == 'error':
+                        self.stats['errors'] += 1
+                        raise payload
+                    if first_chunk:
+                        first_chunk = False
+                        self.stats['streams'] += 1
+                        self.stats['first_chunk_ms_total'] += (time.monotonic() - started) * 1000
+                    yield payload
+            finally:
+                # Потребитель ушёл или генерация оборвалась — поток провайдера прекратит чтение
+                stop.set()
+
+            self.stats['completed'] += 1
+            self.stats['latency_ms_total'] += (time.monotonic() - started) * 1000
+
+    async def _await_tracked(self, awaitable, turn, prompt_type: str, timeout: float):
+        """
+        Ожидание с таймаутом; для отменяемых типов ожидание регистрируется за репликой
+        пользователя, и cancel_user прерывает его с LLMCancelledError.
+        """
+        call = asyncio.ensure_future(asyncio.wait_for(awaitable, timeout))
+        if turn is not None:
+            self._inflight.setdefault(turn[0], set()).add(call)
+
+        try:
+            return await call
+        except asyncio.CancelledError:
+            if call not in self._superseded:
+                raise
+            self.stats['cancelled'] += 1
+            raise LLMCancelledError(f"{prompt_type}: пользователь {turn[0]} прислал новое сообщение")
+        except asyncio.TimeoutError:
+            # Поток провайдера доработает сам, но слот семафора освобождаем сразу
+            self.stats['timeouts'] += 1
+            raise LLMTimeoutError(f"{prompt_type}: нет ответа LLM за {self.timeouts.get(prompt_type, 0):.0f} с")
+        except (LLMCancelledError, LLMTimeoutError):
+            raise
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        finally:
+            self._superseded.discard(call)
+            if turn is not None:
+                user_calls = self._inflight.get(turn[0])
+                if user_calls is not None:
+                    user_calls.discard(call)
+                    if not user_calls:
+                        self._inflight.pop(turn[0], None)
+
+    def get_stats(self) -> Dict:
+        """Метрики шлюза для мониторинга"""
+        completed = self.stats['completed']
+        return {
+            'max_concurrency': self.max_concurrency,
+            'calls': self.stats['calls'],
+            'completed': completed,
+            'timeouts': self.stats['timeouts'],
+            'cancelled': self.stats['cancelled'],
+            'errors': self.stats['errors'],
+            'inflight_users': len(self._inflight),
+            'avg_latency_ms': round(self.stats['latency_ms_total'] / completed, 1) if completed else 0,
+            'streams': self.stats['streams'],
+            'avg_first_chunk_ms': round(self.stats['first_chunk_ms_total'] / self.stats['streams'], 1) if self.stats['streams'] else 0,
+        }
+
+llm_gateway = LLMGateway()
+
 # Умный промпт для классификации сообщений
 MESSAGE_CLASSIFIER_PROMPT = """Ты - классификатор сообщений. Определи тип и верни ТОЛЬКО ОДНО СЛОВО: BUSINESS_DATA или BUSINESS_QUESTION или GENERAL_CHAT.
 
@@ -74,107 +341,100 @@ BUSINESS_DATA_EXTRACTION_PROMPT = """Ты - инструмент для извл
 НИКАКИХ ДРУГИХ ТЕКСТОВ КРОМЕ JSON!"""
 
 # Промпт для определения недостающих данных
-MISSING_DATA_ANALYSIS_PROMPT = """Ты - бизнес-аналитик, который помогает собрать данные для полного анализа бизнеса.
-Твоя задача - определить, каких данных не хватает, и задать 1-2 ЧЕТКИХ, КОНКРЕТНЫХ вопроса, чтобы получить недостающую информацию.
-Каждый вопрос должен быть С НОВОЙ СТРОКИ.
+# Порядок, в котором планировщик запрашивает недостающие данные:
+# сначала название, затем требуемые для минимального анализа поля, затем дополнительные.
+# average_check и profit не спрашиваем — они вычисляются из revenue/clients и revenue/expenses.
+MISSING_DATA_PRIORITY = [
+    'business_name', 'revenue', 'expenses', 'clients',
+    'investments', 'marketing_costs', 'employees', 'monthly_costs',
+    'new_clients_per_month', 'customer_retention_rate',
+]
+
+# Вопрос по каждому полю (monthly_costs и expenses — разные поля: постоянные и общие расходы)
+MISSING_DATA_QUESTIONS = {
+    'business_name': "Как называется ваш бизнес?",
+    'revenue': "Какая у вас выручка в месяц?",
+    'expenses': "Какие у вас общие расходы в месяц (аренда, зарплаты, материалы, маркетинг)?",
+    'clients': "Сколько клиентов в среднем у вас бывает в месяц?",
+    'investments': "Сколько денег вы вложили в бизнес (инвестиции)?",
+    'marketing_costs': "Сколько в месяц уходит на маркетинг и рекламу?",
+    'employees': "Сколько у вас сотрудников?",
+    'monthly_costs': "Какие у вас постоянные ежемесячные расходы (только аренда и зарплаты)?",
+    'new_clients_per_month': "Сколько новых клиентов приходит к вам в месяц?",
+    'customer_retention_rate': "Какой процент клиентов возвращается к вам повторно?",
+}
 
-ВНИМАТЕЛЬНО ИЗУЧИ УЖЕ СОБРАННЫЕ ДАННЫЕ.
-НЕ ЗАДАВАЙ ВОПРОСЫ О ДАННЫХ, КОТОРЫЕ УЖЕ ПРИСУТСТВУЮТ!
+# Необязательная переформулировка вопроса планировщика через LLM (LLM_REPHRASE_MISSING_QUESTIONS=1)
+LLM_REPHRASE_MISSING_QUESTIONS = os.getenv("LLM_REPHRASE_MISSING_QUESTIONS", "0").lower() in ("1", "true", "yes")
 
-Если все необходимы данные собраны (как "ТРЕБУЕМЫЕ ДАННЫЕ", так и "ДОПОЛНИТЕЛЬНЫЕ ДАННЫЕ"), то верни ТОЛЬКО ОДНО СЛОВО: ENOUGH_DATA.
-Не используй форматирование жирным или курсивом, только обычный текст и вопросы.
+MISSING_DATA_REPHRASE_PROMPT = """Ты - бизнес-аналитик, который помогает собрать данные для анализа бизнеса.
+Перефразируй вопрос к предпринимателю коротко и дружелюбно, учитывая уже собранные данные.
+Не меняй смысл вопроса и не добавляй других вопросов. Не используй форматирование жирным или курсивом.
+Верни ТОЛЬКО текст вопроса.
 
 УЖЕ СОБРАННЫЕ ДАННЫЕ:
 {collected_data}
 
-СПИСОК ВСЕХ ВОЗМОЖНЫХ ДАННЫХ ДЛЯ АНАЛИЗА:
-- business_name (название бизнеса)
-- revenue (выручка)
-- expenses (расходы)
-- clients (количество клиентов)
-- investments (инвестиции)
-- marketing_costs (затраты на маркетинг)
-- employees (количество сотрудников)
-- monthly_costs (ежемесячные постоянные расходы)
-- new_clients_per_month (новых клиентов в месяц)
-- customer_retention_rate (коэффициент удержания клиентов в процентах)
-
-ТРЕБУЕМЫЕ ДАННЫЕ (критически важны для минимального анализа):
-- business_name (название бизнеса) - ПРИОРИТЕТ #1
-- revenue
-- expenses
-- clients
-
-ДОПОЛНИТЕЛЬНЫЕ ДАННЫЕ (для расширенного анализа, спрашивай о них, только если основные уже есть):
-- investments
-- marketing_costs
-- employees
-- monthly_costs
-- new_clients_per_month
-- customer_retention_rate
-
-ВАЖНО: НЕ СПРАШИВАЙ О ДАННЫХ, КОТОРЫЕ МОЖНО ВЫЧИСЛИТЬ:
-- Если есть revenue и clients, НЕ спрашивай о average_check (он вычисляется автоматически)
-- Если есть revenue и expenses, НЕ спрашивай о profit (он вычисляется автоматически)
-
-ПОМНИ: monthly_costs и expenses - РАЗНЫЕ поля:
-- expenses = общие расходы (аренда + зарплаты + материалы + маркетинг)
-- monthly_costs = только постоянные расходы (аренда + зарплаты)
-
-ЗАДАЧА:
-1. СНАЧАЛА проверь business_name - если его нет, спроси ОБЯЗАТЕЛЬНО: "Как называется ваш бизнес?"
-2. Затем проверь остальные ТРЕБУЕМЫЕ ДАННЫЕ (revenue, expenses, clients)
-3. Только потом спрашивай о ДОПОЛНИТЕЛЬНЫХ ДАННЫХ
-4. Сформулируй 1-2 максимально конкретных и коротких вопроса по ОДНОЙ, НАИБОЛЕЕ ВАЖНОЙ ОТСУТСТВУЮЩЕЙ метрике
-5. Если ВСЕ данные из обоих списков собраны, верни ТОЛЬКО ОДНО СЛОВО: ENOUGH_DATA
-
-Пример вопросов (только если данных нет!):
-Как называется ваш бизнес?
-Какая у вас выручка в месяц?
-Сколько клиентов в среднем у вас бывает?
-"""
+ВОПРОС:
+{question}"""
+
 QUESTION_ANSWER_PROMPT = """Ты - опытный бизнес-консультант с 10-летним опытом. Отвечай на вопросы развернуто, профессионально, но понятным языком. Используй практические кейсы и конкретные примеры. Будь полезным и поддерживающим."""
 
 GENERAL_CHAT_PROMPT = """Ты - дружелюбный помощник для предпринимателей. Поддержи беседу, будь позитивным и полезным. Мягко направляй разговор в сторону бизнес-анализа, если это уместно."""
 
 async def classify_message_type(text: str) -> str:
-    """Умное определение типа сообщения с помощью AI"""
+    """Умное определение типа сообщения: очевидные случаи — локально, неоднозначные — через AI"""
+    label, _ = await classify_message(text)
+    return label
+
+async def classify_message(text: str) -> Tuple[str, str]:
+    """
+    Тип сообщения и источник метки (LABEL_SOURCE_*). Источник пишется в messages.label_source:
+    локальный классификатор обучается только на метках LLM, а не на своих собственных.
+    """
+    message_classifier.ensure_trained()
+    label, confidence = message_classifier.predict(text)
+    if label is not None:
+        logger.debug(f"Локальный классификатор: {label} ({confidence:.2f}) для '{text[:50]}...'")
+        return label, LABEL_SOURCE_LOCAL
+
     try:
         messages = [
             {"role": "user", "content": MESSAGE_CLASSIFIER_PROMPT},
             {"role": "user", "content": text}
         ]
 
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: g4f.ChatCompletion.create(
-                model=SIMPLE_MODEL,
-                messages=messages,
-                stream=False
-            )
-        )
+        started = time.monotonic()
+        try:
+            response = await llm_gateway.complete(messages, 'classification', SIMPLE_MODEL)
+        finally:
+            message_classifier.record_escalation(time.monotonic() - started)
 
         logger.debug(f"Классификатор отработал для сообщения: '{text[:50]}...'")
 
         response_upper = response.upper().strip()
 
         if "BUSINESS_DATA" in response_upper:
-            return "business_data"
+            message_classifier.learn(text, "business_data")
+            return "business_data", LABEL_SOURCE_LLM
         elif "BUSINESS_QUESTION" in response_upper:
-            return "question"
+            message_classifier.learn(text, "question")
+            return "question", LABEL_SOURCE_LLM
         elif "GENERAL_CHAT" in response_upper:
-            return "general"
+            message_classifier.learn(text, "general")
+            return "general", LABEL_SOURCE_LLM
         else:
             # Fallback
             # Проверяем, если сообщение похоже на бизнес-данные (есть цифры и бизнес-слова)
             business_words = ['выручка', 'доход', 'прибыль', 'расход', 'трачу', 'клиент', 'продаю', 'чек', 'инвестиц', 'материалы', 'помещение', 'сотрудника', 'деталей', 'штуку']
             text_lower = text.lower()
             if any(word in text_lower for word in business_words) and any(char.isdigit() for char in text):
-                return "business_data"
+                return "business_data", LABEL_SOURCE_FALLBACK
             
-            return simple_detect_message_type(text) # Если не бизнес_дата, то используем простой классификатор
+            return simple_detect_message_type(text), LABEL_SOURCE_FALLBACK # Если не бизнес_дата, то используем простой классификатор
 
+    except LLMCancelledError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка классификации сообщения: {e}")
         # Fallback на простое определение
@@ -182,9 +442,9 @@ async def classify_message_type(text: str) -> str:
         business_words = ['выручка', 'доход', 'прибыль', 'расход', 'трачу', 'клиент', 'продаю', 'чек', 'инвестиц', 'материалы', 'помещение', 'сотрудника', 'деталей', 'штуку']
         text_lower = text.lower()
         if any(word in text_lower for word in business_words) and any(char.isdigit() for char in text):
-            return "business_data"
+            return "business_data", LABEL_SOURCE_FALLBACK
         
-        return simple_detect_message_type(text)
+        return simple_detect_message_type(text), LABEL_SOURCE_FALLBACK
 
 def simple_detect_message_type(text: str) -> str:
     """Простое определение типа сообщения (fallback)"""
@@ -215,23 +475,28 @@ def simple_detect_message_type(text: str) -> str:
     return "general"
 
 async def extract_business_data(text: str) -> Dict:
-    """Извлечение бизнес-данных из свободного текста"""
+    """Извлечение бизнес-данных из свободного текста: правила локально, LLM — только для неразобранного"""
+    data_extractor.stats['messages'] += 1
+    local_data, resolved = data_extractor.extract_local(text)
+    if resolved:
+        data_extractor.stats['local_only'] += 1
+        logger.debug(f"Данные извлечены локально: {local_data}")
+        return {**data_extractor.empty_result(), **local_data}
+
+    data_extractor.stats['llm_fallbacks'] += 1
+    llm_data = await _extract_business_data_llm(text)
+    # Числа, разобранные правилами, точнее догадок модели — они имеют приоритет
+    return {**data_extractor.empty_result(), **llm_data, **local_data}
+
+async def _extract_business_data_llm(text: str) -> Dict:
+    """Извлечение бизнес-данных через LLM"""
     try:
         messages = [
             {"role": "user", "content": BUSINESS_DATA_EXTRACTION_PROMPT},
             {"role": "user", "content": text}
         ]
         
-        import asyncio
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: g4f.ChatCompletion.create(
-                model=g4f.models.gpt_4,
-                messages=messages,
-                stream=False
-            )
-        )
+        response = await llm_gateway.complete(messages, 'extraction', g4f.models.gpt_4)
 
         logger.debug("Извлечение данных выполнено")
 
@@ -254,110 +519,199 @@ async def extract_business_data(text: str) -> Dict:
         logger.error(f"Ошибка извлечения бизнес-данных: {e}")
         return {}
 
+def _significant_data(collected_data: Dict) -> Dict:
+    """Только значимые данные (не None, не 0, не пустые строки)"""
+    return {
+        k: v for k, v in collected_data.items()
+        if v is not None and v != 0 and v != '' and str(v).strip() != ''
+    }
+
+def plan_missing_data(collected_data: Dict) -> str:
+    """
+    Детерминированный планировщик: вопрос о самом приоритетном отсутствующем поле
+    или ENOUGH_DATA, если собраны все поля.
+    """
+    significant_data = _significant_data(collected_data)
+    for field in MISSING_DATA_PRIORITY:
+        if field not in significant_data:
+            return MISSING_DATA_QUESTIONS[field]
+    return "ENOUGH_DATA"
+
 async def analyze_missing_data(collected_data: Dict) -> str:
-    """Анализ недостающих данных и формирование вопросов"""
+    """Анализ недостающих данных и формирование вопросов (без LLM; LLM — только для переформулировки)"""
+    question = plan_missing_data(collected_data)
+    if question == "ENOUGH_DATA" or not LLM_REPHRASE_MISSING_QUESTIONS:
+        return question
+
     try:
-        # Форматируем собранные данные для промпта
-        # Фильтруем только значимые данные (не None, не 0, не пустые строки)
-        significant_data = {}
-        for k, v in collected_data.items():
-            if v is not None and v != 0 and v != '' and str(v).strip() != '':
-                significant_data[k] = v
-        
-        data_text = "\n".join([f"- {k}: {v}" for k, v in significant_data.items()])
-        
-        prompt = MISSING_DATA_ANALYSIS_PROMPT.format(collected_data=data_text)
-        
+        data_text = "\n".join([f"- {k}: {v}" for k, v in _significant_data(collected_data).items()])
+        prompt = MISSING_DATA_REPHRASE_PROMPT.format(collected_data=data_text, question=question)
+
         messages = [
             {"role": "user", "content": prompt}
         ]
 
-        response = g4f.ChatCompletion.create(
-            model=g4f.models.gpt_4,
-            messages=messages,
-            stream=False
-        )
+        response = await llm_gateway.complete(messages, 'missing_data', g4f.models.gpt_4)
+
+        logger.debug("Вопрос о недостающих данных переформулирован")
+
+        rephrased = response.strip()
+        # ENOUGH_DATA решает только планировщик
+        return rephrased if rephrased and "ENOUGH_DATA" not in rephrased.upper() else question
 
-        logger.debug("Анализ недостающих данных выполнен")
-        
-        return response.strip()
-        
     except Exception as e:
-        logger.error(f"Ошибка анализа недостающих данных: {e}")
-        return "ENOUGH_DATA"  # В случае ошибки считаем что данных достаточно
+        logger.error(f"Ошибка переформулировки вопроса о недостающих данных: {e}")
+        return question
 
 def prepare_messages(user_id: str, prompt: str, user_message: str):
     """Подготавливает сообщения с промптом предposlедним"""
-    if user_id not in conversation_memory:
-        conversation_memory[user_id] = []
-    
-    messages = conversation_memory[user_id].copy()  # История
+    messages = conversation_memory.get_messages(user_id)  # История
     if prompt:
         messages.append({"role": "user", "content": prompt})  # Промпт предposledним
     messages.append({"role": "user", "content": user_message})  # Запрос последним
     
     return messages
 
+def _remember_turn(user_id: str, user_message: str, response: str):
+    """Запись реплики в историю пользователя (длину истории ограничивает хранилище)"""
+    conversation_memory.append_turn(user_id, user_message, response)
+
 async def answer_question(question: str, user_id: str = "default") -> str:
     """Ответ на вопрос о бизнесе"""
     try:
+        await conversation_memory.ensure_loaded(user_id)
         messages = prepare_messages(user_id, QUESTION_ANSWER_PROMPT, question)
 
-        import asyncio
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: g4f.ChatCompletion.create(
-                model=SIMPLE_MODEL,
-                messages=messages,
-                stream=False
-            )
-        )
-        
-        conversation_memory[user_id].extend([
-            {"role": "user", "content": question},
-            {"role": "assistant", "content": response}
-        ])
+        response = await llm_gateway.complete(messages, 'question', SIMPLE_MODEL)
         
-        # Ограничиваем историю
-        if len(conversation_memory[user_id]) > 12:
-            conversation_memory[user_id] = conversation_memory[user_id][-12:]   
+        _remember_turn(user_id, question, response)
         return response
         
+    except LLMCancelledError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка ответа на вопрос: {e}")
         return f"Извините, произошла ошибка: {str(e)}"
 
-async def general_chat(message: str, user_id: str = "default") -> str:
-    """Общий разговор"""
+async def general_chat(message: str, user_id: str = "default", prompt_type: str = 'chat') -> str:
+    """Общий разговор (prompt_type='analysis' — неотменяемый запрос с увеличенным таймаутом)"""
     try:
+        await conversation_memory.ensure_loaded(user_id)
         messages = prepare_messages(user_id, GENERAL_CHAT_PROMPT, message)
 
-        import asyncio
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: g4f.ChatCompletion.create(
-                model=SIMPLE_MODEL,
-                messages=messages,
-                stream=False
-            )
-        )
-        
-        conversation_memory[user_id].extend([
-            {"role": "user", "content": message},
-            {"role": "assistant", "content": response}
-        ])
+        response = await llm_gateway.complete(messages, prompt_type, SIMPLE_MODEL)
         
-        # Ограничиваем историю
-        if len(conversation_memory[user_id]) > 12:
-            conversation_memory[user_id] = conversation_memory[user_id][-12:]   
+        _remember_turn(user_id, message, response)
         return response
         
+    except LLMCancelledError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка общего чата: {e}")
         return "Привет! Расскажите о своем бизнесе - помогу с анализом!"
 
+async def _stream_reply(prompt: str, user_message: str, user_id: str, prompt_type: str, error_text) -> AsyncIterator[str]:
+    """
+    Потоковый ответ с записью в историю после завершения.
+    Ошибка до первого фрагмента даёт тот же текст, что и непотоковая версия; после — ответ обрывается.
+    """
+    await conversation_memory.ensure_loaded(user_id)
+    messages = prepare_messages(user_id, prompt, user_message)
+    parts: List[str] = []
+    try:
+        async for chunk in llm_gateway.stream(messages, prompt_type, SIMPLE_MODEL):
+            parts.append(chunk)
+            yield chunk
+    except LLMCancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка потокового ответа ({prompt_type}): {e}")
+        if not parts:
+            yield error_text(e)
+            return
+
+    if parts:
+        _remember_turn(user_id, user_message, "".join(parts))
+
+def stream_answer_question(question: str, user_id: str = "default") -> AsyncIterator[str]:
+    """Ответ на вопрос о бизнесе по мере генерации"""
+    return _stream_reply(QUESTION_ANSWER_PROMPT, question, user_id, 'question',
+                         lambda e: f"Извините, произошла ошибка: {str(e)}")
+
+def stream_general_chat(message: str, user_id: str = "default") -> AsyncIterator[str]:
+    """Общий разговор по мере генерации"""
+    return _stream_reply(GENERAL_CHAT_PROMPT, message, user_id, 'chat',
+                         lambda e: "Привет! Расскажите о своем бизнесе - помогу с анализом!")
+
+async def check_loop_responsiveness(provider_delay: float = 1.0, calls: int = 4) -> float:
+    """
+    Регрессионная проверка: пока медленный провайдер отвечает, event loop не должен блокироваться.
+    Возвращает максимальную задержку heartbeat-тика в секундах.
+    """
+    global _provider_create
+    original_provider = _provider_create
+
+    def slow_provider(model, messages):
+        time.sleep(provider_delay)
+        return "pong"
+
+    tick = 0.05
+    max_lag = 0.0
+    stop = asyncio.Event()
+
+    async def heartbeat():
+        nonlocal max_lag
+        while not stop.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(tick)
+            max_lag = max(max_lag, time.monotonic() - started - tick)
+
+    _provider_create = slow_provider
+    try:
+        beat = asyncio.create_task(heartbeat())
+        ping = [{"role": "user", "content": "ping"}]
+        await asyncio.gather(*(llm_gateway.complete(ping, 'question') for _ in range(calls)))
+        stop.set()
+        await beat
+    finally:
+        _provider_create = original_provider
+    return max_lag
+
+async def check_turn_cancellation(provider_delay: float = 1.0) -> float:
+    """
+    Регрессионная проверка: новое сообщение пользователя прерывает ожидание ответа на предыдущее.
+    Возвращает, сколько секунд старая реплика ждала после отмены.
+    """
+    global _provider_create
+    original_provider = _provider_create
+
+    def slow_provider(model, messages):
+        time.sleep(provider_delay)
+        return "ответ"
+
+    async def old_turn():
+        token = llm_gateway.begin_turn("check_user")
+        try:
+            await general_chat("первое сообщение", "check_user")
+        except LLMCancelledError:
+            return time.monotonic()
+        finally:
+            llm_gateway.end_turn(token)
+
+    _provider_create = slow_provider
+    try:
+        task = asyncio.create_task(old_turn())
+        await asyncio.sleep(0.1)
+        cancelled_at = time.monotonic()
+        llm_gateway.cancel_user("check_user")
+        finished_at = await task
+    finally:
+        _provider_create = original_provider
+        conversation_memory.pop("check_user", None)
+    assert finished_at is not None, "Старая реплика не была отменена"
+    assert "check_user" not in llm_gateway._generations, "номер реплики остался после её завершения"
+    return finished_at - cancelled_at
+
 # Тестирование
 if __name__ == "__main__":
     import asyncio
@@ -365,9 +719,22 @@ if __name__ == "__main__":
     async def test_ai():
         print("🧠 Тестируем обновленный AI...")
         
+        lag = await check_loop_responsiveness()
+        print(f"Макс. задержка event loop при медленном LLM: {lag * 1000:.0f} мс")
+        assert lag < 0.2, "LLM-вызов блокирует event loop"
+
+        wait = await check_turn_cancellation()
+        print(f"Отмена устаревшей реплики: {wait * 1000:.0f} мс")
+        assert wait < 0.2, "Новое сообщение не прерывает ожидание LLM"
+
+        assert plan_missing_data({}) == MISSING_DATA_QUESTIONS['business_name']
+        assert plan_missing_data({'business_name': 'Кофейня', 'revenue': 0}) == MISSING_DATA_QUESTIONS['revenue']
+        assert plan_missing_data({field: 1 for field in MISSING_DATA_PRIORITY}) == "ENOUGH_DATA"
+        print("Шлюз LLM:", llm_gateway.get_stats())
+        
         # Тест извлечения данных
         test_text = "У меня кофейня, выручка 500к в месяц, расходы 200к, около 100 клиентов в день, средний чек 500 рублей"
         result = await extract_business_data(test_text)
         print("Извлеченные данные:", result)
         
-    asyncio.run(test_ai())
\ No newline at end of file
+    asyncio.run(test_ai())
@@ -0,0 +1,291 @@
+"""
+Пересчет метрик в business_snapshots после изменения формул metrics_calculator.py.
+
+Снимки читаются серверным курсором кусками по --chunk-size строк, метрики считаются
+пакетно (MetricsCalculator.calculate_metrics_batch), revenue_growth_rate — относительно
+предыдущего снимка того же бизнеса. Health Score считается по отрасли бизнеса (businesses.business_type)
+с теми же бенчмарками, что в живом пути: они один раз загружаются BenchmarkEngine и передаются процессам. Результат пишется одним UPDATE ... FROM (VALUES ...)
+на кусок; строки, у которых ничего не изменилось, не переписываются. Переписанным ставится
+updated_at — по нему меняется ETag рядов графиков (get_business_series_version).
+
+Таблица снимков делится на диапазоны business_id, диапазоны обрабатываются пулом процессов.
+Прогресс каждого диапазона хранится в metrics_backfill_progress и фиксируется в той же
+транзакции, что и UPDATE куска: прерванный запуск с тем же --run продолжается с места остановки.
+Между кусками процесс спит --pause-ms, чтобы не забивать БД.
+
+Если запуск что-то изменил, в конце пересобираются сводки business_rollups (в них Health Score снимков).
+Решение принимается по metrics_backfill_progress, а не по текущему вызову: строки, записанные до
+остановки, при продолжении уже совпадают, но сводки для них еще не пересобраны (rollups_rebuilt).
+Кэши работающих процессов (CachedDatabase) подхватят новые значения не позже DB_CACHE_TTL.
+
+Запуск: python backfill_metrics.py [--workers 4] [--chunk-size 5000] [--pause-ms 50] [--run NAME] [--restart] [--dry-run]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from benchmark_engine import BenchmarkEngine, DEFAULT_BUSINESS_TYPE
+from database import Database, REBUILD_BUSINESS_ROLLUPS, SNAPSHOT_METRIC_COLUMNS, _as_float
+from metrics_calculator import metrics_calculator
+
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", "5000"))
+BACKFILL_PAUSE_MS = int(os.getenv("BACKFILL_PAUSE_MS", "50"))
+
+# Диапазонов business_id на процесс: мелкие диапазоны выравнивают нагрузку между процессами
+_RANGES_PER_WORKER = 8
+
+# Колонки снимка, из которых считаются метрики (new_clients нет и в живом пути — оценка clients * 0.3)
+INPUT_COLUMNS = ['revenue', 'expenses', 'profit', 'clients', 'investments', 'marketing_costs']
+SCORE_COLUMNS = [column for column in SNAPSHOT_METRIC_COLUMNS if column.endswith('_health_score')]
+FLOAT_COLUMNS = [column for column in SNAPSHOT_METRIC_COLUMNS if column not in SCORE_COLUMNS]
+OUTPUT_COLUMNS = FLOAT_COLUMNS + SCORE_COLUMNS
+
+PROGRESS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS metrics_backfill_progress (
+        run_name TEXT NOT NULL,
+        range_start INTEGER NOT NULL,
+        range_end INTEGER NOT NULL,
+        next_business_id INTEGER NOT NULL, -- диапазон обходится сверху вниз; всё выше уже записано
+        done BOOLEAN NOT NULL DEFAULT FALSE,
+        rows_updated BIGINT NOT NULL DEFAULT 0,
+        rollups_rebuilt BOOLEAN NOT NULL DEFAULT FALSE, -- сводки пересобраны после всех rows_updated
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (run_name, range_start)
+    )
+'''
+# Таблица прогресса из версии без rollups_rebuilt
+PROGRESS_TABLE_UPGRADE = '''
+    ALTER TABLE metrics_backfill_progress ADD COLUMN IF NOT EXISTS rollups_rebuilt BOOLEAN NOT NULL DEFAULT FALSE
+'''
+
+# Порядок совпадает с обратным обходом idx_snapshots_business_created — без сортировки на сервере
+SELECT_SNAPSHOTS = f'''
+    SELECT s.snapshot_id, s.business_id, COALESCE(b.business_type, '{DEFAULT_BUSINESS_TYPE}'),
+        {', '.join(f's.{column}' for column in INPUT_COLUMNS)}
+    FROM business_snapshots s
+    JOIN businesses b ON b.business_id = s.business_id
+    WHERE s.business_id BETWEEN %s AND %s
+    ORDER BY s.business_id DESC, s.created_at, s.snapshot_id
+'''
+
+UPDATE_SNAPSHOTS = f'''
+    UPDATE business_snapshots AS s SET {', '.join(f'{column} = v.{column}' for column in OUTPUT_COLUMNS)},
+        updated_at = CURRENT_TIMESTAMP
+    FROM (VALUES %s) AS v(snapshot_id, {', '.join(OUTPUT_COLUMNS)})
+    WHERE s.snapshot_id = v.snapshot_id
+      AND ({', '.join(f's.{column}' for column in OUTPUT_COLUMNS)})
+          IS DISTINCT FROM ({', '.join(f'v.{column}' for column in OUTPUT_COLUMNS)})
+'''
+UPDATE_TEMPLATE = '(' + ', '.join(
+    ['%s::integer'] + ['%s::double precision'] * len(FLOAT_COLUMNS) + ['%s::integer'] * len(SCORE_COLUMNS)
+) + ')'
+
+def compute_chunk(rows: List[tuple], carry: Optional[Tuple[int, float]]) -> Tuple[List[tuple], Tuple[int, float]]:
+    """
+    Метрики для куска строк (snapshot_id, business_id, business_type, *INPUT_COLUMNS) в порядке обхода.
+    carry — (business_id, revenue) последней строки предыдущего куска: предшественник первой строки.
+    Строки считаются пакетами по типу бизнеса — у каждой отрасли свой бенчмарк Health Score.
+    Возвращает кортежи для UPDATE_SNAPSHOTS и carry для следующего куска.
+    """
+    columns = {name: [_as_float(row[index + 3]) for row in rows] for index, name in enumerate(INPUT_COLUMNS)}
+    previous_revenue = []
+    previous_business, previous = carry if carry else (None, float('nan'))
+    for row, revenue in zip(rows, columns['revenue']):
+        previous_revenue.append(previous if row[1] == previous_business else float('nan'))
+        previous_business, previous = row[1], revenue
+
+    by_industry: Dict[str, List[int]] = {}
+    for index, row in enumerate(rows):
+        by_industry.setdefault(row[2], []).append(index)
+
+    values = []
+    for industry, indexes in by_industry.items():
+        result = metrics_calculator.calculate_metrics_batch(
+            {name: [column[i] for i in indexes] for name, column in columns.items()},
+            [previous_revenue[i] for i in indexes],
+            industry=industry,
+        )
+        values.extend(zip(
+            [rows[i][0] for i in indexes],
+            *(result[column].tolist() for column in OUTPUT_COLUMNS)
+        ))
+    return values, (previous_business, previous)
+
+def backfill_range(dsn: str, run_name: str, range_start: int, next_business_id: int,
+                   chunk_size: int, pause: float, dry_run: bool, benchmarks: Dict[str, Dict]) -> Dict:
+    """Пересчет диапазона business_id [range_start, next_business_id] в отдельном процессе"""
+    for industry, benchmark in benchmarks.items():
+        metrics_calculator.set_industry_benchmark(industry, benchmark)
+    reader = psycopg2.connect(dsn)
+    writer = psycopg2.connect(dsn)
+    stats = {'range_start': range_start, 'scanned': 0, 'updated': 0, 'chunks': 0}
+    try:
+        reader.set_session(readonly=True)
+        # Именованный курсор — серверный: строки приходят кусками, а не всей выборкой сразу
+        cursor = reader.cursor(name=f"backfill_{run_name}_{range_start}")
+        cursor.itersize = chunk_size
+        cursor.execute(SELECT_SNAPSHOTS, (range_start, next_business_id))
+
+        carry = None
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            values, carry = compute_chunk(rows, carry)
+            with writer.cursor() as write_cursor:
+                execute_values(write_cursor, UPDATE_SNAPSHOTS, values, template=UPDATE_TEMPLATE,
+                               page_size=len(values))
+                updated = write_cursor.rowcount
+                # Бизнес последней строки мог не поместиться в кусок целиком — при продолжении
+                # он пересчитывается заново (UPDATE идемпотентен), всё выше уже записано
+                write_cursor.execute('''
+                    UPDATE metrics_backfill_progress
+                    SET next_business_id = %s, rows_updated = rows_updated + %s,
+                        rollups_rebuilt = rollups_rebuilt AND %s = 0, updated_at = CURRENT_TIMESTAMP
+                    WHERE run_name = %s AND range_start = %s
+                ''', (rows[-1][1], updated, updated, run_name, range_start))
+            if dry_run:
+                writer.rollback()
+            else:
+                writer.commit()
+            stats['scanned'] += len(rows)
+            stats['updated'] += updated
+            stats['chunks'] += 1
+            if pause:
+                time.sleep(pause)
+
+        if not dry_run:
+            with writer.cursor() as write_cursor:
+                write_cursor.execute('''
+                    UPDATE metrics_backfill_progress SET done = TRUE, updated_at = CURRENT_TIMESTAMP
+                    WHERE run_name = %s AND range_start = %s
+                ''', (run_name, range_start))
+            writer.commit()
+        return stats
+    finally:
+        reader.close()
+        writer.close()
+
+async def load_benchmarks() -> Dict[str, Dict]:
+    """Отраслевые бенчмарки из данных — те же, что BenchmarkEngine публикует в живом процессе"""
+    database = Database()
+    await database.init_db()
+    try:
+        engine = BenchmarkEngine(database)
+        await engine.refresh()
+        return engine.benchmarks
+    finally:
+        database.close()
+
+def plan_ranges(cursor, run_name: str, workers: int, restart: bool) -> List[Tuple[int, int]]:
+    """Незавершенные диапазоны запуска: (range_start, next_business_id); при первом запуске — разбиение"""
+    cursor.execute(PROGRESS_TABLE)
+    cursor.execute(PROGRESS_TABLE_UPGRADE)
+    if restart:
+        cursor.execute("DELETE FROM metrics_backfill_progress WHERE run_name = %s", (run_name,))
+    cursor.execute("SELECT 1 FROM metrics_backfill_progress WHERE run_name = %s LIMIT 1", (run_name,))
+    if cursor.fetchone() is None:
+        cursor.execute("SELECT MIN(business_id), MAX(business_id) FROM business_snapshots")
+        low, high = cursor.fetchone()
+        if low is None:
+            return []
+        count = max(1, workers * _RANGES_PER_WORKER)
+        width = max(1, -(-(high - low + 1) // count))
+        ranges = [(start, min(high, start + width - 1)) for start in range(low, high + 1, width)]
+        execute_values(cursor, '''
+            INSERT INTO metrics_backfill_progress (run_name, range_start, range_end, next_business_id) VALUES %s
+        ''', [(run_name, start, end, end) for start, end in ranges])
+    cursor.execute('''
+        SELECT range_start, next_business_id FROM metrics_backfill_progress
+        WHERE run_name = %s AND NOT done ORDER BY range_start
+    ''', (run_name,))
+    return cursor.fetchall()
+
+def rebuild_rollups_if_needed(cursor, run_name: str) -> bool:
+    """Пересобрать business_rollups, если запуск (в том числе прерванный ранее) изменил снимки после последней пересборки"""
+    cursor.execute('''
+        SELECT 1 FROM metrics_backfill_progress
+        WHERE run_name = %s AND rows_updated > 0 AND NOT rollups_rebuilt LIMIT 1
+    ''', (run_name,))
+    if cursor.fetchone() is None:
+        return False
+    # Health Score в сводках business_rollups считан с прежних значений снимков
+    cursor.execute(REBUILD_BUSINESS_ROLLUPS)
+    cursor.execute("UPDATE metrics_backfill_progress SET rollups_rebuilt = TRUE WHERE run_name = %s", (run_name,))
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет метрик business_snapshots")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="процессов")
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help="строк на чтение и UPDATE")
+    parser.add_argument('--pause-ms', type=int, default=BACKFILL_PAUSE_MS, help="пауза между кусками")
+    parser.add_argument('--run', default='default', help="имя запуска для продолжения после остановки")
+    parser.add_argument('--restart', action='store_true', help="сбросить прогресс запуска и начать заново")
+    parser.add_argument('--dry-run', action='store_true', help="посчитать изменения без записи")
+    args = parser.parse_args()
+
+    dsn = Database().build_dsn_from_env()
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        ranges = plan_ranges(conn.cursor(), args.run, args.workers, args.restart)
+        if not ranges:
+            # Запуск мог остановиться после последнего куска, но до пересборки сводок
+            if not args.dry_run and rebuild_rollups_if_needed(conn.cursor(), args.run):
+                print("  сводки business_rollups пересобраны")
+            print(f"✅ Запуск '{args.run}': пересчитывать нечего")
+            return
+    finally:
+        conn.close()
+
+    benchmarks = asyncio.run(load_benchmarks())
+    print(f"🔁 Запуск '{args.run}': {len(ranges)} диапазонов business_id, процессов {args.workers}"
+          f"{' (без записи)' if args.dry_run else ''}; бенчмарки из данных: {', '.join(benchmarks) or 'нет'}")
+    started = time.perf_counter()
+    totals = {'scanned': 0, 'updated': 0}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(backfill_range, dsn, args.run, range_start, next_business_id,
+                        args.chunk_size, args.pause_ms / 1000, args.dry_run, benchmarks): range_start
+            for range_start, next_business_id in ranges
+        }
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ Диапазон с business_id {futures[future]}: {e}")
+                continue
+            totals['scanned'] += stats['scanned']
+            totals['updated'] += stats['updated']
+            print(f"  диапазон с business_id {stats['range_start']}: "
+                  f"прочитано {stats['scanned']}, изменено {stats['updated']}")
+
+    if not args.dry_run:
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+        try:
+            if rebuild_rollups_if_needed(conn.cursor(), args.run):
+                print("  сводки business_rollups пересобраны")
+        finally:
+            conn.close()
+
+    elapsed = time.perf_counter() - started
+    rate = totals['scanned'] / elapsed if elapsed else 0
+    print(f"{'❌' if failed else '✅'} Прочитано {totals['scanned']} снимков, изменено {totals['updated']} "
+          f"за {elapsed:.1f} с ({rate:.0f} строк/с)")
+    if failed:
+        print(f"Диапазонов с ошибкой: {failed}; повторный запуск с --run {args.run} продолжит с места остановки")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Микробенчмарк Health Score: цепочки if/elif против правил HEALTH_SCORE_RULES.
+
+Сравниваются:
+- if/elif — MetricsCalculator._calculate_*_health_score, скалярный путь (одна строка);
+- правила, searchsorted — HealthScoreRules.score_batch для всех строк сразу (пакетный путь).
+Перед замером оценки сверяются по всем отраслям industry_benchmarks, включая значения ровно на порогах:
+правила должны давать те же баллы, что if/elif.
+
+Запуск: python bench_health_scores.py [кол-во строк] (нужен NumPy)
+"""
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+from metrics_calculator import MetricsCalculator, HealthScoreRules, HEALTH_SCORE_RULES, np
+
+SCORES = list(HEALTH_SCORE_RULES)
+
+def scalar_scorers(calculator: MetricsCalculator) -> Dict[str, Callable[[Dict, Dict], int]]:
+    return {
+        'financial_health_score': calculator._calculate_financial_health_score,
+        'growth_health_score': calculator._calculate_growth_health_score,
+        'efficiency_health_score': calculator._calculate_efficiency_health_score,
+    }
+
+def sample_metrics(rows: int, benchmark: Dict) -> List[Dict]:
+    """Случайные метрики; каждое третье значение — ровно на одном из порогов"""
+    edges = [0, 0.5, 1.0, 1.5, 2.0, 3, 5, 6, 10, 12, 15, 20, 30, 999, -0.0]
+    edges += [benchmark['ltv_cac_ratio'] * k for k in (0.5, 0.7, 1.0, 1.5)]
+    names = ['profit_margin', 'safety_margin', 'months_to_bankruptcy', 'roi', 'revenue_growth_rate', 'sgr',
+             'ltv_cac_ratio', 'asset_turnover', 'profitability_index']
+    rng = random.Random(23)
+    return [
+        {name: rng.choice(edges) if rng.random() < 0.33 else rng.uniform(-50, 60) for name in names}
+        for _ in range(rows)
+    ]
+
+def measure(name: str, rows: int, call: Callable[[], object]) -> float:
+    best = float('inf')
+    for _ in range(5):
+        started = time.perf_counter()
+        call()
+        best = min(best, time.perf_counter() - started)
+    print(f"{name:>24}: {best * 1000:8.2f} мс, {best / rows * 1e9:7.0f} нс/строка")
+    return best
+
+def main():
+    if np is None:
+        print("NumPy не установлен — правила используются только в пакетном пути, сравнивать не с чем")
+        return
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    calculator = MetricsCalculator()
+    scalar = scalar_scorers(calculator)
+
+    for industry, benchmark in calculator.industry_benchmarks.items():
+        rules = HealthScoreRules(benchmark)
+        metrics = sample_metrics(2000, benchmark)
+        columns = {name: np.asarray([row[name] for row in metrics]) for name in metrics[0]}
+        for score in SCORES:
+            expected = [scalar[score](row, benchmark) for row in metrics]
+            assert rules.score_batch(score, columns).tolist() == expected, f"{industry}: {score}"
+    print(f"✅ Оценки правил совпадают с if/elif для отраслей: {', '.join(calculator.industry_benchmarks)}")
+
+    benchmark = calculator.industry_benchmarks['other']
+    rules = HealthScoreRules(benchmark)
+    metrics = sample_metrics(rows, benchmark)
+    columns = {name: np.asarray([row[name] for row in metrics]) for name in metrics[0]}
+    print(f"Строк: {rows}, три оценки на строку")
+    legacy = measure("if/elif", rows, lambda: [[scalar[score](row, benchmark) for score in SCORES] for row in metrics])
+    batch = measure("правила, searchsorted", rows, lambda: [rules.score_batch(score, columns) for score in SCORES])
+    print(f"{'':>24}  searchsorted быстрее if/elif в {legacy / batch:.0f} раз")
+
+if __name__ == "__main__":
+    main()
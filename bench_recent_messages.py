@@ -0,0 +1,133 @@
+"""
+Бенчмарк подгрузки истории пользователя (get_user_recent_messages) на большой таблице messages.
+
+Во временной схеме тестовой базы (DATABASE_URL / PG*) создаются таблицы и индексы из
+SCHEMA_STATEMENTS и MIGRATIONS, засевается N сообщений (по умолчанию 10 млн) и сравниваются:
+- прежний запрос: соединение messages с conversation_sessions по session_id и фильтр cs.user_id;
+- текущий запрос Database: прямой путь по индексу messages (user_id, id DESC);
+- кольцо последних сообщений в памяти (повторная подгрузка без БД).
+Схема удаляется в конце.
+
+Запуск: python bench_recent_messages.py [кол-во сообщений] [кол-во пользователей] [кол-во замеров]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from database import Database, SCHEMA_STATEMENTS, MIGRATIONS
+
+LEGACY_QUERY = '''
+    SELECT m.user_message, m.bot_response, m.message_type, m.created_at
+    FROM messages m
+    JOIN conversation_sessions cs ON cs.session_id = m.session_id
+    WHERE cs.user_id = %s AND m.session_id IS NOT NULL
+    ORDER BY m.id DESC
+    LIMIT %s
+'''
+
+# Сообщения засеваются пачками, чтобы не держать одну гигантскую транзакцию
+_SEED_CHUNK = 1_000_000
+
+def seed(cursor, messages: int, users: int):
+    sessions = users * 5
+    cursor.execute(f"""
+        INSERT INTO users (user_id, username)
+        SELECT 'user_' || g, 'u' || g FROM generate_series(1, {users}) g
+    """)
+    cursor.execute(f"""
+        INSERT INTO conversation_sessions (user_id, current_state, collected_data)
+        SELECT 'user_' || (g % {users} + 1), CASE WHEN g % 3 = 0 THEN 'chat' ELSE 'completed' END, '{{}}'
+        FROM generate_series(1, {sessions}) g
+    """)
+    for start in range(1, messages + 1, _SEED_CHUNK):
+        end = min(messages, start + _SEED_CHUNK - 1)
+        cursor.execute(f"""
+            INSERT INTO messages (user_id, session_id, user_message, bot_response, message_type)
+            SELECT 'user_' || ((g % {sessions}) % {users} + 1), g % {sessions} + 1,
+                   'сообщение ' || g, 'ответ ' || g, 'general'
+            FROM generate_series({start}, {end}) g
+        """)
+        print(f"  засеяно {end:,} / {messages:,}")
+    cursor.execute("ANALYZE")
+
+def measure(name: str, samples: int, call: Callable[[str], object], users: int) -> Dict:
+    latencies: List[float] = []
+    for _ in range(samples):
+        user_id = f"user_{random.randint(1, users)}"
+        started = time.perf_counter()
+        call(user_id)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    result = {
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+    print(f"{name:>22}: p50 {result['p50_ms']:.3f} мс, p99 {result['p99_ms']:.3f} мс")
+    return result
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    samples = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    schema = f"bench_recent_{os.getpid()}"
+
+    conn = psycopg2.connect(Database().build_dsn_from_env(), cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(f"SET search_path TO {schema}")
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+        print(f"🌱 Засеваю {messages:,} сообщений для {users:,} пользователей...")
+        seed(cursor, messages, users)
+        for _, _, statements in MIGRATIONS:
+            for statement in statements:
+                cursor.execute(statement)
+        cursor.execute("ANALYZE")
+
+        def run(query: str):
+            def call(user_id: str):
+                cursor.execute(query, (user_id, 20))
+                return cursor.fetchall()
+            return call
+
+        # Текущий SQL берём из самого Database, чтобы бенчмарк не расходился с кодом
+        database = Database()
+        captured = []
+
+        async def capture(query, params=()):
+            captured.append(query)
+            return []
+
+        database._fetch = capture
+        asyncio.run(database.get_user_recent_messages('user_1', limit=20))
+        current_query = captured[0]
+
+        print(f"⏱ {samples} подгрузок истории по 20 сообщений:")
+        legacy = measure('соединение с сессиями', samples, run(LEGACY_QUERY), users)
+        direct = measure('messages (user_id, id)', samples, run(current_query), users)
+
+        # Кольцо: прогреваем ответами БД, затем повторная подгрузка идёт из памяти
+        ring_users = min(users, samples)
+        for i in range(1, ring_users + 1):
+            rows = run(current_query)(f"user_{i}")
+            version = database._recent_messages.begin_prime(f"user_{i}")
+            database._recent_messages.prime(f"user_{i}", [dict(row) for row in reversed(rows)], version)
+        ring = measure('кольцо в памяти', samples,
+                       lambda user_id: database._recent_messages.get(user_id, 20), ring_users)
+
+        print(f"📈 прямой индекс быстрее соединения в {legacy['p50_ms'] / max(direct['p50_ms'], 1e-6):.1f} раза (p50), "
+              f"кольцо — в {legacy['p50_ms'] / max(ring['p50_ms'], 1e-6):.0f} раз")
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.close()
+
+if __name__ == "__main__":
+    main()
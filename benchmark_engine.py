@@ -0,0 +1,252 @@
+"""
+Отраслевые бенчмарки из собственных данных: распределения ключевых метрик по businesses.business_type.
+
+Движок держит в памяти последний снимок каждого активного бизнеса (тип и значения
+BENCHMARK_METRICS) и обновляет его инкрементально: раз в BENCHMARK_REFRESH_INTERVAL читает
+только снимки с snapshot_id больше уже виденного (по первичному ключу). Перцентили считаются
+по этому срезу в памяти с той же линейной интерполяцией, что percentile_cont в PostgreSQL.
+Обновление идет фоновой задачей: ensure_fresh на пути запроса только планирует его, а до
+первого обновления действуют статические бенчмарки. Раз в BENCHMARK_FULL_RELOAD срез перечитывается целиком — так учитываются удаленные бизнесы,
+смена типа и пересчет метрик backfill_metrics.py (он меняет строки, не меняя snapshot_id).
+
+Цель отрасли — медиана (BENCHMARK_TARGET_PERCENTILE) при выборке не меньше BENCHMARK_MIN_SAMPLE
+бизнесов; иначе остается статический бенчмарк MetricsCalculator. Результат передается в
+metrics_calculator.set_industry_benchmark и используется Health Score и generate_benchmark_report.
+"""
+import asyncio
+import math
+import os
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from database import db
+from metrics_calculator import metrics_calculator
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_REFRESH_INTERVAL = int(os.getenv("BENCHMARK_REFRESH_INTERVAL", "3600"))
+BENCHMARK_FULL_RELOAD = int(os.getenv("BENCHMARK_FULL_RELOAD", str(24 * 3600)))
+BENCHMARK_MIN_SAMPLE = int(os.getenv("BENCHMARK_MIN_SAMPLE", "30"))
+BENCHMARK_TARGET_PERCENTILE = float(os.getenv("BENCHMARK_TARGET_PERCENTILE", "0.5"))
+BENCHMARK_PAGE_SIZE = int(os.getenv("BENCHMARK_PAGE_SIZE", "5000"))
+
+# Метрики с отраслевой целью (ключи industry_benchmarks)
+BENCHMARK_METRICS = ('profit_margin', 'ltv_cac_ratio', 'roi')
+# Перцентили, которые отдаются в отчет
+REPORT_PERCENTILES = (0.25, 0.5, 0.75)
+# Тип бизнеса по умолчанию (Database.create_business)
+DEFAULT_BUSINESS_TYPE = "general"
+
+def percentile_cont(values: List[float], fraction: float) -> float:
+    """Перцентиль по отсортированному списку с линейной интерполяцией (как percentile_cont)"""
+    position = fraction * (len(values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class BenchmarkEngine:
+    """Инкрементально обновляемые перцентили метрик по типам бизнеса"""
+
+    def __init__(self, database, calculator=None, refresh_interval: int = None,
+                 full_reload: int = None, min_sample: int = None):
+        self.database = database
+        self.calculator = calculator or metrics_calculator
+        self.refresh_interval = refresh_interval or BENCHMARK_REFRESH_INTERVAL
+        self.full_reload = full_reload or BENCHMARK_FULL_RELOAD
+        self.min_sample = min_sample or BENCHMARK_MIN_SAMPLE
+
+        # Статические бенчмарки — запасной вариант для отраслей и метрик без достаточной выборки
+        self._static = {industry: dict(benchmark) for industry, benchmark in self.calculator.industry_benchmarks.items()}
+        # business_id -> (business_type, значения BENCHMARK_METRICS) последнего снимка
+        self._latest: Dict[int, Tuple[str, Tuple[float, ...]]] = {}
+        self._watermark = 0
+        self._refreshed_at: Optional[float] = None
+        self._reloaded_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.benchmarks: Dict[str, Dict] = {}
+
+        self.stats = {
+            'refreshes': 0,
+            'full_reloads': 0,
+            'rows_read': 0,
+            'failed_refreshes': 0,
+            'last_refresh_ms': 0.0,
+        }
+
+    def industry_for(self, business_id: Optional[int]) -> str:
+        """Тип бизнеса из среза в памяти (без запроса в БД); новый бизнес — тип по умолчанию"""
+        latest = self._latest.get(business_id)
+        return latest[0] if latest else DEFAULT_BUSINESS_TYPE
+
+    def ensure_fresh(self):
+        """
+        Запланировать обновление в фоне, если прошел интервал (вызывать из event loop).
+        Вызывающий не ждет: чтение снимков не попадает на путь запроса, действуют текущие бенчмарки.
+        """
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        self._refresh_task = asyncio.create_task(self._refresh_in_background(), name='benchmark-refresh')
+
+    async def _refresh_in_background(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            self.stats['failed_refreshes'] += 1
+            logger.warning(f"⚠️ Не удалось обновить отраслевые бенчмарки, остаются прежние: {e}")
+        finally:
+            # И после сбоя следующая попытка — не раньше чем через интервал
+            self._refreshed_at = time.monotonic()
+
+    async def refresh(self):
+        started = time.perf_counter()
+        full = self._reloaded_at is None or time.monotonic() - self._reloaded_at >= self.full_reload
+        latest = {} if full else self._latest
+        watermark = 0 if full else self._watermark
+
+        while True:
+            rows = await self.database.get_snapshots_after(
+                watermark, ['business_id', *BENCHMARK_METRICS], limit=BENCHMARK_PAGE_SIZE
+            )
+            for row in rows:
+                if row['is_active']:
+                    latest[row['business_id']] = (
+                        row['business_type'] or DEFAULT_BUSINESS_TYPE,
+                        tuple(float(row[metric] or 0) for metric in BENCHMARK_METRICS),
+                    )
+                else:
+                    latest.pop(row['business_id'], None)
+            self.stats['rows_read'] += len(rows)
+            if rows:
+                watermark = rows[-1]['snapshot_id']
+            if len(rows) < BENCHMARK_PAGE_SIZE:
+                break
+
+        self._latest, self._watermark = latest, watermark
+        if full:
+            self._reloaded_at = time.monotonic()
+            self.stats['full_reloads'] += 1
+        self._publish(self._aggregate())
+        self.stats['refreshes'] += 1
+        self.stats['last_refresh_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    def _aggregate(self) -> Dict[str, Dict]:
+        """Бенчмарк каждого типа: цели по перцентилям собственных данных поверх статических"""
+        samples: Dict[str, List[List[float]]] = {}
+        businesses: Dict[str, int] = {}
+        for business_type, values in self._latest.values():
+            businesses[business_type] = businesses.get(business_type, 0) + 1
+            columns = samples.setdefault(business_type, [[] for _ in BENCHMARK_METRICS])
+            for column, value in zip(columns, values):
+                # 0 — метрика не рассчитана (нет выручки, инвестиций или маркетинга)
+                if value != 0 and math.isfinite(value):
+                    column.append(value)
+
+        benchmarks = {}
+        for business_type, columns in samples.items():
+            benchmark = dict(self._static.get(business_type, self._static['other']))
+            percentiles = {}
+            for metric, column in zip(BENCHMARK_METRICS, columns):
+                if len(column) < self.min_sample:
+                    continue
+                column.sort()
+                percentiles[metric] = {f"p{int(fraction * 100)}": percentile_cont(column, fraction)
+                                       for fraction in REPORT_PERCENTILES}
+                target = percentile_cont(column, BENCHMARK_TARGET_PERCENTILE)
+                # Неположительная цель обнулила бы баллы за метрику — оставляем статическую
+                if target > 0:
+                    benchmark[metric] = target
+            if percentiles:
+                benchmark['percentiles'] = percentiles
+                benchmark['sample_size'] = businesses[business_type]
+                benchmark['source'] = 'data'
+                benchmarks[business_type] = benchmark
+        return benchmarks
+
+    def _publish(self, benchmarks: Dict[str, Dict]):
+        """Передать изменившиеся бенчмарки калькулятору; пропавшие отрасли вернуть к статическим"""
+        for industry in set(self.benchmarks) - set(benchmarks):
+            self.calculator.set_industry_benchmark(industry, self._static.get(industry, self._static['other']))
+        for industry, benchmark in benchmarks.items():
+            if self.benchmarks.get(industry) != benchmark:
+                self.calculator.set_industry_benchmark(industry, benchmark)
+        self.benchmarks = benchmarks
+
+    def get_stats(self) -> Dict:
+        return {
+            'businesses': len(self._latest),
+            'watermark_snapshot_id': self._watermark,
+            'industries': {
+                industry: {
+                    'sample_size': benchmark['sample_size'],
+                    **{metric: round(benchmark[metric], 2) for metric in BENCHMARK_METRICS},
+                }
+                for industry, benchmark in self.benchmarks.items()
+            },
+            **self.stats,
+        }
+
+# Глобальный экземпляр движка бенчмарков
+benchmark_engine = BenchmarkEngine(db)
+
+if __name__ == "__main__":
+    import random
+    from metrics_calculator import MetricsCalculator
+
+    class _FakeDatabase:
+        """Снимки в памяти; get_snapshots_after ведет себя как запрос по первичному ключу"""
+
+        def __init__(self):
+            self.rows: List[Dict] = []
+            self.queries = 0
+
+        def add(self, business_id: int, business_type: str, **metrics):
+            self.rows.append({'snapshot_id': len(self.rows) + 1, 'business_id': business_id,
+                              'business_type': business_type, 'is_active': True,
+                              **{metric: metrics.get(metric, 0) for metric in BENCHMARK_METRICS}})
+
+        async def get_snapshots_after(self, after_snapshot_id, columns, limit=5000):
+            self.queries += 1
+            return [row for row in self.rows if row['snapshot_id'] > after_snapshot_id][:limit]
+
+    async def main():
+        rng = random.Random(24)
+        fake = _FakeDatabase()
+        calculator = MetricsCalculator()
+        engine = BenchmarkEngine(fake, calculator=calculator, refresh_interval=60, min_sample=30)
+        margins = [rng.uniform(1, 41) for _ in range(40)]
+        for business_id, margin in enumerate(margins, start=1):
+            fake.add(business_id, 'cafe', profit_margin=margin, roi=rng.uniform(-10, 50))
+        for business_id in range(100, 110):
+            fake.add(business_id, 'retail', profit_margin=50)
+
+        engine.ensure_fresh()
+        assert engine.industry_for(1) == DEFAULT_BUSINESS_TYPE and fake.queries == 0, "обновление выполнено на пути вызова"
+        await engine._refresh_task
+        expected = sorted(margins)[19] + (sorted(margins)[20] - sorted(margins)[19]) * 0.5
+        assert abs(calculator.industry_benchmarks['cafe']['profit_margin'] - expected) < 1e-9, "медиана посчитана неверно"
+        assert calculator.industry_benchmarks['cafe']['ltv_cac_ratio'] == 3.0, "метрика без данных не взяла статическую цель"
+        assert 'retail' not in engine.benchmarks, "отрасль с малой выборкой получила бенчмарк"
+        assert engine.industry_for(1) == 'cafe' and engine.industry_for(999) == DEFAULT_BUSINESS_TYPE
+
+        # Повторный вызов в пределах интервала не ходит в БД; обновление читает только новые снимки
+        queries = fake.queries
+        engine.ensure_fresh()
+        await asyncio.sleep(0)
+        assert fake.queries == queries, "обновление раньше интервала"
+        engine._refreshed_at = None
+        rows_read = engine.stats['rows_read']
+        fake.add(1, 'cafe', profit_margin=1000)
+        engine.ensure_fresh()
+        engine.ensure_fresh()
+        await engine._refresh_task
+        assert engine.stats['rows_read'] - rows_read == 1, "обновление перечитало старые снимки"
+
+        metrics = calculator.calculate_all_metrics({'revenue': 100, 'expenses': 80, 'clients': 10}, industry='cafe')
+        report = calculator.generate_benchmark_report(metrics, industry='cafe')
+        assert report['industry'] == 'cafe' and report['source'] == 'data' and report['comparisons'][0]['percentiles']
+        print(engine.get_stats())
+
+    asyncio.run(main())
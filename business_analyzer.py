@@ -2,6 +2,7 @@ import logging
 from typing import Dict, List, Optional
 from database import db
 from metrics_calculator import metrics_calculator
+from benchmark_engine import benchmark_engine
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +25,11 @@ class BusinessAnalyzer:
                 business_id = await db.create_business(user_id, business_name)
                 logger.info(f"🆕 Создан бизнес: {business_id}")
 
-            # 1. Расчет всех 22 метрик
+            # 1. Расчет всех 22 метрик (Health Score — по бенчмарку типа бизнеса)
             previous_data = await self._get_previous_business_data(business_id)
-            metrics = self.calculator.calculate_all_metrics(raw_data, previous_data)
+            benchmark_engine.ensure_fresh()
+            industry = benchmark_engine.industry_for(business_id)
+            metrics = self.calculator.calculate_all_metrics(raw_data, previous_data, industry=industry)
             
             # Создаем копию raw_data с рассчитанными значениями
             enriched_data = raw_data.copy()
@@ -81,18 +84,17 @@ class BusinessAnalyzer:
             return None
             
         try:
-            history = await db.get_business_history(business_id, limit=2)
-            if len(history) > 1:
-                # Возвращаем предыдущий снепшот как сырые данные
-                prev_snapshot = history[1]
+            # Новый снимок еще не записан, поэтому предыдущий для него — последний в сводке
+            rollup = await db.get_business_rollup(business_id)
+            if rollup:
                 return {
-                    'revenue': prev_snapshot.get('revenue', 0),
-                    'expenses': prev_snapshot.get('expenses', 0),
-                    'profit': prev_snapshot.get('profit', 0),
-                    'clients': prev_snapshot.get('clients', 0),
-                    'average_check': prev_snapshot.get('average_check', 0),
-                    'investments': prev_snapshot.get('investments', 0),
-                    'marketing_costs': prev_snapshot.get('marketing_costs', 0)
+                    'revenue': rollup.get('revenue', 0),
+                    'expenses': rollup.get('expenses', 0),
+                    'profit': rollup.get('profit', 0),
+                    'clients': rollup.get('clients', 0),
+                    'average_check': rollup.get('average_check', 0),
+                    'investments': rollup.get('investments', 0),
+                    'marketing_costs': rollup.get('marketing_costs', 0)
                 }
             return None
         except:
@@ -121,7 +123,7 @@ class BusinessAnalyzer:
             НЕ объединяй советы в один!
             """
             
-            response = await general_chat(prompt, user_id)
+            response = await general_chat(prompt, user_id, prompt_type='analysis')
             
             # Парсим ответ
             result = {'КОММЕНТАРИЙ': '', 'СОВЕТЫ': []}
@@ -213,16 +215,20 @@ class BusinessAnalyzer:
         Получение метрик бизнеса для веб-сайта
         """
         try:
-            history = await db.get_business_history(business_id)
+            # Агрегаты и тренд — из сводки business_rollups; из снимков — только последние два
+            # (те же, что в сводке; limit <= 2 отдает кэш-прослойка)
+            rollup = await db.get_business_rollup(business_id)
             
-            if not history:
+            if not rollup:
                 return {'error': 'Бизнес не найден'}
             
+            history = await db.get_business_history(business_id, limit=2, columns='report')
+            
             # Агрегация данных за период
-            aggregated_data = self._aggregate_period_data(history, period)
+            aggregated_data = self._aggregate_period_data(rollup, period)
             
             # Расчет трендов
-            trends = self._calculate_trends(history)
+            trends = self._calculate_trends(rollup)
             
             return {
                 'business_id': business_id,
@@ -243,14 +249,17 @@ class BusinessAnalyzer:
         """
         try:
             # Инициализируем БД если нужно
-            if db.conn is None:
+            if db.pool is None:
                 await db.init_db()
             
-            history = await db.get_business_history(business_id)
+            # Отчёт читает последний снимок, тренд к предыдущему — из сводки
+            history = await db.get_business_history(business_id, limit=1, columns='report')
             
             if not history:
                 return {'error': 'Бизнес не найден'}
             
+            rollup = await db.get_business_rollup(business_id)
+            
             current_data = history[0]
             
             # Извлекаем только рассчитанные метрики из БД
@@ -271,7 +280,10 @@ class BusinessAnalyzer:
             )
             
             # Benchmark report
-            benchmark_report = self.calculator.generate_benchmark_report(metrics)
+            benchmark_engine.ensure_fresh()
+            benchmark_report = self.calculator.generate_benchmark_report(
+                metrics, industry=benchmark_engine.industry_for(business_id)
+            )
             
             # Рекомендации из БД
             recommendations = []
@@ -292,33 +304,37 @@ class BusinessAnalyzer:
                 'detailed_metrics': metrics,  # Рассчитанные метрики
                 'raw_data': current_data,  # Сырые данные из БД
                 'recommendations': recommendations,
-                'trends': self._calculate_trends(history)
+                'benchmark_report': benchmark_report,
+                'trends': self._calculate_trends(rollup)
             }
             
         except Exception as e:
             logger.error(f"❌ Ошибка генерации отчета: {e}")
             return {'error': str(e)}
     
-    def _aggregate_period_data(self, history: List[Dict], period: str) -> Dict:
-        """Агрегация данных за период"""
-        if not history:
+    def _aggregate_period_data(self, rollup: Optional[Dict], period: str) -> Dict:
+        """Агрегация данных за период: средние по накопленным суммам сводки (все снимки)"""
+        if not rollup or not rollup.get('snapshot_count'):
             return {}
         
-        # Простая агрегация - можно улучшить
+        count = rollup['snapshot_count']
         return {
-            'avg_revenue': sum(h.get('revenue', 0) for h in history) / len(history),
-            'avg_profit': sum(h.get('profit', 0) for h in history) / len(history),
-            'avg_health_score': sum(h.get('overall_health_score', 0) for h in history) / len(history),
-            'period_count': len(history)
+            'avg_revenue': (rollup.get('revenue_sum') or 0) / count,
+            'avg_profit': (rollup.get('profit_sum') or 0) / count,
+            'avg_health_score': (rollup.get('health_score_sum') or 0) / count,
+            'period_count': count
         }
     
-    def _calculate_trends(self, history: List[Dict]) -> Dict:
-        """Расчет трендов на основе истории"""
-        if len(history) < 2:
+    def _calculate_trends(self, rollup: Optional[Dict]) -> Dict:
+        """Расчет трендов: последний снимок сводки против предыдущего"""
+        if not rollup or rollup.get('prev_snapshot_id') is None:
             return {'trend': 'stable', 'change': 0}
         
-        current = history[0]
-        previous = history[1]
+        current = rollup
+        previous = {
+            'revenue': rollup.get('prev_revenue') or 0,
+            'overall_health_score': rollup.get('prev_overall_health_score') or 0
+        }
         
         revenue_change = 0
         if previous.get('revenue', 0) > 0:
@@ -1,5 +1,9 @@
 import asyncio
-from typing import Dict, List, Optional
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set
 from database import db
 from business_analyzer import business_analyzer
 from ai import extract_business_data, analyze_missing_data
@@ -8,6 +12,28 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Отложенные записи в БД держим здесь, чтобы задачи не собрал GC, если сессию уже закрыли
+_background_writes: Set[asyncio.Task] = set()
+
+class TurnTimings:
+    """Замер этапов одного хода диалога (показывает критический путь)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    async def measure(self, stage: str, awaitable: Awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.stages[stage] = (time.perf_counter() - started) * 1000
+
+    def summary(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        stages = ", ".join(f"{name} {ms:.0f} мс" for name, ms in self.stages.items())
+        return f"{stages}; всего {total:.0f} мс"
+
 class BusinessConversation:
     """
     Умный диалоговый менеджер для сбора данных о бизнесе в свободной форме
@@ -31,6 +57,9 @@ class BusinessConversation:
         self.collected_data = {}
         self.business_id = None
         self.user_id = None
+        # Последняя отложенная запись: следующие ждут её, поэтому порядок записей сохраняется
+        self._last_write: Optional[asyncio.Task] = None
+        self.last_turn_timings: Dict[str, float] = {}
     
     async def get_conversation(self, user_id: str) -> 'BusinessConversation':
         """Получение или создание сессии для пользователя"""
@@ -74,8 +103,8 @@ class BusinessConversation:
         Обработка сообщения пользователя
         Возвращает: {'response': str, 'next_action': str, 'is_complete': bool}
         """
-        # Сохраняем ответ пользователя в контексте текущего состояния
-        await self._save_user_response(user_message)
+        # Сохраняем ответ пользователя в контексте текущего состояния (вне пути ответа)
+        self._save_user_response(user_message)
         
         # Универсальная отмена без сохранения/анализа
         cancel_words = ['выйти', 'выход', 'отмена', 'cancel', 'exit', 'quit']
@@ -132,8 +161,18 @@ class BusinessConversation:
             if user_message.strip().lower() in ['да', 'yes', 'готово', 'готов'] and self._has_required_data():
                 return await self._handle_analysis('да')
 
-            # Извлекаем данные из текста с помощью AI (включая business_name)
-            extracted_data = await extract_business_data(user_message)
+            timings = TurnTimings()
+
+            # Название при редактировании может понадобиться из businesses — запрашиваем параллельно с извлечением
+            # (список бизнесов пользователя обычно уже в кэше CachedDatabase)
+            businesses_task = None
+            if self.business_id and self.user_id and not str(self.collected_data.get('business_name') or '').strip():
+                businesses_task = asyncio.ensure_future(
+                    timings.measure('businesses', db.get_user_businesses(self.user_id))
+                )
+
+            # Извлекаем данные из текста (правила + AI, включая business_name)
+            extracted_data = await timings.measure('extract', extract_business_data(user_message))
             logger.info(f"🔍 Извлечено данных: {extracted_data}")
 
             # Объединяем с уже собранными данными: мердж только "значимых" значений
@@ -154,11 +193,14 @@ class BusinessConversation:
             # Отрасль больше не используется
 
             # Если мы в режиме РЕДАКТИРОВАНИЯ (есть business_id) и название пустое — подтянем его из БД
-            if (not self.collected_data.get('business_name') or str(self.collected_data.get('business_name', '')).strip() == '') and self.business_id:
+            if businesses_task is not None:
                 try:
-                    history = await db.get_business_history(self.business_id, limit=1)
-                    if history and history[0].get('business_name'):
-                        self.collected_data['business_name'] = history[0]['business_name']
+                    businesses = await businesses_task
+                    if not str(self.collected_data.get('business_name') or '').strip():
+                        for business in businesses or []:
+                            if business['business_id'] == self.business_id and business.get('business_name'):
+                                self.collected_data['business_name'] = business['business_name']
+                                break
                 except Exception:
                     pass
 
@@ -186,21 +228,29 @@ class BusinessConversation:
             
             # Если собраны все обязательные поля, переходим к сбору дополнительных
             if required_fields_count == len(self.REQUIRED_FIELDS):
-                logger.info("🧠 Запрос недостающих данных у AI (полный набор полей)")
-                missing_questions_text = await analyze_missing_data(self.collected_data) # Отдаем AI полные данные
-                logger.info(f"🧠 Ответ AI по недостающим данным: {missing_questions_text[:20]}")
+                logger.info("🧠 Планирование недостающих данных (полный набор полей)")
+                missing_questions_text = await timings.measure('plan', analyze_missing_data(self.collected_data)) # Отдаем планировщику полные данные
+                logger.info(f"🧠 Следующий вопрос по недостающим данным: {missing_questions_text[:20]}")
             else:
-                # Если не хватает обязательных, то AI должен сфокусироваться только на них
-                # Создаем временный словарь, чтобы AI не видел дополнительные, пока не соберет основные
+                # Если не хватает обязательных, то спрашиваем только о них
+                # Создаем временный словарь, чтобы планировщик не видел дополнительные, пока не соберет основные
                 temp_collected_data = {k: v for k, v in self.collected_data.items() if k in self.REQUIRED_FIELDS}
-                logger.info("🧠 Запрос недостающих данных у AI (только обязательные)")
-                missing_questions_text = await analyze_missing_data(temp_collected_data)
-                logger.info(f"🧠 Ответ AI по недостающим данным: {missing_questions_text[:20]}")
+                logger.info("🧠 Планирование недостающих данных (только обязательные)")
+                missing_questions_text = await timings.measure('plan', analyze_missing_data(temp_collected_data))
+                logger.info(f"🧠 Следующий вопрос по недостающим данным: {missing_questions_text[:20]}")
+
 
+            enough_data = missing_questions_text.strip().upper() == "ENOUGH_DATA"
 
-            if missing_questions_text.strip().upper() == "ENOUGH_DATA":
-                await self._update_state(self.STATES['READY_FOR_ANALYSIS'])
+            # Состояние и собранные данные пишем в БД вне пути ответа
+            await self._update_state(
+                self.STATES['READY_FOR_ANALYSIS'] if enough_data else self.STATES['COLLECTING_DATA'],
+                defer=True
+            )
+            self.last_turn_timings = dict(timings.stages)
+            logger.info(f"⏱ Ход сбора данных: {timings.summary()}")
 
+            if enough_data:
                 summary = self._get_data_summary()
                 return {
                     'response': f"✅ Отлично! У меня есть все необходимые данные для анализа.\n\n"
@@ -389,47 +439,282 @@ class BusinessConversation:
         
         return response
     
-    async def _save_user_response(self, response: str):
-        """Сохранение ответа пользователя"""
-        try:
-            await db.log_message(
-                session_id=self.session_id,
-                user_message=response,
-                bot_response='',
-                message_type='user_input'
-            )
-        except Exception:
-            # Логирование умышленно молчит, чтобы не ломать диалог
+    def _defer_write(self, write: Callable[[], Awaitable]) -> asyncio.Task:
+        """Запись в БД вне пути ответа; записи одной сессии выполняются строго по очереди"""
+        previous = self._last_write
+
+        async def run():
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            try:
+                await write()
+            except Exception as e:
+                logger.warning(f"Отложенная запись сессии {self.session_id} не удалась: {e}")
+
+        task = asyncio.create_task(run())
+        self._last_write = task
+        _background_writes.add(task)
+        task.add_done_callback(_background_writes.discard)
+        return task
+
+    async def flush_writes(self):
+        """Дождаться всех отложенных записей сессии"""
+        if self._last_write is not None:
+            await asyncio.gather(self._last_write, return_exceptions=True)
+
+    def _save_user_response(self, response: str):
+        """Сохранение ответа пользователя (отложенное)"""
+        if not self.user_id:
             return
+
+        async def write():
+            try:
+                await db.log_message(
+                    user_id=self.user_id,
+                    session_id=self.session_id,
+                    user_message=response,
+                    bot_response='',
+                    message_type='user_input'
+                )
+            except Exception:
+                # Логирование умышленно молчит, чтобы не ломать диалог
+                return
+
+        self._defer_write(write)
     
-    async def _update_state(self, new_state: str):
-        """Обновление состояния сессии"""
+    async def _update_state(self, new_state: str, defer: bool = False):
+        """Обновление состояния сессии (defer=True — запись в БД вне пути ответа)"""
         self.current_state = new_state
-        if self.session_id:
-            await db.update_session_state(
-                self.session_id, 
-                new_state, 
-                self.collected_data
-            )
+        if not self.session_id:
+            return
+        # Снимок данных на момент смены состояния: словарь продолжит меняться в следующих ходах
+        collected_data = dict(self.collected_data)
+
+        if defer:
+            self._defer_write(lambda: db.update_session_state(self.session_id, new_state, collected_data))
+            return
+
+        await self.flush_writes()
+        await db.update_session_state(
+            self.session_id, 
+            new_state, 
+            collected_data
+        )
 
 # Глобальный менеджер сессий
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+SESSION_MAX_RESIDENT = int(os.getenv("SESSION_MAX_RESIDENT", "5000"))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+SESSION_RESUME_WINDOW = int(os.getenv("SESSION_RESUME_WINDOW", str(7 * 24 * 3600)))
+
+# Состояния, в которых брошенный диалог можно продолжить после вытеснения или рестарта
+RESUMABLE_STATES = {
+    BusinessConversation.STATES['START'],
+    BusinessConversation.STATES['AWAITING_BUSINESS_NAME'],
+    BusinessConversation.STATES['COLLECTING_DATA'],
+    BusinessConversation.STATES['READY_FOR_ANALYSIS'],
+}
+
 class ConversationManager:
-    def __init__(self):
-        self.active_sessions = {}  # user_id -> BusinessConversation
-    
+    """
+    Реестр диалоговых сессий в памяти.
+    Сессия, простаивающая дольше SESSION_IDLE_TIMEOUT, и самые старые сессии сверх
+    SESSION_MAX_RESIDENT вытесняются; её состояние уже лежит в conversation_sessions,
+    поэтому при следующем сообщении пользователя find_conversation поднимает её из БД.
+    """
+
+    def __init__(self, idle_timeout: int = None, max_resident: int = None):
+        self.idle_timeout = idle_timeout or SESSION_IDLE_TIMEOUT
+        self.max_resident = max_resident or SESSION_MAX_RESIDENT
+
+        # user_id -> BusinessConversation в порядке последней активности (LRU)
+        self.active_sessions: "OrderedDict[str, BusinessConversation]" = OrderedDict()
+        self._last_seen: Dict[str, float] = {}
+        # Вытесненные сессии: user_id -> (session_id, последняя отложенная запись)
+        self._evicted: "OrderedDict[str, tuple]" = OrderedDict()
+        # Пользователи, для которых уже выяснено, что продолжать нечего (без запроса в БД)
+        self._no_session: "OrderedDict[str, float]" = OrderedDict()
+        # user_id -> момент /new_business: следующее сообщение — данные о бизнесе
+        self._awaiting_data: Dict[str, float] = {}
+
+        self._sweeper: Optional[asyncio.Task] = None
+        self.stats = {
+            'created': 0,
+            'resumed': 0,
+            'evicted_idle': 0,
+            'evicted_lru': 0,
+            'ended': 0,
+            'awaiting_expired': 0,
+        }
+
+    def _touch(self, user_id: str):
+        self.active_sessions.move_to_end(user_id)
+        self._last_seen[user_id] = time.monotonic()
+
+    def _register(self, user_id: str, conversation: 'BusinessConversation'):
+        self.active_sessions[user_id] = conversation
+        self._evicted.pop(user_id, None)
+        self._no_session.pop(user_id, None)
+        self._touch(user_id)
+        self._ensure_sweeper()
+        while len(self.active_sessions) > self.max_resident:
+            oldest = next(iter(self.active_sessions))
+            self._evict(oldest)
+            self.stats['evicted_lru'] += 1
+
+    def _evict(self, user_id: str):
+        """Выгрузка сессии из памяти; отложенные записи продолжают выполняться в фоне"""
+        conversation = self.active_sessions.pop(user_id)
+        self._last_seen.pop(user_id, None)
+        if conversation.session_id and conversation.current_state in RESUMABLE_STATES:
+            self._evicted[user_id] = (conversation.session_id, conversation._last_write)
+            while len(self._evicted) > self.max_resident * 10:
+                self._evicted.popitem(last=False)
+
+    def _remember_no_session(self, user_id: str):
+        self._no_session[user_id] = time.monotonic()
+        self._no_session.move_to_end(user_id)
+        while len(self._no_session) > self.max_resident * 10:
+            self._no_session.popitem(last=False)
+
     async def get_conversation(self, user_id: str) -> 'BusinessConversation':
         """Получение или создание сессии для пользователя"""
-        if user_id not in self.active_sessions:
-            conversation = BusinessConversation()
-            await conversation.initialize(user_id)
-            self.active_sessions[user_id] = conversation
-        
-        return self.active_sessions[user_id]
+        conversation = self.active_sessions.get(user_id)
+        if conversation is not None:
+            self._touch(user_id)
+            return conversation
+
+        conversation = BusinessConversation()
+        await conversation.initialize(user_id)
+        self._register(user_id, conversation)
+        self.stats['created'] += 1
+        return conversation
+
+    async def find_conversation(self, user_id: str) -> Optional['BusinessConversation']:
+        """Активная сессия пользователя: из памяти, а если её вытеснили — из БД"""
+        conversation = self.active_sessions.get(user_id)
+        if conversation is not None:
+            self._touch(user_id)
+            return conversation
+
+        if user_id in self._no_session:
+            return None
+
+        evicted = self._evicted.get(user_id)
+        if evicted is not None:
+            session_id, last_write = evicted
+            # Состояние в БД должно включать последние отложенные записи сессии
+            if last_write is not None:
+                await asyncio.gather(last_write, return_exceptions=True)
+        else:
+            session_id = None
+            try:
+                latest = await db.get_latest_conversation_session(user_id)
+            except Exception as e:
+                logger.warning(f"Не удалось найти сессию пользователя {user_id}: {e}")
+                return None
+            if latest and latest['current_state'] in RESUMABLE_STATES and self._is_recent(latest.get('updated_at')):
+                session_id = latest['session_id']
+
+        # Пока шёл запрос, сессию мог создать параллельный обработчик
+        if user_id in self.active_sessions:
+            return self.active_sessions[user_id]
+
+        conversation = BusinessConversation()
+        if session_id is None or not await conversation.load_session(session_id) \
+                or conversation.current_state not in RESUMABLE_STATES:
+            self._evicted.pop(user_id, None)
+            self._remember_no_session(user_id)
+            return None
+
+        self._register(user_id, conversation)
+        self.stats['resumed'] += 1
+        logger.info(f"♻️ Сессия {session_id} пользователя {user_id} поднята из БД")
+        return conversation
+
+    @staticmethod
+    def _is_recent(updated_at) -> bool:
+        if updated_at is None:
+            return True
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - updated_at).total_seconds() <= SESSION_RESUME_WINDOW
     
     def end_conversation(self, user_id: str):
         """Завершение сессии"""
-        if user_id in self.active_sessions:
-            del self.active_sessions[user_id]
+        conversation = self.active_sessions.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+        self._evicted.pop(user_id, None)
+        self._remember_no_session(user_id)
+        if conversation is None:
+            return
+        self.stats['ended'] += 1
+        # Незавершённая в БД сессия иначе поднялась бы при следующем сообщении
+        if conversation.session_id and conversation.current_state in RESUMABLE_STATES:
+            conversation.current_state = conversation.STATES['COMPLETED']
+            session_id, collected_data = conversation.session_id, dict(conversation.collected_data)
+            conversation._defer_write(lambda: db.update_session_state(
+                session_id, conversation.STATES['COMPLETED'], collected_data
+            ))
+
+    def mark_awaiting_data(self, user_id: str):
+        """Следующее сообщение пользователя — данные для нового бизнеса"""
+        self._awaiting_data[user_id] = time.monotonic()
+        self._ensure_sweeper()
+
+    def pop_awaiting_data(self, user_id: str) -> bool:
+        """Снять флаг ожидания данных; False — флага нет или он просрочен"""
+        marked_at = self._awaiting_data.pop(user_id, None)
+        return marked_at is not None and time.monotonic() - marked_at <= self.idle_timeout
+
+    def sweep(self) -> int:
+        """Вытеснение простаивающих сессий и просроченных флагов ожидания данных"""
+        now = time.monotonic()
+        expire_before = now - self.idle_timeout
+        evicted = 0
+        # active_sessions упорядочен по активности: простаивающие — в голове
+        while self.active_sessions:
+            user_id = next(iter(self.active_sessions))
+            if self._last_seen.get(user_id, now) >= expire_before:
+                break
+            self._evict(user_id)
+            self.stats['evicted_idle'] += 1
+            evicted += 1
+
+        for user_id in [u for u, marked_at in self._awaiting_data.items() if marked_at < expire_before]:
+            del self._awaiting_data[user_id]
+            self.stats['awaiting_expired'] += 1
+
+        # Отрицательный кэш устаревает: сессию мог начать другой инстанс бота
+        while self._no_session and next(iter(self._no_session.values())) < expire_before:
+            self._no_session.popitem(last=False)
+        return evicted
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            try:
+                evicted = self.sweep()
+                if evicted:
+                    logger.info(f"🧹 Вытеснено простаивающих сессий: {evicted}, в памяти: {len(self.active_sessions)}")
+            except Exception as e:
+                logger.warning(f"Ошибка очистки сессий: {e}")
+
+    def _ensure_sweeper(self):
+        """Фоновая очистка запускается на цикле событий при первой сессии"""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    def get_stats(self) -> Dict:
+        """Метрики реестра сессий"""
+        return {
+            'resident_sessions': len(self.active_sessions),
+            'evicted_resumable': len(self._evicted),
+            'awaiting_data': len(self._awaiting_data),
+            'idle_timeout_seconds': self.idle_timeout,
+            'max_resident': self.max_resident,
+            **self.stats,
+        }
 
 # Глобальный экземпляр менеджера
-conv_manager = ConversationManager()
\ No newline at end of file
+conv_manager = ConversationManager()
@@ -0,0 +1,210 @@
+"""
+Локальное извлечение бизнес-данных — быстрый путь перед extract_business_data.
+
+Сообщения вида "выручка 500к, расходы 300к, клиентов 1000" разбираются правилами:
+текст режется на фрагменты, в каждом ищутся ключевые слова полей
+BUSINESS_DATA_EXTRACTION_PROMPT и числа с русскими суффиксами (к, тыс, млн, млрд).
+Если остались числа без поля или поля без числа — сообщение отдаётся LLM,
+а его ответ дополняет локальный результат.
+"""
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Поля в порядке формата BUSINESS_DATA_EXTRACTION_PROMPT
+EXTRACTION_FIELDS = [
+    'business_name', 'revenue', 'expenses', 'clients', 'investments', 'marketing_costs',
+    'employees', 'monthly_costs', 'new_clients_per_month', 'customer_retention_rate',
+]
+
+# Основы ключевых слов числовых полей
+FIELD_KEYWORDS = {
+    'revenue': ['выручк', 'доход', 'оборот', 'зарабатыва', 'продаж на'],
+    'expenses': ['расход', 'затрат', 'трач', 'издержк'],
+    'monthly_costs': ['аренд', 'зарплат', 'коммунал', 'постоянн', 'ежемесячн'],
+    'clients': ['клиент', 'покупател', 'посетител', 'гост'],
+    'new_clients_per_month': ['новых клиент', 'новых покупател', 'новых посетител', 'привлека'],
+    'investments': ['инвестиц', 'вложил', 'вложени', 'вложено', 'стартов'],
+    'marketing_costs': ['маркетинг', 'реклам', 'продвижени'],
+    'employees': ['сотрудник', 'работник', 'персонал', 'штат'],
+    'customer_retention_rate': ['удержани', 'возвращ', 'повторн', 'retention'],
+}
+
+# Более узкое поле вытесняет общее, если оба упомянуты в одном фрагменте
+_OVERRIDES = {
+    'new_clients_per_month': 'clients',
+    'marketing_costs': 'expenses',
+}
+
+# Поля, которые могут получить одно и то же число ("расходы на аренду и зарплаты 300к")
+_SHARED_VALUE_FIELDS = {'expenses', 'monthly_costs'}
+
+# Числа рядом с этими словами не относятся ни к одному полю — LLM для них не нужен
+IGNORED_KEYWORDS = ['чек', 'цен', 'стоимост', 'лет', 'год', 'час', 'минут', 'штук', 'шт']
+
+_SCALES = [
+    (re.compile(r'^(?:млрд|миллиард)'), 1_000_000_000),
+    (re.compile(r'^(?:млн|миллион|лям)'), 1_000_000),
+    (re.compile(r'^(?:к|k|тыс|тысяч|т\.?р)'), 1_000),
+]
+
+_NUMBER_RE = re.compile(
+    r'(?<![\w.])(\d{1,3}(?:[  ]\d{3})+|\d+)(?:[.,](\d+))?'
+    r'\s*(%|процент\w*|млрд\w*|миллиард\w*|млн\w*|миллион\w*|лям\w*|тыс\w*|т\.?р\.?|к(?![а-я])|k(?![a-z]))?',
+    re.IGNORECASE
+)
+
+# Фрагменты: точка/запятая с пробелом (1.5 и 1,5 остаются числами), точка с запятой, перевод строки
+_CLAUSE_SPLIT_RE = re.compile(r'[;\n]|[,.!?]\s+')
+
+_BUSINESS_NAME_PATTERNS = [
+    re.compile(r'(?:называется|название(?:\s+бизнеса)?\s*[:\-—]?)\s*[«"]?([^«»",.;\n]{2,60})', re.IGNORECASE),
+    re.compile(r'(?:^|\s)у (?:меня|нас)\s+(?:есть\s+)?([а-яёa-z][^,.;\n\d]{1,50}?)(?=[,.;\n]|\s+(?:с|в|на)\s+выручк|$)', re.IGNORECASE),
+    re.compile(r'(?:мой|наш)\s+бизнес\s*[:\-—]?\s*([^,.;\n\d]{2,50})', re.IGNORECASE),
+]
+
+stats = {
+    'messages': 0,
+    'local_only': 0,
+    'llm_fallbacks': 0,
+    'local_ms_total': 0.0,
+}
+
+def parse_number(match: re.Match) -> float:
+    """Число из совпадения _NUMBER_RE с учётом суффикса масштаба"""
+    integer = re.sub(r'[  ]', '', match.group(1))
+    fraction = match.group(2)
+    value = float(f"{integer}.{fraction}") if fraction else float(integer)
+    suffix = (match.group(3) or '').lower()
+    for pattern, scale in _SCALES:
+        if pattern.match(suffix):
+            value *= scale
+            break
+    return value
+
+def _as_number(value: float):
+    return int(value) if float(value).is_integer() else round(value, 2)
+
+def _clause_fields(clause: str) -> List[str]:
+    """Поля, упомянутые во фрагменте, в порядке первого упоминания"""
+    positions = {}
+    for field, stems in FIELD_KEYWORDS.items():
+        found = [clause.find(stem) for stem in stems if stem in clause]
+        if found:
+            positions[field] = min(found)
+    for narrow, general in _OVERRIDES.items():
+        if narrow in positions and general in positions:
+            del positions[general]
+    return sorted(positions, key=positions.get)
+
+def extract_business_name(text: str) -> Optional[str]:
+    """Название бизнеса по явным оборотам: "у меня кофейня", "называется «Ромашка»", "мой бизнес — ..." """
+    for pattern in _BUSINESS_NAME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            name = match.group(1).strip(' «»"\'-—')
+            if name and not any(stem in name.lower() for stems in FIELD_KEYWORDS.values() for stem in stems):
+                return name
+    return None
+
+def extract_local(text: str) -> Tuple[Dict, bool]:
+    """
+    Локальный разбор сообщения.
+    Возвращает (поля, resolved): resolved=False — в тексте осталось то, что правила
+    не смогли однозначно разнести по полям, и нужен LLM.
+    """
+    started = time.perf_counter()
+    data: Dict = {}
+    resolved = True
+    free_text = False  # фрагмент без чисел и полей: вероятно, название или описание бизнеса
+    text_lower = text.lower().replace('ё', 'е')
+
+    for clause in _CLAUSE_SPLIT_RE.split(text_lower):
+        clause = clause.strip()
+        if not clause:
+            continue
+        numbers = list(_NUMBER_RE.finditer(clause))
+        fields = _clause_fields(clause)
+
+        if not numbers:
+            # Поле упомянуто словами ("клиентов около тысячи") — разбирать должен LLM
+            if fields:
+                resolved = False
+            elif re.search(r'[а-яa-z]', clause):
+                free_text = True
+            continue
+
+        if not fields:
+            if not any(stem in clause for stem in IGNORED_KEYWORDS):
+                resolved = False
+            continue
+
+        if len(numbers) == 1 and (len(fields) == 1 or set(fields) <= _SHARED_VALUE_FIELDS):
+            pairs = [(field, numbers[0]) for field in fields]
+        elif len(numbers) == len(fields):
+            # "выручка 500к и расходы 300к", "500к выручки и 300к расходов" — поля и числа идут в одном порядке
+            pairs = list(zip(fields, numbers))
+        else:
+            resolved = False
+            continue
+
+        for field, match in pairs:
+            value = parse_number(match)
+            is_percent = (match.group(3) or '').startswith(('%', 'процент'))
+            if field == 'customer_retention_rate':
+                # Удержание — проценты; доля 0.7 тоже означает 70%
+                value_pct = value * 100 if not is_percent and value <= 1 else value
+                data[field] = _as_number(value_pct)
+            elif is_percent:
+                resolved = False
+            else:
+                data[field] = _as_number(value)
+
+    name = extract_business_name(text)
+    if name:
+        data['business_name'] = name
+    elif free_text or not data:
+        # Текст без чисел и полей, а название не найдено ("Кофейня «Бодрость»") — решает LLM
+        resolved = False
+
+    stats['local_ms_total'] += (time.perf_counter() - started) * 1000
+    return data, resolved
+
+def empty_result() -> Dict:
+    return {field: None for field in EXTRACTION_FIELDS}
+
+def get_stats() -> Dict:
+    """Доля сообщений, разобранных без LLM"""
+    messages = stats['messages']
+    return {
+        'messages': messages,
+        'local_only': stats['local_only'],
+        'llm_fallbacks': stats['llm_fallbacks'],
+        'local_rate': round(stats['local_only'] / messages, 3) if messages else 0,
+        'avg_local_ms': round(stats['local_ms_total'] / messages, 3) if messages else 0,
+    }
+
+if __name__ == "__main__":
+    samples = [
+        ("выручка 500к, расходы 300к, клиентов 1000", True),
+        ("У меня кофейня, выручка 1,5 млн в месяц, расходы на аренду и зарплаты 300 тыс", True),
+        ("трачу на рекламу 50 000 руб, 12 сотрудников, удержание 70%", True),
+        ("новых клиентов 150 в месяц, средний чек 500", True),
+        ("вложил 2 млн на старте", True),
+        ("выручка 800к и расходы 500к", True),
+        ("клиентов примерно пара сотен", False),
+        ("Кофейня на углу", False),
+        ("Кофейня «Бодрость», выручка 500к, расходы 300к, клиентов 1000", False),
+        ("Кафе Ромашка. Выручка 500к, расходы 300к", False),
+        ("продаю 300 чашек кофе и 120 десертов", False),
+    ]
+    for text, expected in samples:
+        data, resolved = extract_local(text)
+        mark = '✅' if resolved == expected else '⚠️'
+        print(f"{mark} {text!r} -> {data} ({'локально' if resolved else 'LLM'})")
+
+    iterations = 10000
+    started = time.perf_counter()
+    for i in range(iterations):
+        extract_local(samples[i % len(samples)][0])
+    print(f"⏱ {(time.perf_counter() - started) / iterations * 1e6:.0f} мкс на сообщение")
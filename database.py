@@ -4,13 +4,17 @@ from datetime import datetime, timezone, timedelta
 from typing import Dict, List, Optional
 import logging
 import os
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from env_utils import is_production, get_database_config, should_create_files
+from message_log import RecentMessagesRing
 
 try:
     import psycopg2
     from psycopg2.extras import RealDictCursor, execute_values
+    from psycopg2.pool import ThreadedConnectionPool
 except ImportError:
     print("❌ Требуется пакет: pip install psycopg2-binary")
     raise
@@ -22,12 +26,411 @@ if not is_production():
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor(max_workers=4)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+# Соединение, простаивавшее дольше этого времени, проверяется SELECT 1 перед выдачей
+DB_POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "30"))
+
+executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS)
+
+# Журнал сообщений пишется пачками в фоне (message_log.MessageLogBuffer); 0 — INSERT на каждое сообщение
+MESSAGE_LOG_BUFFERED = os.getenv("MESSAGE_LOG_BUFFERED", "1").lower() in ("1", "true", "yes")
+
+# Схема БД: выполняется по порядку в create_tables (все операторы идемпотентны)
+SCHEMA_STATEMENTS = [
+    # Таблица пользователей
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Новая таблица бизнесов
+    '''
+    CREATE TABLE IF NOT EXISTS businesses (
+        business_id SERIAL PRIMARY KEY,
+        user_id TEXT,
+        business_name TEXT,
+        business_type TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        is_active BOOLEAN DEFAULT TRUE,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )
+    ''',
+    # Основная таблица снимков бизнеса
+    '''
+    CREATE TABLE IF NOT EXISTS business_snapshots (
+        snapshot_id SERIAL PRIMARY KEY,
+        business_id INTEGER,
+        period_type TEXT,
+        period_date DATE,
+        
+        -- Сырые данные от пользователя
+        revenue DOUBLE PRECISION DEFAULT 0,
+        expenses DOUBLE PRECISION DEFAULT 0,
+        profit DOUBLE PRECISION DEFAULT 0,
+        clients INTEGER DEFAULT 0,
+        average_check DOUBLE PRECISION DEFAULT 0,
+        investments DOUBLE PRECISION DEFAULT 0,
+        marketing_costs DOUBLE PRECISION DEFAULT 0,
+        employees INTEGER DEFAULT 0,
+        new_clients_per_month INTEGER DEFAULT 0,
+        customer_retention_rate DOUBLE PRECISION DEFAULT 0,
+        
+        -- Рассчитанные метрики (22 штуки)
+        profit_margin DOUBLE PRECISION DEFAULT 0,
+        break_even_clients DOUBLE PRECISION DEFAULT 0,
+        safety_margin DOUBLE PRECISION DEFAULT 0,
+        roi DOUBLE PRECISION DEFAULT 0,
+        profitability_index DOUBLE PRECISION DEFAULT 0,
+        ltv DOUBLE PRECISION DEFAULT 0,
+        cac DOUBLE PRECISION DEFAULT 0,
+        ltv_cac_ratio DOUBLE PRECISION DEFAULT 0,
+        customer_profit_margin DOUBLE PRECISION DEFAULT 0,
+        sgr DOUBLE PRECISION DEFAULT 0,
+        revenue_growth_rate DOUBLE PRECISION DEFAULT 0,
+        asset_turnover DOUBLE PRECISION DEFAULT 0,
+        roe DOUBLE PRECISION DEFAULT 0,
+        months_to_bankruptcy DOUBLE PRECISION DEFAULT 0,
+        
+        -- Health Score
+        financial_health_score INTEGER DEFAULT 0,
+        growth_health_score INTEGER DEFAULT 0,
+        efficiency_health_score INTEGER DEFAULT 0,
+        overall_health_score INTEGER DEFAULT 0,
+        
+        -- AI советы и комментарий
+        advice1 TEXT DEFAULT '',
+        advice2 TEXT DEFAULT '',
+        advice3 TEXT DEFAULT '',
+        advice4 TEXT DEFAULT '',
+        ai_commentary TEXT DEFAULT '',
+        
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (business_id) REFERENCES businesses(business_id)
+    )
+    ''',
+    # Сессии диалогов для умного сбора данных
+    '''
+    CREATE TABLE IF NOT EXISTS conversation_sessions (
+        session_id SERIAL PRIMARY KEY,
+        user_id TEXT,
+        business_id INTEGER,
+        current_state TEXT,
+        collected_data TEXT, -- JSON
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (business_id) REFERENCES businesses(business_id)
+    )
+    ''',
+    # Сообщения (логи чата)
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        session_id INTEGER,
+        user_message TEXT,
+        bot_response TEXT,
+        message_type TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES conversation_sessions(session_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        cache_key TEXT PRIMARY KEY,
+        prompt_type TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    ''',
+]
+
+# Сводка бизнеса (business_rollups): последний и предыдущий снимок и суммы по всем снимкам.
+# Обновляется тем же запросом, что добавляет снимок, поэтому рост, изменения KPI и тренд
+# читаются одной строкой по первичному ключу, без истории.
+ROLLUP_LAST_COLUMNS = ['revenue', 'expenses', 'profit', 'clients', 'average_check', 'investments',
+                       'marketing_costs', 'overall_health_score']
+ROLLUP_PREVIOUS_COLUMNS = ['revenue', 'expenses', 'profit', 'clients', 'overall_health_score']
+# Накопленные суммы: колонка сводки -> колонка снимка
+ROLLUP_SUM_COLUMNS = {'revenue_sum': 'revenue', 'profit_sum': 'profit', 'health_score_sum': 'overall_health_score'}
+
+BUSINESS_ROLLUPS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS business_rollups (
+        business_id INTEGER PRIMARY KEY,
+        
+        -- Последний снимок
+        last_snapshot_id INTEGER NOT NULL,
+        last_created_at TIMESTAMP WITH TIME ZONE,
+        revenue DOUBLE PRECISION DEFAULT 0,
+        expenses DOUBLE PRECISION DEFAULT 0,
+        profit DOUBLE PRECISION DEFAULT 0,
+        clients INTEGER DEFAULT 0,
+        average_check DOUBLE PRECISION DEFAULT 0,
+        investments DOUBLE PRECISION DEFAULT 0,
+        marketing_costs DOUBLE PRECISION DEFAULT 0,
+        overall_health_score INTEGER DEFAULT 0,
+        
+        -- Предыдущий снимок (NULL, пока снимок один)
+        prev_snapshot_id INTEGER,
+        prev_revenue DOUBLE PRECISION,
+        prev_expenses DOUBLE PRECISION,
+        prev_profit DOUBLE PRECISION,
+        prev_clients INTEGER,
+        prev_overall_health_score INTEGER,
+        
+        -- Суммы по всем снимкам бизнеса
+        snapshot_count INTEGER NOT NULL DEFAULT 0,
+        revenue_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        profit_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        health_score_sum BIGINT NOT NULL DEFAULT 0,
+        
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (business_id) REFERENCES businesses(business_id)
+    )
+'''
+
+_ROLLUP_PREVIOUS = [f'prev_{column}' for column in ROLLUP_PREVIOUS_COLUMNS]
+
+# Добавление снимка вместе со сдвигом сводки: прежний последний снимок становится предыдущим.
+# Параллельные снимки одного бизнеса упорядочиваются блокировкой строки сводки в ON CONFLICT.
+_ROLLUP_UPSERT = f'''
+    INSERT INTO business_rollups (
+        business_id, last_snapshot_id, last_created_at, {', '.join(ROLLUP_LAST_COLUMNS)},
+        snapshot_count, {', '.join(ROLLUP_SUM_COLUMNS)}
+    )
+    SELECT business_id, snapshot_id, created_at, {', '.join(ROLLUP_LAST_COLUMNS)},
+           1, {', '.join(ROLLUP_SUM_COLUMNS.values())}
+    FROM inserted
+    ON CONFLICT (business_id) DO UPDATE SET
+        prev_snapshot_id = business_rollups.last_snapshot_id,
+        {', '.join(f'prev_{column} = business_rollups.{column}' for column in ROLLUP_PREVIOUS_COLUMNS)},
+        last_snapshot_id = EXCLUDED.last_snapshot_id,
+        last_created_at = EXCLUDED.last_created_at,
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in ROLLUP_LAST_COLUMNS)},
+        snapshot_count = business_rollups.snapshot_count + 1,
+        {', '.join(f'{total} = business_rollups.{total} + EXCLUDED.{column}' for total, column in ROLLUP_SUM_COLUMNS.items())},
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# Полная пересборка сводок из business_snapshots: заполнение при миграции и после backfill_metrics.py
+# (пересчет меняет overall_health_score уже учтенных снимков)
+REBUILD_BUSINESS_ROLLUPS = f'''
+    INSERT INTO business_rollups (
+        business_id, last_snapshot_id, last_created_at, {', '.join(ROLLUP_LAST_COLUMNS)},
+        prev_snapshot_id, {', '.join(_ROLLUP_PREVIOUS)},
+        snapshot_count, {', '.join(ROLLUP_SUM_COLUMNS)}
+    )
+    SELECT totals.business_id, last.snapshot_id, last.created_at, {', '.join(f'last.{column}' for column in ROLLUP_LAST_COLUMNS)},
+           prev.snapshot_id, {', '.join(f'prev.{column}' for column in ROLLUP_PREVIOUS_COLUMNS)},
+           totals.snapshot_count, {', '.join(f'totals.{total}' for total in ROLLUP_SUM_COLUMNS)}
+    FROM (
+        SELECT business_id, COUNT(*) AS snapshot_count,
+               {', '.join(f'COALESCE(SUM({column}), 0) AS {total}' for total, column in ROLLUP_SUM_COLUMNS.items())}
+        FROM business_snapshots
+        WHERE business_id IS NOT NULL
+        GROUP BY business_id
+    ) totals
+    CROSS JOIN LATERAL (
+        SELECT snapshot_id, created_at, {', '.join(ROLLUP_LAST_COLUMNS)}
+        FROM business_snapshots s
+        WHERE s.business_id = totals.business_id
+        ORDER BY s.created_at DESC, s.snapshot_id DESC
+        LIMIT 1
+    ) last
+    LEFT JOIN LATERAL (
+        SELECT snapshot_id, {', '.join(ROLLUP_PREVIOUS_COLUMNS)}
+        FROM business_snapshots s
+        WHERE s.business_id = totals.business_id
+        ORDER BY s.created_at DESC, s.snapshot_id DESC
+        OFFSET 1 LIMIT 1
+    ) prev ON TRUE
+    ON CONFLICT (business_id) DO UPDATE SET
+        last_snapshot_id = EXCLUDED.last_snapshot_id,
+        last_created_at = EXCLUDED.last_created_at,
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in ROLLUP_LAST_COLUMNS)},
+        prev_snapshot_id = EXCLUDED.prev_snapshot_id,
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in _ROLLUP_PREVIOUS)},
+        snapshot_count = EXCLUDED.snapshot_count,
+        {', '.join(f'{total} = EXCLUDED.{total}' for total in ROLLUP_SUM_COLUMNS)},
+        updated_at = CURRENT_TIMESTAMP
+    -- Снимок, добавленный во время пересборки, не затирается устаревшей строкой
+    WHERE business_rollups.last_snapshot_id <= EXCLUDED.last_snapshot_id
+'''
+
+# Версионированные миграции: (версия, описание, операторы). Применяются по порядку после
+# SCHEMA_STATEMENTS; применённые версии записываются в schema_migrations. Операторы должны быть
+# идемпотентными: прерванную миграцию безопасно выполнить заново целиком.
+# Индексы строятся без CONCURRENTLY: он несовместим с advisory-блокировкой на время миграции
+# (CREATE INDEX CONCURRENTLY ждёт и сессию, которая стоит в очереди за блокировкой).
+MIGRATIONS = [
+    (1, 'Индексы горячих запросов', [
+        # get_business_history, карточка бизнеса: последние снимки бизнеса
+        '''
+        CREATE INDEX IF NOT EXISTS idx_snapshots_business_created
+        ON business_snapshots (business_id, created_at DESC, snapshot_id DESC)
+        ''',
+        # get_user_businesses: только активные бизнесы пользователя
+        '''
+        CREATE INDEX IF NOT EXISTS idx_businesses_user_active
+        ON businesses (user_id, created_at DESC)
+        WHERE is_active
+        ''',
+        # get_or_create_user_chat_session: сессия общего чата пользователя
+        '''
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_chat
+        ON conversation_sessions (user_id, updated_at DESC, session_id DESC)
+        WHERE current_state = 'chat'
+        ''',
+        # get_latest_conversation_session: все сессии пользователя по свежести
+        '''
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_updated
+        ON conversation_sessions (user_id, updated_at DESC, session_id DESC)
+        ''',
+        # Сообщения сессии (внешний ключ messages.session_id)
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_session
+        ON messages (session_id, id DESC)
+        ''',
+        # get_system_stats: активные за сутки
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_created
+        ON messages (created_at)
+        ''',
+        # get_advice: последние снимки с советами
+        '''
+        CREATE INDEX IF NOT EXISTS idx_snapshots_with_advice
+        ON business_snapshots (created_at DESC)
+        WHERE advice1 IS NOT NULL AND advice1 != ''
+        ''',
+        # purge_llm_cache
+        '''
+        CREATE INDEX IF NOT EXISTS idx_llm_cache_expires
+        ON llm_cache (expires_at)
+        ''',
+    ]),
+    (2, 'Прямой индекс истории сообщений пользователя', [
+        # get_user_recent_messages фильтрует messages.user_id без соединения с conversation_sessions
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_user_recent
+        ON messages (user_id, id DESC)
+        WHERE session_id IS NOT NULL
+        ''',
+    ]),
+    (3, 'Сводки бизнесов для роста, KPI и трендов без чтения истории', [
+        BUSINESS_ROLLUPS_TABLE,
+        REBUILD_BUSINESS_ROLLUPS,
+    ]),
+    (4, 'Время перезаписи снимка для версии рядов', [
+        # Ставит backfill_metrics.py при пересчете метрик; без DEFAULT — меняется только каталог
+        '''
+        ALTER TABLE business_snapshots ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE
+        ''',
+    ]),
+    (5, 'Источник метки типа сообщения', [
+        # Классификатор обучается только на независимых метках (LLM, шаги диалога)
+        '''
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS label_source TEXT
+        ''',
+    ]),
+]
+
+SCHEMA_MIGRATIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description TEXT,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+# Ключ pg_advisory_lock: несколько процессов (сайт и бот) не применяют миграции одновременно
+MIGRATION_LOCK_KEY = 7_301_001
+
+# Колонки business_snapshots по группам — из них собираются проекции get_business_history
+SNAPSHOT_KEY_COLUMNS = ['snapshot_id', 'business_id', 'period_date', 'created_at']
+SNAPSHOT_RAW_COLUMNS = [
+    'revenue', 'expenses', 'profit', 'clients', 'average_check', 'investments', 'marketing_costs',
+    'employees', 'new_clients_per_month', 'customer_retention_rate',
+]
+SNAPSHOT_METRIC_COLUMNS = [
+    'profit_margin', 'break_even_clients', 'safety_margin', 'roi', 'profitability_index',
+    'ltv', 'cac', 'ltv_cac_ratio', 'customer_profit_margin', 'sgr', 'revenue_growth_rate',
+    'asset_turnover', 'roe', 'months_to_bankruptcy',
+    'financial_health_score', 'growth_health_score', 'efficiency_health_score', 'overall_health_score',
+]
+SNAPSHOT_ADVICE_COLUMNS = ['advice1', 'advice2', 'advice3', 'advice4']
+
+# Именованные проекции: только то, что читает потребитель (ключевые колонки добавляются всегда).
+# 'all' — SELECT * для тех, кому нужна строка целиком.
+SNAPSHOT_PROJECTIONS = {
+    'health': ['overall_health_score'],
+    'kpi': ['revenue', 'expenses', 'profit', 'clients', 'average_check', 'overall_health_score'],
+    'raw': SNAPSHOT_RAW_COLUMNS,
+    'chart': SNAPSHOT_RAW_COLUMNS[:8] + SNAPSHOT_METRIC_COLUMNS,
+    'analysis': ['revenue', 'expenses', 'profit', 'clients', 'average_check', 'profit_margin',
+                 'efficiency_health_score', 'overall_health_score', 'ai_commentary'],
+    'advice': SNAPSHOT_ADVICE_COLUMNS,
+    'report': SNAPSHOT_RAW_COLUMNS + SNAPSHOT_METRIC_COLUMNS + SNAPSHOT_ADVICE_COLUMNS,
+}
+
+# Метрики графиков дашборда в порядке отдачи (колонки проекции 'chart' без ключевых)
+SERIES_METRICS = SNAPSHOT_PROJECTIONS['chart']
+
+_SNAPSHOT_COLUMNS = set(SNAPSHOT_KEY_COLUMNS + SNAPSHOT_RAW_COLUMNS + SNAPSHOT_METRIC_COLUMNS
+                        + SNAPSHOT_ADVICE_COLUMNS + ['period_type', 'ai_commentary'])
+
+def snapshot_columns(columns) -> Optional[List[str]]:
+    """
+    Колонки для get_business_history: имя проекции или список колонок.
+    None — все колонки (SELECT *). Неизвестные колонки — ValueError (имена попадают в SQL).
+    """
+    if columns is None or columns == 'all':
+        return None
+    if isinstance(columns, str):
+        if columns not in SNAPSHOT_PROJECTIONS:
+            raise ValueError(f"Неизвестная проекция снимков: {columns}")
+        columns = SNAPSHOT_PROJECTIONS[columns]
+    unknown = [column for column in columns if column not in _SNAPSHOT_COLUMNS]
+    if unknown:
+        raise ValueError(f"Неизвестные колонки снимков: {', '.join(unknown)}")
+    return SNAPSHOT_KEY_COLUMNS + [column for column in dict.fromkeys(columns) if column not in SNAPSHOT_KEY_COLUMNS]
+
+def _recent_message(user_message, bot_response, message_type, created_at) -> Dict:
+    """Строка истории в формате get_user_recent_messages"""
+    return {
+        'user_message': user_message or '',
+        'bot_response': bot_response or '',
+        'message_type': message_type or '',
+        'created_at': created_at,
+    }
+
+def _as_float(value) -> float:
+    """Число для DOUBLE PRECISION колонки (asyncpg не приводит типы сам)"""
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _as_int(value) -> int:
+    """Число для INTEGER колонки; дробные значения округляются, как при касте в PostgreSQL"""
+    try:
+        return int(round(float(value or 0)))
+    except (TypeError, ValueError):
+        return 0
 
 class Database:
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        # Слоты пула: getconn при исчерпании бросает PoolError, поэтому лишние вызывающие ждут слот
+        self._pool_slots = None
         self.executor = executor
+        self._last_used: Dict[int, float] = {}
+        self._message_log = None
+        self._recent_messages = RecentMessagesRing()
     
     def build_dsn_from_env(self) -> str:
         """Build PostgreSQL DSN from environment variables"""
@@ -61,249 +464,336 @@ class Database:
     
     async def init_db(self):
         """Инициализация базы данных"""
+        if self.pool is not None:
+            # Уже инициализирована (веб-сайт и бот работают на одном экземпляре)
+            return
         try:
+            dsn = self.build_dsn_from_env()
+            # Пул по размеру executor-а: каждый поток получает своё соединение
+            pool_size = int(os.getenv("DB_POOL_SIZE", str(DB_EXECUTOR_WORKERS)))
+            if pool_size < DB_EXECUTOR_WORKERS:
+                logger.warning(f"⚠️ DB_POOL_SIZE={pool_size} меньше DB_EXECUTOR_WORKERS={DB_EXECUTOR_WORKERS}: "
+                               f"лишние запросы будут ждать свободного соединения")
+            self.pool = ThreadedConnectionPool(1, pool_size, dsn, cursor_factory=RealDictCursor)
+            self._pool_slots = threading.BoundedSemaphore(pool_size)
             if is_production():
-                # В продакшене используем PostgreSQL
-                dsn = self.build_dsn_from_env()
-                self.conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
-                self.conn.autocommit = True
-                logger.info("✅ Подключение к PostgreSQL установлено (продакшен)")
+                logger.info(f"✅ Пул подключений к PostgreSQL создан (продакшен, {pool_size} соединений)")
             else:
                 # Локально используем PostgreSQL (мигрировали с SQLite)
-                dsn = self.build_dsn_from_env()
-                self.conn = psycopg2.connect(dsn, cursor_factory=RealDictCursor)
-                self.conn.autocommit = True
-                logger.info("✅ Подключение к PostgreSQL установлено (локально)")
+                logger.info(f"✅ Пул подключений к PostgreSQL создан (локально, {pool_size} соединений)")
             
             await self.create_tables()
         except Exception as e:
             logger.error(f"❌ Ошибка подключения к базе данных: {e}")
             raise
+
+    def close(self):
+        """Закрытие всех соединений пула"""
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+            self._pool_slots = None
+            self._last_used.clear()
+
+    def _discard(self, conn):
+        """Выбросить соединение из пула (пул откроет новое при следующем запросе)"""
+        self._last_used.pop(id(conn), None)
+        try:
+            self.pool.putconn(conn, close=True)
+        except Exception:
+            pass
+
+    def _acquire(self):
+        """Взять живое соединение из пула, переподключаясь при обрыве"""
+        if self.pool is None:
+            raise RuntimeError("База данных не инициализирована (вызовите init_db)")
+        
+        last_error = None
+        # Каждый простаивающий коннект может оказаться мёртвым — пробуем не больше размера пула + 1
+        for _ in range(self.pool.maxconn + 1):
+            conn = self.pool.getconn()
+            if conn.closed:
+                self._discard(conn)
+                continue
+            if not conn.autocommit:
+                conn.autocommit = True
+            
+            idle = time.monotonic() - self._last_used.get(id(conn), 0.0)
+            if idle < DB_POOL_PING_INTERVAL:
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logger.warning(f"⚠️ Соединение с PostgreSQL потеряно, переподключаюсь: {e}")
+                last_error = e
+                self._discard(conn)
+        
+        raise psycopg2.OperationalError(f"Не удалось получить рабочее соединение из пула: {last_error}")
+
+    def _with_connection(self, func):
+        """
+        Выполнить func(conn) на соединении из пула и вернуть соединение обратно.
+        Если все соединения заняты, поток ждет свободного слота (а не получает PoolError).
+        """
+        slots = self._pool_slots
+        if slots is None:
+            raise RuntimeError("База данных не инициализирована (вызовите init_db)")
+        with slots:
+            conn = self._acquire()
+            try:
+                result = func(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Оборванное соединение не возвращаем в пул
+                self._discard(conn)
+                raise
+            except Exception:
+                self._last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+                raise
+            self._last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn)
+            return result
+
+    async def _run(self, func):
+        """Выполнить синхронную функцию с соединением в executor-е"""
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self._with_connection, func)
+    
+    async def _fetch(self, query: str, params: tuple = ()) -> List[Dict]:
+        """SELECT, возвращающий список строк-словарей"""
+        def _select(conn):
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+        
+        return await self._run(_select)
+    
+    async def _fetchrow(self, query: str, params: tuple = ()) -> Optional[Dict]:
+        """Запрос, возвращающий одну строку (или None)"""
+        def _select(conn):
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        
+        return await self._run(_select)
     
+    async def _execute(self, query: str, params: tuple = ()) -> None:
+        """Запрос без результата (INSERT/UPDATE/DDL)"""
+        def _exec(conn):
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+        
+        await self._run(_exec)
+    
+    async def _execute_locked(self, lock_key: int, statements: List) -> None:
+        """
+        Операторы (строка или (запрос, параметры)) на одном соединении под pg_advisory_lock.
+        Блокировка снимается и при ошибке, чтобы соединение вернулось в пул чистым.
+        """
+        def _exec(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_advisory_lock(%s)', (lock_key,))
+            try:
+                for statement in statements:
+                    query, params = statement if isinstance(statement, tuple) else (statement, ())
+                    cursor.execute(query, params)
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (lock_key,))
+
+        await self._run(_exec)
+
     async def create_tables(self):
         """Создание новых таблиц для мульти-бизнесов"""
-        def _create():
-            cursor = self.conn.cursor()
-            
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id TEXT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Новая таблица бизнесов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS businesses (
-                    business_id SERIAL PRIMARY KEY,
-                    user_id TEXT,
-                    business_name TEXT,
-                    business_type TEXT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # Основная таблица снимков бизнеса
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS business_snapshots (
-                    snapshot_id SERIAL PRIMARY KEY,
-                    business_id INTEGER,
-                    period_type TEXT,
-                    period_date DATE,
-                    
-                    -- Сырые данные от пользователя
-                    revenue DOUBLE PRECISION DEFAULT 0,
-                    expenses DOUBLE PRECISION DEFAULT 0,
-                    profit DOUBLE PRECISION DEFAULT 0,
-                    clients INTEGER DEFAULT 0,
-                    average_check DOUBLE PRECISION DEFAULT 0,
-                    investments DOUBLE PRECISION DEFAULT 0,
-                    marketing_costs DOUBLE PRECISION DEFAULT 0,
-                    employees INTEGER DEFAULT 0,
-                    new_clients_per_month INTEGER DEFAULT 0,
-                    customer_retention_rate DOUBLE PRECISION DEFAULT 0,
-                    
-                    -- Рассчитанные метрики (22 штуки)
-                    profit_margin DOUBLE PRECISION DEFAULT 0,
-                    break_even_clients DOUBLE PRECISION DEFAULT 0,
-                    safety_margin DOUBLE PRECISION DEFAULT 0,
-                    roi DOUBLE PRECISION DEFAULT 0,
-                    profitability_index DOUBLE PRECISION DEFAULT 0,
-                    ltv DOUBLE PRECISION DEFAULT 0,
-                    cac DOUBLE PRECISION DEFAULT 0,
-                    ltv_cac_ratio DOUBLE PRECISION DEFAULT 0,
-                    customer_profit_margin DOUBLE PRECISION DEFAULT 0,
-                    sgr DOUBLE PRECISION DEFAULT 0,
-                    revenue_growth_rate DOUBLE PRECISION DEFAULT 0,
-                    asset_turnover DOUBLE PRECISION DEFAULT 0,
-                    roe DOUBLE PRECISION DEFAULT 0,
-                    months_to_bankruptcy DOUBLE PRECISION DEFAULT 0,
-                    
-                    -- Health Score
-                    financial_health_score INTEGER DEFAULT 0,
-                    growth_health_score INTEGER DEFAULT 0,
-                    efficiency_health_score INTEGER DEFAULT 0,
-                    overall_health_score INTEGER DEFAULT 0,
-                    
-                    -- AI советы и комментарий
-                    advice1 TEXT DEFAULT '',
-                    advice2 TEXT DEFAULT '',
-                    advice3 TEXT DEFAULT '',
-                    advice4 TEXT DEFAULT '',
-                    ai_commentary TEXT DEFAULT '',
-                    
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (business_id) REFERENCES businesses(business_id)
-                )
-            ''')
-            
-            # Сессии диалогов для умного сбора данных
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversation_sessions (
-                    session_id SERIAL PRIMARY KEY,
-                    user_id TEXT,
-                    business_id INTEGER,
-                    current_state TEXT,
-                    collected_data TEXT, -- JSON
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (business_id) REFERENCES businesses(business_id)
-                )
-            ''')
-            
-            # Сообщения (логи чата)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    session_id INTEGER,
-                    user_message TEXT,
-                    bot_response TEXT,
-                    message_type TEXT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (session_id) REFERENCES conversation_sessions(session_id)
-                )
-            ''')
-        
-        await asyncio.get_event_loop().run_in_executor(self.executor, _create)
+        for statement in SCHEMA_STATEMENTS:
+            await self._execute(statement)
+        await self.apply_migrations()
+
+    async def apply_migrations(self):
+        """Применение ещё не применённых миграций из MIGRATIONS по возрастанию версии"""
+        await self._execute(SCHEMA_MIGRATIONS_TABLE)
+        applied = {row['version'] for row in await self._fetch('SELECT version FROM schema_migrations')}
+        for version, description, statements in sorted(MIGRATIONS, key=lambda migration: migration[0]):
+            if version in applied:
+                continue
+            started = time.perf_counter()
+            await self._execute_locked(MIGRATION_LOCK_KEY, [
+                *statements,
+                ('''
+                    INSERT INTO schema_migrations (version, description) VALUES (%s, %s)
+                    ON CONFLICT (version) DO NOTHING
+                ''', (version, description)),
+            ])
+            logger.info(f"✅ Миграция {version} применена: {description} ({(time.perf_counter() - started) * 1000:.0f} мс)")
     
     # ===== НОВЫЕ МЕТОДЫ ДЛЯ МУЛЬТИ-БИЗНЕСОВ =====
     
     async def create_business(self, user_id: str, name: str, business_type: str = "general") -> int:
         """Создание нового бизнеса"""
-        def _create():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO businesses (user_id, business_name, business_type)
-                VALUES (%s, %s, %s) RETURNING business_id
-            ''', (user_id, name, business_type))
-            return cursor.fetchone()['business_id']
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _create)
+        row = await self._fetchrow('''
+            INSERT INTO businesses (user_id, business_name, business_type)
+            VALUES (%s, %s, %s) RETURNING business_id
+        ''', (user_id, name, business_type))
+        return row['business_id']
     
     async def get_user_businesses(self, user_id: str) -> List[Dict]:
         """Получение всех бизнесов пользователя"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT business_id, business_name, business_type, created_at, is_active
-                FROM businesses 
-                WHERE user_id = %s AND is_active = TRUE
-                ORDER BY created_at DESC
-            ''', (user_id,))
-            rows = cursor.fetchall()
-            return [
-                {
-                    'business_id': row['business_id'],
-                    'business_name': row['business_name'],
-                    'business_type': row['business_type'],
-                    'created_at': row['created_at'],
-                    'is_active': row['is_active']
-                }
-                for row in rows
-            ]
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        return await self._fetch('''
+            SELECT business_id, business_name, business_type, created_at, is_active
+            FROM businesses 
+            WHERE user_id = %s AND is_active = TRUE
+            ORDER BY created_at DESC
+        ''', (user_id,))
     
     async def add_business_snapshot(self, business_id: int, raw_data: Dict, metrics: Dict, period_date: str = None, advice_list: List[str] = None, ai_commentary: str = '') -> int:
         """Добавление снимка бизнеса со всеми метриками"""
-        def _add():
-            cursor = self.conn.cursor()
-            utc_now = datetime.now(timezone.utc)
-            moscow_time = utc_now
-            actual_period_date = period_date or moscow_time.strftime("%Y-%m-%d")
-            
-            advice_list_local = (advice_list or [])[:4]
-            while len(advice_list_local) < 4:
-                advice_list_local.append('')
-            
-            moscow_time_str = moscow_time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            cursor.execute('''
-                INSERT INTO business_snapshots (
-                    business_id, period_type, period_date,
-                    revenue, expenses, profit, clients, average_check, investments, marketing_costs, employees,
-                    new_clients_per_month, customer_retention_rate,
-                    profit_margin, break_even_clients, safety_margin, roi, profitability_index,
-                    ltv, cac, ltv_cac_ratio, customer_profit_margin, sgr, revenue_growth_rate,
-                    asset_turnover, roe, months_to_bankruptcy,
-                    financial_health_score, growth_health_score, efficiency_health_score, overall_health_score,
-                    advice1, advice2, advice3, advice4, ai_commentary, created_at
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING snapshot_id
-            ''', (
-                business_id, 'monthly', actual_period_date,
-                raw_data.get('revenue', 0), raw_data.get('expenses', 0), raw_data.get('profit', 0),
-                raw_data.get('clients', 0), raw_data.get('average_check', 0), raw_data.get('investments', 0),
-                raw_data.get('marketing_costs', 0), raw_data.get('employees', 0),
-                raw_data.get('new_clients_per_month', 0), raw_data.get('customer_retention_rate', 0),
-                metrics.get('profit_margin', 0), metrics.get('break_even_clients', 0),
-                metrics.get('safety_margin', 0), metrics.get('roi', 0), metrics.get('profitability_index', 0),
-                metrics.get('ltv', 0), metrics.get('cac', 0), metrics.get('ltv_cac_ratio', 0),
-                metrics.get('customer_profit_margin', 0), metrics.get('sgr', 0), metrics.get('revenue_growth_rate', 0),
-                metrics.get('asset_turnover', 0), metrics.get('roe', 0), metrics.get('months_to_bankruptcy', 0),
-                metrics.get('financial_health_score', 0), metrics.get('growth_health_score', 0),
-                metrics.get('efficiency_health_score', 0), metrics.get('overall_health_score', 0),
-                advice_list_local[0], advice_list_local[1], advice_list_local[2], advice_list_local[3],
-                ai_commentary, moscow_time_str
-            ))
-            return cursor.fetchone()['snapshot_id']
+        utc_now = datetime.now(timezone.utc)
+        moscow_time = utc_now
+        if isinstance(period_date, str):
+            actual_period_date = datetime.strptime(period_date, "%Y-%m-%d").date()
+        else:
+            actual_period_date = period_date or moscow_time.date()
         
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _add)
+        advice_list_local = (advice_list or [])[:4]
+        while len(advice_list_local) < 4:
+            advice_list_local.append('')
+        
+        # Время без таймзоны, как и прежняя строка "%Y-%m-%d %H:%M:%S"
+        moscow_time_naive = moscow_time.replace(tzinfo=None, microsecond=0)
+        
+        # Снимок и сдвиг сводки business_rollups — один оператор, поэтому они не расходятся
+        row = await self._fetchrow(f'''
+            WITH inserted AS (
+            INSERT INTO business_snapshots (
+                business_id, period_type, period_date,
+                revenue, expenses, profit, clients, average_check, investments, marketing_costs, employees,
+                new_clients_per_month, customer_retention_rate,
+                profit_margin, break_even_clients, safety_margin, roi, profitability_index,
+                ltv, cac, ltv_cac_ratio, customer_profit_margin, sgr, revenue_growth_rate,
+                asset_turnover, roe, months_to_bankruptcy,
+                financial_health_score, growth_health_score, efficiency_health_score, overall_health_score,
+                advice1, advice2, advice3, advice4, ai_commentary, created_at
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING snapshot_id, business_id, created_at, {', '.join(ROLLUP_LAST_COLUMNS)}
+            ), rollup AS ({_ROLLUP_UPSERT})
+            SELECT snapshot_id FROM inserted
+        ''', (
+            business_id, 'monthly', actual_period_date,
+            _as_float(raw_data.get('revenue', 0)), _as_float(raw_data.get('expenses', 0)), _as_float(raw_data.get('profit', 0)),
+            _as_int(raw_data.get('clients', 0)), _as_float(raw_data.get('average_check', 0)), _as_float(raw_data.get('investments', 0)),
+            _as_float(raw_data.get('marketing_costs', 0)), _as_int(raw_data.get('employees', 0)),
+            _as_int(raw_data.get('new_clients_per_month', 0)), _as_float(raw_data.get('customer_retention_rate', 0)),
+            _as_float(metrics.get('profit_margin', 0)), _as_float(metrics.get('break_even_clients', 0)),
+            _as_float(metrics.get('safety_margin', 0)), _as_float(metrics.get('roi', 0)), _as_float(metrics.get('profitability_index', 0)),
+            _as_float(metrics.get('ltv', 0)), _as_float(metrics.get('cac', 0)), _as_float(metrics.get('ltv_cac_ratio', 0)),
+            _as_float(metrics.get('customer_profit_margin', 0)), _as_float(metrics.get('sgr', 0)), _as_float(metrics.get('revenue_growth_rate', 0)),
+            _as_float(metrics.get('asset_turnover', 0)), _as_float(metrics.get('roe', 0)), _as_float(metrics.get('months_to_bankruptcy', 0)),
+            _as_int(metrics.get('financial_health_score', 0)), _as_int(metrics.get('growth_health_score', 0)),
+            _as_int(metrics.get('efficiency_health_score', 0)), _as_int(metrics.get('overall_health_score', 0)),
+            advice_list_local[0], advice_list_local[1], advice_list_local[2], advice_list_local[3],
+            ai_commentary, moscow_time_naive
+        ))
+        return row['snapshot_id']
     
-    async def get_business_history(self, business_id: int, limit: int = 12) -> List[Dict]:
-        """Получение истории снимков бизнеса"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT * FROM business_snapshots 
-                WHERE business_id = %s 
-                ORDER BY created_at DESC, snapshot_id DESC 
+    async def get_business_history(self, business_id: int, limit: int = 12, columns='all') -> List[Dict]:
+        """
+        Получение истории снимков бизнеса (новые первыми).
+        columns — имя проекции из SNAPSHOT_PROJECTIONS или список колонок; 'all' — все колонки.
+        """
+        selected = snapshot_columns(columns)
+        select_list = ', '.join(selected) if selected else '*'
+        return await self._fetch(f'''
+            SELECT {select_list} FROM business_snapshots 
+            WHERE business_id = %s 
+            ORDER BY created_at DESC, snapshot_id DESC 
+            LIMIT %s
+        ''', (business_id, limit))
+
+    async def get_business_rollup(self, business_id: int) -> Optional[Dict]:
+        """Сводка бизнеса: последний и предыдущий снимок и суммы по всем снимкам (None — снимков нет)"""
+        return await self._fetchrow('SELECT * FROM business_rollups WHERE business_id = %s', (business_id,))
+
+    async def get_business_series_version(self, business_id: int) -> Dict:
+        """
+        Версия истории бизнеса для ETag: max(id) и количество меняются при добавлении снимков,
+        max(updated_at) — при перезаписи метрик сохраненных снимков (backfill_metrics.py)
+        """
+        row = await self._fetchrow('''
+            SELECT COALESCE(MAX(snapshot_id), 0) AS last_snapshot_id, COUNT(*) AS points,
+                   COALESCE(EXTRACT(EPOCH FROM MAX(updated_at)), 0) AS rewritten_at
+            FROM business_snapshots
+            WHERE business_id = %s
+        ''', (business_id,))
+        return {'last_snapshot_id': int(row['last_snapshot_id']), 'points': int(row['points']),
+                'rewritten_at': float(row['rewritten_at'])}
+
+    async def get_snapshots_after(self, after_snapshot_id: int, columns: List[str], limit: int = 5000) -> List[Dict]:
+        """
+        Снимки с snapshot_id > after_snapshot_id по возрастанию id вместе с типом и активностью бизнеса.
+        Для инкрементальных агрегатов: каждый вызов читает по первичному ключу только новое.
+        """
+        selected = ', '.join(f's.{column}' for column in snapshot_columns(columns))
+        return await self._fetch(f'''
+            SELECT {selected}, b.business_type, b.is_active
+            FROM business_snapshots s
+            JOIN businesses b ON b.business_id = s.business_id
+            WHERE s.snapshot_id > %s
+            ORDER BY s.snapshot_id
+            LIMIT %s
+        ''', (after_snapshot_id, limit))
+
+    async def get_business_series(self, business_id: int, metrics: List[str] = None,
+                                  since: int = None, limit: int = 180) -> Dict:
+        """
+        Колоночные ряды для графиков: {'dates': [...], 'series': {метрика: [...]}, 'cursor': id}.
+        Порядок — от старых к новым; БД сама собирает массивы (array_agg), поэтому в Python
+        нет ни сортировки, ни разбора дат. since — курсор (snapshot_id) прошлого ответа:
+        вернутся только более новые снимки.
+        """
+        metrics = list(dict.fromkeys(metrics or SERIES_METRICS))
+        unknown = [metric for metric in metrics if metric not in SERIES_METRICS]
+        if unknown:
+            raise ValueError(f"Неизвестные метрики: {', '.join(unknown)}")
+
+        order = 'ORDER BY created_at NULLS FIRST, snapshot_id'
+        aggregates = ',\n                '.join(
+            f"COALESCE(array_agg(COALESCE({metric}, 0)::float8 {order}), '{{}}') AS {metric}"
+            for metric in metrics
+        )
+        since_filter = 'AND snapshot_id > %s' if since is not None else ''
+        params = (business_id, since, limit) if since is not None else (business_id, limit)
+        row = await self._fetchrow(f'''
+            SELECT
+                COALESCE(array_agg(
+                    COALESCE(to_char(created_at, 'YYYY-MM-DD HH24:MI'), period_date::text) {order}
+                ), '{{}}') AS dates,
+                {aggregates},
+                MAX(snapshot_id) AS last_snapshot_id
+            FROM (
+                SELECT snapshot_id, created_at, period_date, {', '.join(metrics)}
+                FROM business_snapshots
+                WHERE business_id = %s {since_filter}
+                ORDER BY created_at DESC, snapshot_id DESC
                 LIMIT %s
-            ''', (business_id, limit))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+            ) recent
+        ''', params)
+        last_snapshot_id = row['last_snapshot_id']
+        return {
+            'dates': list(row['dates']),
+            'series': {metric: list(row[metric]) for metric in metrics},
+            'cursor': int(last_snapshot_id) if last_snapshot_id is not None else (since or 0),
+        }
 
     async def soft_delete_business(self, user_id: str, business_id: int) -> None:
         """Мягкое удаление бизнеса (is_active = FALSE) только владельцем"""
-        def _del():
-            cursor = self.conn.cursor()
-            cursor.execute(
-                """
-                UPDATE businesses SET is_active = FALSE
-                WHERE business_id = %s AND user_id = %s
-                """,
-                (business_id, user_id)
-            )
-        await asyncio.get_event_loop().run_in_executor(self.executor, _del)
+        await self._execute(
+            """
+            UPDATE businesses SET is_active = FALSE
+            WHERE business_id = %s AND user_id = %s
+            """,
+            (business_id, user_id)
+        )
 
     # Удалено: отрасль больше не обновляется
     
@@ -311,144 +801,157 @@ class Database:
     
     async def create_conversation_session(self, user_id: str, business_id: int = None, initial_state: str = "awaiting_business_name") -> int:
         """Создание сессии для умного диалога"""
-        def _create():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO conversation_sessions (user_id, business_id, current_state, collected_data)
-                VALUES (%s, %s, %s, %s) RETURNING session_id
-            ''', (user_id, business_id, initial_state, json.dumps({})))
-            return cursor.fetchone()['session_id']
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _create)
+        row = await self._fetchrow('''
+            INSERT INTO conversation_sessions (user_id, business_id, current_state, collected_data)
+            VALUES (%s, %s, %s, %s) RETURNING session_id
+        ''', (user_id, business_id, initial_state, json.dumps({})))
+        return row['session_id']
     
     async def update_session_state(self, session_id: int, new_state: str, new_data: Dict = None):
         """Обновление состояния сессии"""
-        def _update():
-            cursor = self.conn.cursor()
-            if new_data:
-                cursor.execute('''
-                    UPDATE conversation_sessions 
-                    SET current_state = %s, collected_data = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE session_id = %s
-                ''', (new_state, json.dumps(new_data), session_id))
-            else:
-                cursor.execute('''
-                    UPDATE conversation_sessions 
-                    SET current_state = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE session_id = %s
-                ''', (new_state, session_id))
-        
-        await asyncio.get_event_loop().run_in_executor(self.executor, _update)
+        if new_data:
+            await self._execute('''
+                UPDATE conversation_sessions 
+                SET current_state = %s, collected_data = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE session_id = %s
+            ''', (new_state, json.dumps(new_data), session_id))
+        else:
+            await self._execute('''
+                UPDATE conversation_sessions 
+                SET current_state = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE session_id = %s
+            ''', (new_state, session_id))
     
     async def get_session(self, session_id: int) -> Optional[Dict]:
         """Получение данных сессии"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT session_id, user_id, business_id, current_state, collected_data, created_at
-                FROM conversation_sessions 
-                WHERE session_id = %s
-            ''', (session_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'session_id': row['session_id'],
-                    'user_id': row['user_id'],
-                    'business_id': row['business_id'],
-                    'current_state': row['current_state'],
-                    'collected_data': json.loads(row['collected_data']) if row['collected_data'] else {},
-                    'created_at': row['created_at']
-                }
-            return None
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        row = await self._fetchrow('''
+            SELECT session_id, user_id, business_id, current_state, collected_data, created_at
+            FROM conversation_sessions 
+            WHERE session_id = %s
+        ''', (session_id,))
+        if row:
+            row['collected_data'] = json.loads(row['collected_data']) if row['collected_data'] else {}
+        return row
+    
+    async def get_latest_conversation_session(self, user_id: str) -> Optional[Dict]:
+        """Последняя диалоговая сессия пользователя (кроме сессий общего чата)"""
+        return await self._fetchrow('''
+            SELECT session_id, current_state, updated_at
+            FROM conversation_sessions
+            WHERE user_id = %s AND current_state != 'chat'
+            ORDER BY updated_at DESC, session_id DESC
+            LIMIT 1
+        ''', (user_id,))
     
     # ===== СТАРЫЕ МЕТОДЫ ДЛЯ ОБРАТНОЙ СОВМЕСТИМОСТИ =====
     
     async def save_user(self, user_id: str, username: str, first_name: str, last_name: str):
         """Сохранение пользователя (старый метод)"""
-        def _save():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name
-            ''', (user_id, username, first_name, last_name))
-        
-        await asyncio.get_event_loop().run_in_executor(self.executor, _save)
+        await self._execute('''
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name
+        ''', (user_id, username, first_name, last_name))
     
     async def save_message(self, user_id: str, message_text: str, message_type: str, response_text: str):
         """Сохранение сообщения (старый метод для обратной совместимости)"""
-        def _save():
-            # Старая схема более не актуальна, оставляем пустой no-op для совместимости
-            pass
-        
-        await asyncio.get_event_loop().run_in_executor(self.executor, _save)
-
-    async def log_message(self, user_id: str, session_id: Optional[int], user_message: str, bot_response: str, message_type: str):
-        """Сохранение сообщения в новую таблицу messages с обязательным user_id."""
-        def _insert():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO messages (user_id, session_id, user_message, bot_response, message_type)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (user_id, session_id, user_message, bot_response, message_type))
-        
-        await asyncio.get_event_loop().run_in_executor(self.executor, _insert)
+        # Старая схема более не актуальна, оставляем пустой no-op для совместимости
+        return None
+
+    async def log_message(self, user_id: str, session_id: Optional[int], user_message: str, bot_response: str,
+                          message_type: str, label_source: str = None):
+        """
+        Сохранение сообщения в новую таблицу messages с обязательным user_id.
+        label_source — кто определил message_type (message_classifier.LABEL_SOURCE_*), None — шаг диалога.
+        """
+        # Время фиксируем сейчас: при буферизации строка попадёт в БД позже
+        row = (user_id, session_id, user_message, bot_response, message_type, label_source, datetime.now(timezone.utc))
+        if MESSAGE_LOG_BUFFERED:
+            self._get_message_log().add(row)
+        else:
+            await self.insert_messages([row])
+        if session_id is not None:
+            self._recent_messages.append(user_id, _recent_message(user_message, bot_response, message_type, row[-1]))
+
+    async def insert_messages(self, rows: List[tuple]):
+        """Запись пачки строк messages одним запросом"""
+        def _insert(conn):
+            cursor = conn.cursor()
+            execute_values(cursor, '''
+                INSERT INTO messages (user_id, session_id, user_message, bot_response, message_type, label_source, created_at)
+                VALUES %s
+            ''', rows, page_size=max(len(rows), 1))
+
+        await self._run(_insert)
+
+    def _get_message_log(self):
+        if self._message_log is None:
+            from message_log import MessageLogBuffer
+            self._message_log = MessageLogBuffer(self)
+        return self._message_log
+
+    async def flush_message_log(self):
+        """Дописать буфер журнала сообщений (перед чтением messages и при остановке)"""
+        if self._message_log is not None and len(self._message_log):
+            await self._message_log.flush()
+
+    def get_message_log_stats(self) -> Dict:
+        if self._message_log is None:
+            return {'buffered': MESSAGE_LOG_BUFFERED, 'pending': 0}
+        return {'buffered': MESSAGE_LOG_BUFFERED, **self._message_log.get_stats()}
     
     async def get_user_recent_messages(self, user_id: str, limit: int = 20) -> List[Dict]:
         """Возвращает последние сообщения пользователя из всех его сессий для восстановления контекста."""
-        def _select():
-            cursor = self.conn.cursor()
-            # Берем сообщения, связанные с сессиями данного пользователя
-            cursor.execute('''
-                SELECT m.user_message, m.bot_response, m.message_type, m.created_at
-                FROM messages m
-                JOIN conversation_sessions cs ON cs.session_id = m.session_id
-                WHERE cs.user_id = %s AND m.session_id IS NOT NULL
-                ORDER BY m.id DESC
+        cached = self._recent_messages.get(user_id, limit)
+        if cached is not None:
+            return cached
+
+        write_version = self._recent_messages.begin_prime(user_id)
+        results = None
+        try:
+            await self.flush_message_log()
+            # messages.user_id — прямой путь по индексу (user_id, id DESC), без соединения с сессиями
+            rows = await self._fetch('''
+                SELECT user_message, bot_response, message_type, created_at
+                FROM messages
+                WHERE user_id = %s AND session_id IS NOT NULL
+                ORDER BY id DESC
                 LIMIT %s
-            ''', (user_id, limit))
-            rows = cursor.fetchall()
-            results: List[Dict] = []
-            for row in rows:
-                results.append({
-                    'user_message': row['user_message'] or '',
-                    'bot_response': row['bot_response'] or '',
-                    'message_type': row['message_type'] or '',
-                    'created_at': row['created_at']
-                })
+            ''', (user_id, max(limit, self._recent_messages.size)))
+            results = [
+                _recent_message(row['user_message'], row['bot_response'], row['message_type'], row['created_at'])
+                for row in rows
+            ]
             # Разворачиваем обратно в хронологический порядок (старые -> новые)
             results.reverse()
-            return results
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _select)
+        finally:
+            # При ошибке (и отмене) прогрев снимается, иначе счётчик записей пользователя остался бы навсегда
+            self._recent_messages.prime(user_id, results, write_version)
+        return results[-limit:] if limit > 0 else []
+
+    def get_recent_messages_stats(self) -> Dict:
+        return self._recent_messages.get_stats()
 
     async def get_or_create_user_chat_session(self, user_id: str) -> int:
         """Возвращает id сессии для общего чата пользователя; создает при отсутствии."""
-        def _get_or_create() -> int:
-            cursor = self.conn.cursor()
-            # Ищем последнюю сессию типа chat без привязки к бизнесу
-            cursor.execute('''
-                SELECT session_id FROM conversation_sessions
-                WHERE user_id = %s AND current_state = 'chat'
-                ORDER BY updated_at DESC, session_id DESC
-                LIMIT 1
-            ''', (user_id,))
-            row = cursor.fetchone()
-            if row:
-                return row['session_id']
-            # Создаем новую chat-сессию
-            cursor.execute('''
-                INSERT INTO conversation_sessions (user_id, business_id, current_state, collected_data)
-                VALUES (%s, NULL, 'chat', '{}') RETURNING session_id
-            ''', (user_id,))
-            return cursor.fetchone()['session_id']
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get_or_create)
+        # Ищем последнюю сессию типа chat без привязки к бизнесу
+        row = await self._fetchrow('''
+            SELECT session_id FROM conversation_sessions
+            WHERE user_id = %s AND current_state = 'chat'
+            ORDER BY updated_at DESC, session_id DESC
+            LIMIT 1
+        ''', (user_id,))
+        if row:
+            return row['session_id']
+        # Создаем новую chat-сессию
+        row = await self._fetchrow('''
+            INSERT INTO conversation_sessions (user_id, business_id, current_state, collected_data)
+            VALUES (%s, NULL, 'chat', '{}') RETURNING session_id
+        ''', (user_id,))
+        return row['session_id']
     
     async def save_business_analysis(self, user_id: str, business_data: Dict):
         """Сохранение бизнес-анализа (старый метод для обратной совместимости)"""
@@ -485,7 +988,9 @@ class Database:
         
         # Берем первый бизнес пользователя
         business_id = businesses[0]['business_id']
-        snapshots = await self.get_business_history(business_id, limit=5)
+        snapshots = await self.get_business_history(
+            business_id, limit=5, columns=SNAPSHOT_PROJECTIONS['kpi'] + ['investments']
+        )
         
         # Преобразуем в старый формат для обратной совместимости
         result = []
@@ -506,84 +1011,113 @@ class Database:
 
     async def get_all_users(self) -> List[Dict]:
         """Получение всех пользователей"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT user_id, username, first_name, last_name
-                FROM users 
-                ORDER BY user_id DESC
-            ''')
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        return await self._fetch('''
+            SELECT user_id, username, first_name, last_name
+            FROM users 
+            ORDER BY user_id DESC
+        ''')
     
     async def get_user_info(self, user_id: str) -> Optional[Dict]:
         """Получение информации о конкретном пользователе"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT user_id, username, first_name, last_name
-                FROM users 
-                WHERE user_id = %s
-            ''', (user_id,))
-            row = cursor.fetchone()
-            if row:
-                return dict(row)
-            return None
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        return await self._fetchrow('''
+            SELECT user_id, username, first_name, last_name
+            FROM users 
+            WHERE user_id = %s
+        ''', (user_id,))
     
     async def get_system_stats(self) -> Dict:
         """Получение системной статистики"""
-        def _get():
-            cursor = self.conn.cursor()
-            
-            # Общее количество пользователей
-            cursor.execute('SELECT COUNT(*) as total_users FROM users')
-            total_users = cursor.fetchone()['total_users']
-            
-            # Общее количество анализов
-            cursor.execute('SELECT COUNT(*) as total_analyses FROM business_snapshots')
-            total_analyses = cursor.fetchone()['total_analyses']
-            
-            # Активные сегодня (пользователи с активностью за последние 24 часа)
-            cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) as active_today 
-                FROM messages 
-                WHERE created_at >= NOW() - INTERVAL '1 day'
-            ''')
-            active_today = cursor.fetchone()['active_today']
-            
-            return {
-                'total_users': total_users,
-                'total_analyses': total_analyses,
-                'active_today': active_today
-            }
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        await self.flush_message_log()
+        # Активные сегодня - пользователи с активностью за последние 24 часа
+        row = await self._fetchrow('''
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                (SELECT COUNT(*) FROM business_snapshots) AS total_analyses,
+                (SELECT COUNT(DISTINCT user_id) FROM messages
+                 WHERE created_at >= NOW() - INTERVAL '1 day') AS active_today
+        ''')
+        return {
+            'total_users': row['total_users'],
+            'total_analyses': row['total_analyses'],
+            'active_today': row['active_today']
+        }
     
     async def get_advice(self) -> List[str]:
         """Получение общих советов"""
-        def _get():
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT advice1, advice2, advice3, advice4 
-                FROM business_snapshots 
-                WHERE advice1 IS NOT NULL AND advice1 != ''
-                ORDER BY created_at DESC 
-                LIMIT 10
-            ''')
-            rows = cursor.fetchall()
-            advice = []
-            for row in rows:
-                for key in ['advice1', 'advice2', 'advice3', 'advice4']:
-                    val = row.get(key)
-                    if val and str(val).strip():
-                        advice.append(str(val).strip())
-            return advice[:5]  # Возвращаем максимум 5 советов
-        
-        return await asyncio.get_event_loop().run_in_executor(self.executor, _get)
+        rows = await self._fetch('''
+            SELECT advice1, advice2, advice3, advice4 
+            FROM business_snapshots 
+            WHERE advice1 IS NOT NULL AND advice1 != ''
+            ORDER BY created_at DESC 
+            LIMIT 10
+        ''')
+        advice = []
+        for row in rows:
+            for key in ['advice1', 'advice2', 'advice3', 'advice4']:
+                val = row.get(key)
+                if val and str(val).strip():
+                    advice.append(str(val).strip())
+        return advice[:5]  # Возвращаем максимум 5 советов
+
+    async def get_classified_messages(self, limit: int = 5000, label_sources: List[str] = (),
+                                      message_types: List[str] = ()) -> List[Dict]:
+        """
+        Последние сообщения с размеченным типом — обучающая выборка локального классификатора.
+        Берутся строки с источником метки из label_sources или с типом из message_types.
+        """
+        await self.flush_message_log()
+        return await self._fetch('''
+            SELECT user_message, message_type, label_source
+            FROM messages
+            WHERE message_type IS NOT NULL
+              AND (label_source = ANY(%s) OR message_type = ANY(%s))
+              AND user_message IS NOT NULL AND user_message != ''
+            ORDER BY id DESC
+            LIMIT %s
+        ''', (list(label_sources), list(message_types), limit))
+
+    async def get_llm_cache(self, cache_key: str) -> Optional[Dict]:
+        """Непросроченный ответ LLM из постоянного кэша: {'response', 'ttl_seconds' — сколько осталось жить}"""
+        row = await self._fetchrow('''
+            SELECT response, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)::double precision AS ttl_seconds
+            FROM llm_cache
+            WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP
+        ''', (cache_key,))
+        return dict(row) if row else None
+
+    async def set_llm_cache(self, cache_key: str, prompt_type: str, response: str, ttl_seconds: int):
+        """Сохранение ответа LLM в постоянный кэш"""
+        await self._execute('''
+            INSERT INTO llm_cache (cache_key, prompt_type, response, expires_at)
+            VALUES (%s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+            ON CONFLICT (cache_key) DO UPDATE SET
+                response = EXCLUDED.response,
+                created_at = CURRENT_TIMESTAMP,
+                expires_at = EXCLUDED.expires_at
+        ''', (cache_key, prompt_type, response, float(ttl_seconds)))
+
+    async def purge_llm_cache(self):
+        """Удаление просроченных записей кэша LLM"""
+        await self._execute('DELETE FROM llm_cache WHERE expires_at <= CURRENT_TIMESTAMP')
+
+def create_database() -> Database:
+    """
+    Экземпляр БД с бэкендом из DB_BACKEND: psycopg2 (по умолчанию) или asyncpg.
+    При DB_CACHE=1 (по умолчанию) он оборачивается кэш-прослойкой db_cache.CachedDatabase.
+    """
+    backend = os.getenv("DB_BACKEND", "psycopg2").lower()
+    if backend == "asyncpg":
+        from database_asyncpg import AsyncpgDatabase
+        database = AsyncpgDatabase()
+    else:
+        if backend != "psycopg2":
+            logger.warning(f"⚠️ Неизвестный DB_BACKEND={backend}, используется psycopg2")
+        database = Database()
+
+    if os.getenv("DB_CACHE", "1").lower() in ("1", "true", "yes"):
+        from db_cache import CachedDatabase
+        database = CachedDatabase(database)
+    return database
 
 # Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+db = create_database()
@@ -0,0 +1,186 @@
+"""
+Асинхронный бэкенд базы данных на asyncpg.
+
+Включается переменной окружения DB_BACKEND=asyncpg. Публичные методы
+те же, что у database.Database: переопределены только примитивы
+запросов, поэтому SQL пишется один раз и не ходит через ThreadPoolExecutor.
+"""
+import asyncio
+import os
+import re
+import time
+import logging
+from typing import Dict, List, Optional
+
+from database import Database, DB_EXECUTOR_WORKERS
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+_PLACEHOLDER_RE = re.compile(r'%s')
+
+def to_asyncpg_query(query: str) -> str:
+    """Перевод плейсхолдеров psycopg2 (%s) в нумерованные $1, $2, ..."""
+    counter = iter(range(1, 10_000))
+    return _PLACEHOLDER_RE.sub(lambda _: f"${next(counter)}", query)
+
+class AsyncpgDatabase(Database):
+    """Database поверх нативного asyncpg пула"""
+
+    def __init__(self):
+        super().__init__()
+        if asyncpg is None:
+            raise RuntimeError("DB_BACKEND=asyncpg требует пакет: pip install asyncpg")
+        self._queries: Dict[str, str] = {}
+
+    def build_connect_kwargs(self) -> Dict:
+        """Параметры подключения для asyncpg (он не понимает libpq-строку вида host=... port=...)"""
+        db_url = os.getenv("DATABASE_URL")
+        if db_url:
+            return {'dsn': db_url}
+
+        # Проверка обязательных переменных та же, что и для psycopg2
+        self.build_dsn_from_env()
+        kwargs = {
+            'host': os.getenv("PGHOST") or os.getenv("POSTGRES_HOST"),
+            'port': int(os.getenv("PGPORT") or os.getenv("POSTGRES_PORT") or "5432"),
+            'database': os.getenv("PGDATABASE") or os.getenv("POSTGRES_DB"),
+            'user': os.getenv("PGUSER") or os.getenv("POSTGRES_USER"),
+            'password': os.getenv("PGPASSWORD") or os.getenv("POSTGRES_PASSWORD"),
+        }
+        sslmode = os.getenv("PGSSLMODE")
+        if sslmode:
+            kwargs['ssl'] = sslmode
+        return kwargs
+
+    async def init_db(self):
+        """Инициализация пула asyncpg"""
+        if self.pool is not None:
+            return
+        try:
+            pool_size = int(os.getenv("DB_POOL_SIZE", str(DB_EXECUTOR_WORKERS)))
+            # Без executor-а узким местом становится только пул, поэтому по умолчанию он шире
+            max_size = int(os.getenv("ASYNCPG_POOL_MAX_SIZE", str(pool_size * 2)))
+            self.pool = await asyncpg.create_pool(
+                min_size=1,
+                max_size=max_size,
+                **self.build_connect_kwargs()
+            )
+            logger.info(f"✅ Пул asyncpg к PostgreSQL создан ({max_size} соединений)")
+
+            await self.create_tables()
+        except Exception as e:
+            logger.error(f"❌ Ошибка подключения к базе данных (asyncpg): {e}")
+            raise
+
+    def close(self):
+        """Закрытие пула (сбрасывает соединения без ожидания)"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    async def aclose(self):
+        """Корректное закрытие пула с ожиданием активных запросов"""
+        if self.pool is not None:
+            await self.flush_message_log()
+            await self.pool.close()
+            self.pool = None
+
+    def _query(self, query: str) -> str:
+        """Кэш перевода плейсхолдеров — запросы одни и те же"""
+        converted = self._queries.get(query)
+        if converted is None:
+            converted = to_asyncpg_query(query)
+            self._queries[query] = converted
+        return converted
+
+    def _check_pool(self):
+        if self.pool is None:
+            raise RuntimeError("База данных не инициализирована (вызовите init_db)")
+
+    async def _fetch(self, query: str, params: tuple = ()) -> List[Dict]:
+        self._check_pool()
+        rows = await self.pool.fetch(self._query(query), *params)
+        return [dict(row) for row in rows]
+
+    async def _fetchrow(self, query: str, params: tuple = ()) -> Optional[Dict]:
+        self._check_pool()
+        row = await self.pool.fetchrow(self._query(query), *params)
+        return dict(row) if row else None
+
+    async def _execute(self, query: str, params: tuple = ()) -> None:
+        self._check_pool()
+        await self.pool.execute(self._query(query), *params)
+
+    async def _execute_locked(self, lock_key: int, statements: List) -> None:
+        self._check_pool()
+        async with self.pool.acquire() as conn:
+            await conn.execute('SELECT pg_advisory_lock($1)', lock_key)
+            try:
+                for statement in statements:
+                    query, params = statement if isinstance(statement, tuple) else (statement, ())
+                    await conn.execute(self._query(query), *params)
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', lock_key)
+
+    async def insert_messages(self, rows: List[tuple]):
+        self._check_pool()
+        await self.pool.executemany(self._query('''
+            INSERT INTO messages (user_id, session_id, user_message, bot_response, message_type, label_source, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        '''), rows)
+
+# ===== БЕНЧМАРК =====
+# Сравнение бэкендов на пути обработки сообщения (то, что делает BusinessBot.handle_message
+# вокруг вызова LLM): save_user -> get_user_recent_messages -> get_or_create_user_chat_session -> log_message.
+# Запускать на тестовой базе: python database_asyncpg.py [кол-во сообщений] [параллельность]
+
+async def _bench_backend(database: Database, messages: int, concurrency: int) -> Dict:
+    await database.init_db()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one_message(i: int):
+        user_id = f"bench_{i % 50}"
+        async with semaphore:
+            started = time.perf_counter()
+            await database.save_user(user_id, "bench", "Bench", "User")
+            await database.get_user_recent_messages(user_id, limit=20)
+            session_id = await database.get_or_create_user_chat_session(user_id)
+            await database.log_message(user_id, session_id, "привет", "ответ", "general")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_message(i) for i in range(messages)))
+    total = time.perf_counter() - started
+    await database.flush_message_log()
+
+    if isinstance(database, AsyncpgDatabase):
+        await database.aclose()
+    else:
+        database.close()
+
+    latencies.sort()
+    return {
+        'throughput': messages / total,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+if __name__ == "__main__":
+    import sys
+
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+    async def run_benchmark():
+        print(f"🏁 {messages} сообщений, параллельность {concurrency}")
+        for name, database in [('psycopg2', Database()), ('asyncpg', AsyncpgDatabase())]:
+            result = await _bench_backend(database, messages, concurrency)
+            print(f"{name:>9}: {result['throughput']:.0f} msg/s, p50 {result['p50_ms']:.1f} мс, p99 {result['p99_ms']:.1f} мс")
+
+    asyncio.run(run_benchmark())
@@ -0,0 +1,312 @@
+"""
+Кэш-прослойка (cache-aside) перед Database для горячих запросов пути сообщения.
+
+- save_user: upsert пропускается, если профиль пользователя не изменился;
+- get_user_businesses: список активных бизнесов пользователя;
+- get_business_history(limit <= LATEST_SNAPSHOT_ROWS): последние снимки бизнеса (по проекциям);
+- get_business_rollup: сводка бизнеса (последний и предыдущий снимок, суммы).
+
+Записи через ту же прослойку (create_business, add_business_snapshot,
+soft_delete_business, save_business_analysis) сбрасывают затронутые ключи.
+Каждое значение живёт не дольше DB_CACHE_TTL: другие процессы пишут в БД мимо
+этого кэша. Остальные методы и атрибуты прозрачно проксируются к Database.
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DB_CACHE_TTL = float(os.getenv("DB_CACHE_TTL", "300"))
+DB_CACHE_MAX_ENTRIES = int(os.getenv("DB_CACHE_MAX_ENTRIES", "10000"))
+
+# Столько последних снимков кэшируется на бизнес: limit=1 (карточка) и limit=2 (динамика)
+LATEST_SNAPSHOT_ROWS = 2
+
+class _LRU:
+    """
+    LRU с TTL; ответ, начатый до инвалидации, в кэш не попадает. Чтение берёт отметку общего
+    счётчика (generation), инвалидация запоминает для ключа новое значение счётчика. Журнал
+    инвалидаций ограничен: при переполнении он очищается, а отметки старше очистки отклоняются.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()
+        self._clock = 0
+        # ключ -> значение счётчика при последней инвалидации
+        self._invalidated: Dict[object, int] = {}
+        # Отметки чтения меньше этой — из времени до очистки журнала
+        self._floor = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def generation(self, key) -> int:
+        """Отметка перед чтением из БД; передаётся в set"""
+        return self._clock
+
+    def set(self, key, value, generation: int = None):
+        if generation is not None and (generation < self._floor or self._invalidated.get(key, 0) > generation):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self._clock += 1
+        if len(self._invalidated) >= self.max_entries:
+            self._invalidated.clear()
+            self._floor = self._clock
+        self._invalidated[key] = self._clock
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+def _copy_rows(rows: List[Dict]) -> List[Dict]:
+    # Вызывающий код может менять строки — кэш отдаёт копии
+    return [dict(row) for row in rows]
+
+class CachedDatabase:
+    """Прокси над Database с кэшем пользователей, списков бизнесов и последних снимков"""
+
+    def __init__(self, database, ttl: float = None, max_entries: int = None):
+        self._db = database
+        ttl = ttl or DB_CACHE_TTL
+        max_entries = max_entries or DB_CACHE_MAX_ENTRIES
+        self._users = _LRU(max_entries, ttl)
+        self._businesses = _LRU(max_entries, ttl)
+        self._snapshots = _LRU(max_entries, ttl)
+        self._rollups = _LRU(max_entries, ttl)
+        self.stats = {
+            'user_upserts_skipped': 0,
+            'user_upserts': 0,
+            'businesses_hits': 0,
+            'businesses_misses': 0,
+            'snapshots_hits': 0,
+            'snapshots_misses': 0,
+            'snapshots_bypassed': 0,
+            'rollups_hits': 0,
+            'rollups_misses': 0,
+            'invalidations': 0,
+            'db_ms_total': 0.0,
+            'db_calls': 0,
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    async def _timed(self, awaitable):
+        """Запрос к БД с учётом времени: по среднему оцениваем сэкономленное попаданиями"""
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.stats['db_ms_total'] += (time.perf_counter() - started) * 1000
+            self.stats['db_calls'] += 1
+
+    # ===== ЧТЕНИЕ =====
+
+    async def save_user(self, user_id: str, username: str, first_name: str, last_name: str):
+        profile = (username, first_name, last_name)
+        if self._users.get(user_id) == profile:
+            self.stats['user_upserts_skipped'] += 1
+            return
+        generation = self._users.generation(user_id)
+        await self._timed(self._db.save_user(user_id, username, first_name, last_name))
+        self.stats['user_upserts'] += 1
+        self._users.set(user_id, profile, generation)
+
+    async def get_user_businesses(self, user_id: str) -> List[Dict]:
+        cached = self._businesses.get(user_id)
+        if cached is not None:
+            self.stats['businesses_hits'] += 1
+            return _copy_rows(cached)
+        self.stats['businesses_misses'] += 1
+        generation = self._businesses.generation(user_id)
+        rows = await self._timed(self._db.get_user_businesses(user_id))
+        self._businesses.set(user_id, _copy_rows(rows), generation)
+        return rows
+
+    async def get_business_history(self, business_id: int, limit: int = 12, columns='all') -> List[Dict]:
+        if limit > LATEST_SNAPSHOT_ROWS:
+            self.stats['snapshots_bypassed'] += 1
+            return await self._db.get_business_history(business_id, limit=limit, columns=columns)
+        # Для бизнеса хранится по списку строк на каждую запрошенную проекцию
+        projection = columns if isinstance(columns, str) else tuple(columns)
+        cached = self._snapshots.get(business_id)
+        if cached is not None and projection in cached:
+            self.stats['snapshots_hits'] += 1
+            return _copy_rows(cached[projection][:limit])
+        self.stats['snapshots_misses'] += 1
+        generation = self._snapshots.generation(business_id)
+        rows = await self._timed(self._db.get_business_history(
+            business_id, limit=LATEST_SNAPSHOT_ROWS, columns=columns
+        ))
+        projections = dict(self._snapshots.get(business_id) or {})
+        projections[projection] = _copy_rows(rows)
+        self._snapshots.set(business_id, projections, generation)
+        return rows[:limit]
+
+    async def get_business_rollup(self, business_id: int) -> Optional[Dict]:
+        cached = self._rollups.get(business_id)
+        if cached is not None:
+            self.stats['rollups_hits'] += 1
+            return dict(cached)
+        self.stats['rollups_misses'] += 1
+        generation = self._rollups.generation(business_id)
+        rollup = await self._timed(self._db.get_business_rollup(business_id))
+        # Отсутствие сводки не кэшируется: первый снимок должен быть виден сразу
+        if rollup is not None:
+            self._rollups.set(business_id, dict(rollup), generation)
+        return rollup
+
+    # ===== ЗАПИСЬ (с инвалидацией) =====
+
+    def _invalidate(self, cache: _LRU, key):
+        cache.invalidate(key)
+        self.stats['invalidations'] += 1
+
+    async def create_business(self, user_id: str, name: str, business_type: str = "general") -> int:
+        try:
+            return await self._db.create_business(user_id, name, business_type)
+        finally:
+            self._invalidate(self._businesses, user_id)
+
+    async def add_business_snapshot(self, business_id: int, *args, **kwargs) -> int:
+        try:
+            return await self._db.add_business_snapshot(business_id, *args, **kwargs)
+        finally:
+            self._invalidate(self._snapshots, business_id)
+            self._invalidate(self._rollups, business_id)
+
+    async def soft_delete_business(self, user_id: str, business_id: int) -> None:
+        try:
+            await self._db.soft_delete_business(user_id, business_id)
+        finally:
+            self._invalidate(self._businesses, user_id)
+            self._invalidate(self._snapshots, business_id)
+            self._invalidate(self._rollups, business_id)
+
+    async def save_business_analysis(self, user_id: str, business_data: Dict):
+        # Внутри Database создаёт бизнес и снимок в обход прослойки
+        try:
+            await self._db.save_business_analysis(user_id, business_data)
+        finally:
+            self._invalidate(self._businesses, user_id)
+
+    def get_cache_stats(self) -> Dict:
+        """Попадания кэша и оценка сэкономленного времени БД"""
+        hits = (self.stats['user_upserts_skipped'] + self.stats['businesses_hits']
+                + self.stats['snapshots_hits'] + self.stats['rollups_hits'])
+        misses = (self.stats['user_upserts'] + self.stats['businesses_misses']
+                  + self.stats['snapshots_misses'] + self.stats['rollups_misses'])
+        avg_db_ms = self.stats['db_ms_total'] / self.stats['db_calls'] if self.stats['db_calls'] else 0
+        return {
+            'users': len(self._users),
+            'business_lists': len(self._businesses),
+            'snapshot_entries': len(self._snapshots),
+            'rollup_entries': len(self._rollups),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0,
+            'avg_db_ms': round(avg_db_ms, 2),
+            'saved_db_ms': round(hits * avg_db_ms, 1),
+            **{key: value for key, value in self.stats.items() if key not in ('db_ms_total', 'db_calls')},
+        }
+
+if __name__ == "__main__":
+    import asyncio
+
+    class _FakeDatabase:
+        """Имитация Database с задержкой запроса"""
+
+        def __init__(self):
+            self.queries = 0
+            self.snapshots = {1: [{'snapshot_id': 1, 'revenue': 100}]}
+
+        async def _query(self):
+            self.queries += 1
+            await asyncio.sleep(0.002)
+
+        async def save_user(self, *args):
+            await self._query()
+
+        async def get_user_businesses(self, user_id):
+            await self._query()
+            return [{'business_id': 1, 'business_name': 'Кофейня'}]
+
+        async def get_business_history(self, business_id, limit=12, columns='all'):
+            await self._query()
+            return self.snapshots.get(business_id, [])[:limit]
+
+        async def get_business_rollup(self, business_id):
+            await self._query()
+            history = self.snapshots.get(business_id)
+            return {'business_id': business_id, 'revenue': history[0]['revenue'], 'snapshot_count': len(history)} if history else None
+
+        async def add_business_snapshot(self, business_id, raw_data, metrics):
+            await self._query()
+            self.snapshots[business_id].insert(0, {'snapshot_id': 2, 'revenue': raw_data['revenue']})
+            return 2
+
+    async def main():
+        fake = _FakeDatabase()
+        cached = CachedDatabase(fake)
+        for _ in range(10):
+            await cached.save_user("u1", "name", "Имя", "Фамилия")
+            await cached.get_user_businesses("u1")
+            await cached.get_business_history(1, limit=1)
+        assert fake.queries == 3, f"повторные обращения дошли до БД: {fake.queries}"
+
+        await cached.save_user("u1", "new_name", "Имя", "Фамилия")
+        assert fake.queries == 4, "изменённый профиль не сохранён"
+
+        (await cached.get_business_history(1, limit=1))[0]['revenue'] = -1
+        assert (await cached.get_business_history(1, limit=1))[0]['revenue'] == 100, "кэш отдаёт общие объекты"
+
+        # Ответ, начатый до инвалидации, не должен вернуть устаревшие данные в кэш
+        cached._snapshots.invalidate(1)
+        read = asyncio.create_task(cached.get_business_history(1, limit=1))
+        await asyncio.sleep(0)
+        cached._snapshots.invalidate(1)
+        await read
+        assert cached._snapshots.get(1) is None, "устаревший ответ попал в кэш после инвалидации"
+
+        # Инвалидации ключей, которых нет в кэше, не копятся
+        small = _LRU(max_entries=10, ttl=60)
+        for key in range(1000):
+            small.invalidate(key)
+        assert len(small._invalidated) <= 10, "журнал инвалидаций растёт без предела"
+        ticket = small.generation(5)
+        for key in range(100, 120):
+            small.invalidate(key)
+        small.set(5, "устаревшее", ticket)
+        assert small.get(5) is None, "чтение до очистки журнала попало в кэш"
+
+        await cached.add_business_snapshot(1, {'revenue': 200}, {})
+        latest = await cached.get_business_history(1, limit=1)
+        assert latest[0]['revenue'] == 200, "снимок не сбросил кэш"
+
+        queries = fake.queries
+        for _ in range(5):
+            rollup = await cached.get_business_rollup(1)
+        assert fake.queries == queries + 1 and rollup['snapshot_count'] == 2, "сводка не закэширована"
+        await cached.add_business_snapshot(1, {'revenue': 300}, {})
+        assert (await cached.get_business_rollup(1))['revenue'] == 300, "снимок не сбросил сводку"
+        print(cached.get_cache_stats())
+
+    asyncio.run(main())
@@ -0,0 +1,160 @@
+"""
+Проверка планов горячих запросов (EXPLAIN) на засеянных данных.
+
+Скрипт создаёт в тестовой базе (DATABASE_URL / PG*) временную схему, разворачивает в ней
+SCHEMA_STATEMENTS и MIGRATIONS, засевает данные и снимает EXPLAIN с тех запросов, которые
+на самом деле выполняют методы Database (SQL перехватывается, а не копируется сюда).
+Для каждого запроса проверяется, что большие таблицы читаются по индексу, а не Seq Scan.
+Схема удаляется в конце.
+
+Запуск: python explain_check.py [кол-во пользователей]
+"""
+import asyncio
+import json
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from database import Database, SCHEMA_STATEMENTS, MIGRATIONS, REBUILD_BUSINESS_ROLLUPS
+
+class _RecordingDatabase(Database):
+    """Database, который не ходит в БД, а запоминает SELECT-запросы своих методов"""
+
+    def __init__(self):
+        super().__init__()
+        self.queries: List[Tuple[str, tuple]] = []
+
+    def _record(self, query: str, params: tuple):
+        if query.lstrip().upper().startswith(('SELECT', 'WITH')):
+            self.queries.append((query, params))
+
+    async def _fetch(self, query: str, params: tuple = ()) -> List[Dict]:
+        self._record(query, params)
+        return []
+
+    async def _fetchrow(self, query: str, params: tuple = ()):
+        self._record(query, params)
+        # Любой столбец найден: методы вроде get_or_create_user_chat_session идут по "горячей" ветке
+        return defaultdict(int)
+
+    async def _execute(self, query: str, params: tuple = ()) -> None:
+        self._record(query, params)
+
+# (название, вызов метода Database, таблицы, которые нельзя читать Seq Scan)
+HOT_QUERIES = [
+    ('get_business_history', lambda d: d.get_business_history(42, limit=12), {'business_snapshots'}),
+    ('get_business_history limit=1', lambda d: d.get_business_history(42, limit=1), {'business_snapshots'}),
+    ('get_user_businesses', lambda d: d.get_user_businesses('user_42'), {'businesses'}),
+    ('get_or_create_user_chat_session', lambda d: d.get_or_create_user_chat_session('user_42'), {'conversation_sessions'}),
+    ('get_latest_conversation_session', lambda d: d.get_latest_conversation_session('user_42'), {'conversation_sessions'}),
+    ('get_user_recent_messages', lambda d: d.get_user_recent_messages('user_42', limit=20), {'messages'}),
+    ('get_classified_messages', lambda d: d.get_classified_messages(
+        limit=500, label_sources=['llm'], message_types=['conversation', 'user_input']), {'messages'}),
+    ('get_advice', lambda d: d.get_advice(), {'business_snapshots'}),
+    ('get_snapshots_after', lambda d: d.get_snapshots_after(1000, ['business_id', 'roi']), {'business_snapshots'}),
+    ('get_business_rollup', lambda d: d.get_business_rollup(42), {'business_rollups'}),
+]
+
+def seed_statements(users: int) -> List[str]:
+    """Данные с пропорциями живой базы: ~3 бизнеса, ~30 снимков, ~5 сессий и ~100 сообщений на пользователя"""
+    businesses, snapshots, sessions, messages = users * 3, users * 30, users * 5, users * 100
+    return [
+        f"""
+        INSERT INTO users (user_id, username, first_name)
+        SELECT 'user_' || g, 'u' || g, 'Пользователь' FROM generate_series(1, {users}) g
+        """,
+        f"""
+        INSERT INTO businesses (user_id, business_name, business_type, is_active)
+        SELECT 'user_' || (g % {users} + 1), 'Бизнес ' || g, 'general', g % 10 <> 0
+        FROM generate_series(1, {businesses}) g
+        """,
+        f"""
+        INSERT INTO business_snapshots (business_id, period_type, period_date, revenue, advice1, created_at)
+        SELECT g % {businesses} + 1, 'monthly', CURRENT_DATE, g,
+               CASE WHEN g % 20 = 0 THEN 'совет' ELSE '' END,
+               NOW() - (g || ' minutes')::interval
+        FROM generate_series(1, {snapshots}) g
+        """,
+        f"""
+        INSERT INTO conversation_sessions (user_id, current_state, collected_data, updated_at)
+        SELECT 'user_' || (g % {users} + 1),
+               CASE WHEN g % 3 = 0 THEN 'chat' ELSE 'completed' END, '{{}}',
+               NOW() - (g || ' minutes')::interval
+        FROM generate_series(1, {sessions}) g
+        """,
+        f"""
+        INSERT INTO messages (user_id, session_id, user_message, bot_response, message_type, created_at)
+        SELECT cs.user_id, cs.session_id, 'сообщение ' || g, 'ответ', 'general',
+               NOW() - (g || ' seconds')::interval
+        FROM generate_series(1, {messages}) g
+        JOIN conversation_sessions cs ON cs.session_id = g % {sessions} + 1
+        """,
+        # Сводки по засеянным снимкам (миграция выполнялась на пустой таблице)
+        REBUILD_BUSINESS_ROLLUPS,
+        "ANALYZE",
+    ]
+
+def plan_nodes(plan: Dict):
+    """Все узлы плана (обход в глубину)"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+async def collect_queries() -> List[Tuple[str, str, tuple, set]]:
+    collected = []
+    for name, call, forbidden in HOT_QUERIES:
+        recorder = _RecordingDatabase()
+        await call(recorder)
+        for query, params in recorder.queries:
+            collected.append((name, query, params, forbidden))
+    return collected
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    schema = f"explain_check_{os.getpid()}"
+    queries = asyncio.run(collect_queries())
+
+    conn = psycopg2.connect(Database().build_dsn_from_env(), cursor_factory=RealDictCursor)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    failures = 0
+    try:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(f"SET search_path TO {schema}")
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+        for _, _, statements in MIGRATIONS:
+            for statement in statements:
+                cursor.execute(statement)
+        print(f"🌱 Засеваю данные: {users} пользователей, {users * 100} сообщений...")
+        for statement in seed_statements(users):
+            cursor.execute(statement)
+
+        for name, query, params, forbidden in queries:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+            plan_json = cursor.fetchone()['QUERY PLAN']
+            plan = (json.loads(plan_json) if isinstance(plan_json, str) else plan_json)[0]['Plan']
+            nodes = list(plan_nodes(plan))
+            seq_scans = sorted({node['Relation Name'] for node in nodes
+                                if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in forbidden})
+            indexes = sorted({node['Index Name'] for node in nodes if node.get('Index Name')})
+            if seq_scans:
+                failures += 1
+                print(f"❌ {name}: Seq Scan по {', '.join(seq_scans)}")
+            else:
+                print(f"✅ {name}: {', '.join(indexes) or 'без индексов'} (стоимость {plan['Total Cost']:.0f})")
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.close()
+
+    if failures:
+        print(f"❌ Запросов без индекса: {failures}")
+        sys.exit(1)
+    print("✅ Все горячие запросы используют индексы")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Ограниченное хранилище истории диалогов для LLM (ai.conversation_memory).
+
+Для каждого пользователя держится deque последних реплик фиксированной длины.
+Пользователи вытесняются по LRU: при простое дольше HISTORY_TTL, при превышении
+HISTORY_MAX_USERS или потолка памяти HISTORY_MAX_BYTES. Вытесненная история
+не теряется — при следующем обращении она лениво подгружается из таблицы messages.
+"""
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "12"))
+HISTORY_MAX_USERS = int(os.getenv("HISTORY_MAX_USERS", "10000"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", str(6 * 3600)))
+
+# Сколько строк messages читать при подгрузке (часть из них — реплики без ответа бота)
+_REHYDRATE_ROWS = 20
+
+# Приблизительная цена одной реплики сверх самой строки: кортеж (role, content) и слот deque
+_MESSAGE_OVERHEAD = 64
+
+def _message_size(content: str) -> int:
+    return sys.getsizeof(content) + _MESSAGE_OVERHEAD
+
+class _UserHistory:
+    __slots__ = ('messages', 'size', 'touched_at')
+
+    def __init__(self, max_messages: int):
+        self.messages: Deque[Tuple[str, str]] = deque(maxlen=max_messages)
+        self.size = 0
+        self.touched_at = time.monotonic()
+
+class ConversationHistoryStore:
+    """История реплик пользователей с LRU/TTL-вытеснением и потолком памяти"""
+
+    def __init__(self, max_messages: int = None, max_users: int = None,
+                 max_bytes: int = None, ttl: int = None):
+        self.max_messages = max_messages or HISTORY_MAX_MESSAGES
+        self.max_users = max_users or HISTORY_MAX_USERS
+        self.max_bytes = max_bytes or HISTORY_MAX_BYTES
+        self.ttl = ttl or HISTORY_TTL
+
+        self._users: "OrderedDict[str, _UserHistory]" = OrderedDict()
+        self._bytes = 0
+
+        self.stats = {
+            'hits': 0,
+            'rehydrated': 0,
+            'evicted_ttl': 0,
+            'evicted_lru': 0,
+            'evicted_memory': 0,
+        }
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _touch(self, user_id: str) -> _UserHistory:
+        history = self._users.get(user_id)
+        if history is None:
+            history = _UserHistory(self.max_messages)
+            self._users[user_id] = history
+        else:
+            self._users.move_to_end(user_id)
+        history.touched_at = time.monotonic()
+        return history
+
+    def _append(self, history: _UserHistory, role: str, content: str):
+        if len(history.messages) == history.messages.maxlen:
+            _, dropped = history.messages[0]
+            history.size -= _message_size(dropped)
+            self._bytes -= _message_size(dropped)
+        history.messages.append((role, content))
+        history.size += _message_size(content)
+        self._bytes += _message_size(content)
+
+    def _drop(self, user_id: str):
+        history = self._users.pop(user_id, None)
+        if history is not None:
+            self._bytes -= history.size
+
+    def _evict(self):
+        """Вытеснение с головы LRU: сначала простаивающие, затем сверх лимитов"""
+        expire_before = time.monotonic() - self.ttl
+        while self._users:
+            user_id, history = next(iter(self._users.items()))
+            if history.touched_at < expire_before:
+                self.stats['evicted_ttl'] += 1
+            elif len(self._users) > self.max_users:
+                self.stats['evicted_lru'] += 1
+            elif self._bytes > self.max_bytes and len(self._users) > 1:
+                self.stats['evicted_memory'] += 1
+            else:
+                break
+            self._drop(user_id)
+
+    async def ensure_loaded(self, user_id: str):
+        """Подгрузка истории из messages, если пользователя нет в памяти (новый или вытесненный)"""
+        if user_id in self._users:
+            self.stats['hits'] += 1
+            self._touch(user_id)
+            return
+
+        rows = []
+        try:
+            from database import db
+            rows = await db.get_user_recent_messages(user_id, limit=_REHYDRATE_ROWS)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить историю пользователя {user_id} из БД: {e}")
+
+        # Пока шёл запрос, история могла появиться (параллельная реплика) — она свежее
+        if user_id in self._users:
+            return
+
+        history = self._touch(user_id)
+        for row in rows:
+            if row.get('user_message'):
+                self._append(history, "user", row['user_message'])
+            if row.get('bot_response'):
+                self._append(history, "assistant", row['bot_response'])
+        self.stats['rehydrated'] += 1
+        self._evict()
+
+    def get_messages(self, user_id: str) -> List[Dict]:
+        """История пользователя в формате сообщений LLM (от старых к новым)"""
+        history = self._users.get(user_id)
+        if history is None:
+            return []
+        self._users.move_to_end(user_id)
+        history.touched_at = time.monotonic()
+        return [{"role": role, "content": content} for role, content in history.messages]
+
+    def append_turn(self, user_id: str, user_message: str, response: str):
+        """Запись реплики пользователя и ответа; старые реплики выпадают из deque сами"""
+        history = self._touch(user_id)
+        self._append(history, "user", user_message)
+        self._append(history, "assistant", response)
+        self._evict()
+
+    def pop(self, user_id: str, default=None):
+        history = self._users.get(user_id)
+        self._drop(user_id)
+        return history if history is not None else default
+
+    def get_stats(self) -> Dict:
+        """Метрики: резидентные пользователи, занятая память, вытеснения"""
+        return {
+            'resident_users': len(self._users),
+            'resident_bytes': self._bytes,
+            'max_users': self.max_users,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            **self.stats,
+        }
+
+if __name__ == "__main__":
+    store = ConversationHistoryStore(max_messages=4, max_users=3, max_bytes=10_000, ttl=60)
+    for i in range(5):
+        store.append_turn(f"user_{i}", "вопрос " * 10, "ответ " * 20)
+    assert len(store) == 3 and "user_0" not in store, "LRU не вытесняет лишних пользователей"
+
+    for _ in range(5):
+        store.append_turn("user_4", "ещё вопрос", "ещё ответ")
+    assert len(store.get_messages("user_4")) == 4, "deque не ограничивает историю"
+
+    store.append_turn("big", "x" * 20_000, "y")
+    assert store.get_stats()['resident_bytes'] <= 10_000 or len(store) == 1, "потолок памяти не соблюдается"
+
+    recomputed = sum(h.size for h in store._users.values())
+    assert recomputed == store._bytes, "учёт байтов разошёлся"
+    print(store.get_stats())
@@ -0,0 +1,164 @@
+"""
+Кэш ответов LLM по содержимому запроса.
+
+Ключ — sha256 от (тип промпта, модель, сообщения с нормализованным текстом). Для извлечения
+данных нормализуются только пробелы: ответ содержит название бизнеса в написании пользователя.
+Два уровня: LRU в памяти процесса и, при LLM_CACHE_PERSISTENT=1, таблица
+llm_cache в PostgreSQL (переживает рестарты и общая для инстансов).
+Кэшируются только детерминированные типы промптов — классификация,
+извлечение данных и анализ недостающих данных; чат и ответы на вопросы — никогда.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# TTL по типу промпта, секунды (переопределяются LLM_CACHE_TTL_<ТИП>)
+LLM_CACHE_TTLS = {
+    'classification': 7 * 24 * 3600,
+    'extraction': 24 * 3600,
+    'missing_data': 3600,
+}
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2000"))
+LLM_CACHE_PERSISTENT = os.getenv("LLM_CACHE_PERSISTENT", "0").lower() in ("1", "true", "yes")
+
+# Раз в столько записей в постоянный кэш удаляем просроченные строки
+_PURGE_EVERY = 500
+
+# Промпты, ответ которых повторяет текст пользователя (название бизнеса) — регистр и ё значимы
+CASE_SENSITIVE_PROMPTS = {'extraction'}
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_whitespace(text: str) -> str:
+    return _WHITESPACE_RE.sub(' ', str(text)).strip()
+
+def normalize_text(text: str) -> str:
+    """Регистр и пробелы не меняют ответ детерминированных промптов"""
+    return normalize_whitespace(str(text).lower().replace('ё', 'е'))
+
+def _model_name(model) -> str:
+    return getattr(model, 'name', None) or str(model)
+
+class LLMCache:
+    """Двухуровневый кэш: LRU с TTL в памяти + необязательная таблица в PostgreSQL"""
+
+    def __init__(self, max_entries: int = None, ttls: Dict[str, int] = None, persistent: bool = None):
+        self.max_entries = max_entries or LLM_CACHE_SIZE
+        self.ttls = dict(ttls or {
+            prompt_type: int(os.getenv(f"LLM_CACHE_TTL_{prompt_type.upper()}", str(default)))
+            for prompt_type, default in LLM_CACHE_TTLS.items()
+        })
+        self.persistent = LLM_CACHE_PERSISTENT if persistent is None else persistent
+
+        # key -> (expires_at по time.monotonic(), ответ)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._writes: Set[asyncio.Task] = set()
+        self._persisted = 0
+
+        self.stats = {
+            'memory_hits': 0,
+            'persistent_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
+
+    def is_cacheable(self, prompt_type: str) -> bool:
+        return prompt_type in self.ttls
+
+    @staticmethod
+    def make_key(prompt_type: str, model, messages: List[Dict]) -> str:
+        normalize = normalize_whitespace if prompt_type in CASE_SENSITIVE_PROMPTS else normalize_text
+        payload = json.dumps(
+            [prompt_type, _model_name(model),
+             [(m.get('role'), normalize(m.get('content', ''))) for m in messages]],
+            ensure_ascii=False, separators=(',', ':')
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str, prompt_type: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return response
+            del self._entries[key]
+            self.stats['expired'] += 1
+
+        if self.persistent:
+            try:
+                from database import db
+                row = await db.get_llm_cache(key)
+            except Exception as e:
+                logger.warning(f"Кэш LLM в БД недоступен: {e}")
+                row = None
+            if row is not None:
+                # В памяти запись живет не дольше строки в БД
+                self._remember(key, prompt_type, row['response'], row['ttl_seconds'])
+                self.stats['persistent_hits'] += 1
+                return row['response']
+
+        self.stats['misses'] += 1
+        return None
+
+    async def set(self, key: str, prompt_type: str, response: str):
+        if not response or not response.strip():
+            return
+        self._remember(key, prompt_type, response)
+        if self.persistent:
+            # Запись в БД не задерживает ответ пользователю
+            task = asyncio.create_task(self._persist(key, prompt_type, response))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def _remember(self, key: str, prompt_type: str, response: str, ttl: float = None):
+        ttl = self.ttls[prompt_type] if ttl is None else min(float(ttl), self.ttls[prompt_type])
+        self._entries[key] = (time.monotonic() + ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    async def _persist(self, key: str, prompt_type: str, response: str):
+        try:
+            from database import db
+            await db.set_llm_cache(key, prompt_type, response, self.ttls[prompt_type])
+            self._persisted += 1
+            if self._persisted % _PURGE_EVERY == 0:
+                await db.purge_llm_cache()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ответ LLM в кэш БД: {e}")
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        """Счётчики попаданий и промахов"""
+        hits = self.stats['memory_hits'] + self.stats['persistent_hits']
+        lookups = hits + self.stats['misses']
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'persistent': self.persistent,
+            'hits': hits,
+            'memory_hits': self.stats['memory_hits'],
+            'persistent_hits': self.stats['persistent_hits'],
+            'misses': self.stats['misses'],
+            'hit_rate': round(hits / lookups, 3) if lookups else 0,
+            'expired': self.stats['expired'],
+            'evicted': self.stats['evicted'],
+        }
+
+# Глобальный экземпляр кэша
+llm_cache = LLMCache()
@@ -3,7 +3,7 @@ import os
 import threading
 from dotenv import load_dotenv
 from tgbot import BusinessBot
-from WEBSite import app
+from WEBSite import app, run_on_loop
 from env_utils import setup_environment, is_production
 
 # Загружаем переменные окружения только локально
@@ -32,7 +32,8 @@ def run_web():
     
     # Вебхук теперь устанавливается внутри WEBSite.py при импорте
 
-    app.run(debug=False, host='0.0.0.0', port=port)
+    # Каждый запрос в своём потоке, async-часть выполняется на общем event loop из WEBSite
+    app.run(debug=False, host='0.0.0.0', port=port, threaded=True)
 
 if __name__ == "__main__":
     print("🚀 Запускаю приложение...")
@@ -47,6 +48,6 @@ if __name__ == "__main__":
         web_thread.start()
         print("🌐 Веб-сайт запущен в фоне")
         
-        # Запускаем бота в основном потоке
+        # Запускаем бота на том же event loop, что и веб-сайт: общий пул БД и одна точка планирования
         print("🤖 Запускаю бота (Polling)...")
-        asyncio.run(run_bot())
+        run_on_loop(run_bot())
@@ -0,0 +1,318 @@
+"""
+Локальный классификатор сообщений — быстрый путь перед LLM-классификацией.
+
+Наивный Байес по символьным n-граммам плюс веса ключевых слов. Модель стартует
+с небольшого встроенного корпуса и периодически дообучается на размеченных
+сообщениях из таблицы messages. Очевидные случаи решаются локально за доли
+миллисекунды, в LLM уходят только сообщения с уверенностью ниже порога.
+"""
+import asyncio
+import math
+import os
+import re
+import time
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LABELS = ('business_data', 'question', 'general')
+
+CLASSIFIER_CONFIDENCE = float(os.getenv("CLASSIFIER_CONFIDENCE", "0.85"))
+CLASSIFIER_RETRAIN_INTERVAL = int(os.getenv("CLASSIFIER_RETRAIN_INTERVAL", "3600"))
+CLASSIFIER_TRAINING_LIMIT = int(os.getenv("CLASSIFIER_TRAINING_LIMIT", "5000"))
+
+# Наивный Байес на перекрывающихся n-граммах сильно переуверен: считаем среднее
+# правдоподобие на n-грамму и умножаем на «эффективное число независимых признаков»
+EVIDENCE_SCALE = 6.0
+NGRAM_SIZES = (3, 4)
+
+# Веса ключевых слов (основы) в логарифмической шкале — добавляются к оценке метки
+KEYWORD_WEIGHTS = {
+    'business_data': {
+        'выручк': 1.5, 'доход': 1.0, 'прибыл': 0.8, 'расход': 1.2, 'трач': 1.0, 'затрат': 1.0,
+        'клиент': 0.8, 'продаю': 0.8, 'чек': 0.8, 'инвестиц': 0.8, 'оборот': 1.0,
+        'сотрудник': 0.6, 'помещени': 0.6, 'материал': 0.6, 'в месяц': 1.0, 'руб': 0.8,
+    },
+    'question': {
+        'как ': 1.0, 'почему': 1.2, 'зачем': 1.0, 'что лучше': 1.5, 'стоит ли': 1.5,
+        'подскаж': 1.2, 'посовет': 1.2, 'увелич': 0.8, 'улучш': 0.8, 'оптимиз': 0.8,
+        'снизит': 0.8, 'привлеч': 0.8, 'развит': 0.6, '?': 1.2,
+    },
+    'general': {
+        'привет': 1.5, 'здравств': 1.5, 'спасибо': 1.5, ' пока ': 1.0, 'добрый': 1.0,
+        'как дела': 1.5, ' ок': 0.5, 'отлично': 1.0, 'понятно': 1.0, 'кто ты': 1.5,
+    },
+}
+
+# Цифры вместе с бизнес-словами — почти наверняка бизнес-данные
+_NUMBER_RE = re.compile(r'\d')
+_DATA_NUMBER_BONUS = 2.0
+
+# Стартовый корпус: модель работает до первого обучения на логах
+SEED_EXAMPLES = [
+    ('business_data', "выручка 500к в месяц, расходы 300к"),
+    ('business_data', "у меня кофейня, выручка 800 тысяч, клиентов 1200"),
+    ('business_data', "доход 2 млн, затраты 1.5 млн, 40 сотрудников"),
+    ('business_data', "продаю детали по 3000 рублей, в месяц 200 штук"),
+    ('business_data', "трачу на маркетинг 50000 в месяц, средний чек 700"),
+    ('business_data', "оборот 10 млн в год, прибыль 2 млн"),
+    ('business_data', "аренда помещения 80 тыс, материалы 120 тыс"),
+    ('business_data', "инвестиции 1 млн, новых клиентов 150 в месяц"),
+    ('question', "как увеличить прибыль?"),
+    ('question', "почему падают продажи?"),
+    ('question', "что лучше: снизить цены или вложиться в рекламу?"),
+    ('question', "как привлечь новых клиентов в кофейню"),
+    ('question', "стоит ли нанимать еще одного сотрудника?"),
+    ('question', "подскажи, как оптимизировать расходы"),
+    ('question', "посоветуй стратегию развития малого бизнеса"),
+    ('question', "как повысить удержание клиентов?"),
+    ('general', "привет"),
+    ('general', "здравствуйте!"),
+    ('general', "спасибо большое"),
+    ('general', "как дела?"),
+    ('general', "кто ты такой"),
+    ('general', "отлично, понятно"),
+    ('general', "добрый вечер"),
+    ('general', "ок, пока"),
+]
+
+# Источник метки типа сообщения (messages.label_source). Для обучения берутся только метки LLM
+# и типы шагов диалога (FLOW_MESSAGE_TYPES) — собственные решения классификатора в выборку не попадают,
+# иначе он закреплял бы свои ошибки
+LABEL_SOURCE_LOCAL = 'local'
+LABEL_SOURCE_LLM = 'llm'
+LABEL_SOURCE_FALLBACK = 'fallback'
+
+# Типы из messages.message_type -> метка классификатора
+# (ответы в диалоге сбора данных считаем бизнес-данными, только если в них есть цифры)
+_LOGGED_TYPE_LABELS = {
+    'question': 'question',
+    'general': 'general',
+    'business_data': 'business_data',
+    'conversation': 'business_data',
+    'user_input': 'business_data',
+}
+# Типы, которые ставит сам диалог сбора данных, а не классификатор
+FLOW_MESSAGE_TYPES = ('conversation', 'user_input')
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace('ё', 'е')
+    text = _NUMBER_RE.sub('0', text)
+    return ' ' + re.sub(r'\s+', ' ', text).strip() + ' '
+
+def _ngrams(text: str) -> List[str]:
+    normalized = _normalize(text)
+    grams = []
+    for n in NGRAM_SIZES:
+        grams.extend(normalized[i:i + n] for i in range(len(normalized) - n + 1))
+    return grams
+
+class MessageClassifier:
+    """Наивный Байес по n-граммам с порогом уверенности и учётом экономии LLM-вызовов"""
+
+    def __init__(self, confidence: float = None, retrain_interval: int = None):
+        self.confidence = confidence if confidence is not None else CLASSIFIER_CONFIDENCE
+        self.retrain_interval = retrain_interval if retrain_interval is not None else CLASSIFIER_RETRAIN_INTERVAL
+
+        self._seed_counts: Dict[str, Counter] = {}
+        self._seed_docs: Counter = Counter()
+        self._counts: Dict[str, Counter] = {}
+        self._totals: Dict[str, int] = {}
+        self._docs: Counter = Counter()
+        self._vocabulary = 0
+        self._trained_at = 0.0
+        self._training_task: Optional[asyncio.Task] = None
+
+        self.stats = {
+            'local_hits': 0,
+            'escalations': 0,
+            'local_ms_total': 0.0,
+            'llm_ms_total': 0.0,
+            'training_examples': 0,
+        }
+
+        self._seed_counts, self._seed_docs = self._count(SEED_EXAMPLES)
+        self._install(*self._with_seed([]))
+
+    # ===== ОБУЧЕНИЕ =====
+
+    @staticmethod
+    def _count(examples: Iterable[Tuple[str, str]]) -> Tuple[Dict[str, Counter], Counter]:
+        counts = {label: Counter() for label in LABELS}
+        docs = Counter()
+        for label, text in examples:
+            counts[label].update(_ngrams(text))
+            docs[label] += 1
+        return counts, docs
+
+    def _install(self, counts: Dict[str, Counter], docs: Counter):
+        """Атомарная подмена модели (predict всегда видит согласованное состояние)"""
+        vocabulary = set()
+        for label_counts in counts.values():
+            vocabulary.update(label_counts)
+        self._counts = counts
+        self._totals = {label: sum(counts[label].values()) for label in LABELS}
+        self._docs = docs
+        self._vocabulary = len(vocabulary)
+
+    def _with_seed(self, examples: Iterable[Tuple[str, str]]) -> Tuple[Dict[str, Counter], Counter]:
+        """Счётчики выборки поверх стартового корпуса (копии — seed не меняется при learn)"""
+        counts, docs = self._count(examples)
+        for label in LABELS:
+            counts[label].update(self._seed_counts[label])
+        docs.update(self._seed_docs)
+        return counts, docs
+
+    def train(self, examples: Iterable[Tuple[str, str]]):
+        """Обучение на (метка, текст) поверх стартового корпуса"""
+        counts, docs = self._with_seed(examples)
+        self.stats['training_examples'] = sum(docs.values())
+        self._install(counts, docs)
+
+    def learn(self, text: str, label: str):
+        """Онлайн-дообучение на решении LLM по неуверенному сообщению"""
+        if label not in LABELS:
+            return
+        grams = _ngrams(text)
+        # Новые для всех меток n-граммы расширяют словарь сглаживания Лапласа
+        self._vocabulary += sum(
+            1 for gram in set(grams) if not any(gram in self._counts[other] for other in LABELS)
+        )
+        self._counts[label].update(grams)
+        self._totals[label] += len(grams)
+        self._docs[label] += 1
+
+    @staticmethod
+    def examples_from_rows(rows: List[Dict]) -> List[Tuple[str, str]]:
+        """Строки messages -> обучающие примеры"""
+        examples = []
+        for row in rows:
+            text = (row.get('user_message') or '').strip()
+            label = _LOGGED_TYPE_LABELS.get(row.get('message_type') or '')
+            if not text or label is None:
+                continue
+            if row.get('label_source') in (LABEL_SOURCE_LOCAL, LABEL_SOURCE_FALLBACK):
+                continue
+            if label == 'business_data' and not _NUMBER_RE.search(text):
+                continue
+            examples.append((label, text))
+        return examples
+
+    def ensure_trained(self):
+        """Запускает фоновое переобучение по логам, если модель устарела (не блокирует вызывающего)"""
+        if time.monotonic() - self._trained_at < self.retrain_interval and self._trained_at:
+            return
+        if self._training_task is not None and not self._training_task.done():
+            return
+        self._trained_at = time.monotonic()
+        self._training_task = asyncio.create_task(self._retrain())
+
+    async def _retrain(self):
+        try:
+            from database import db
+            rows = await db.get_classified_messages(
+                CLASSIFIER_TRAINING_LIMIT, label_sources=[LABEL_SOURCE_LLM], message_types=list(FLOW_MESSAGE_TYPES)
+            )
+            examples = self.examples_from_rows(rows)
+            if examples:
+                # Подсчёт n-грамм — в потоке, подмена модели — на loop-е
+                counts, docs = await asyncio.to_thread(self._with_seed, examples)
+                self.stats['training_examples'] = sum(docs.values())
+                self._install(counts, docs)
+                logger.info(f"🧮 Локальный классификатор обучен на {len(examples)} сообщениях")
+        except Exception as e:
+            logger.warning(f"Не удалось обучить локальный классификатор: {e}")
+
+    # ===== КЛАССИФИКАЦИЯ =====
+
+    def probabilities(self, text: str) -> Dict[str, float]:
+        grams = _ngrams(text)
+        total_docs = sum(self._docs.values())
+        text_lower = _normalize(text)
+        has_numbers = bool(_NUMBER_RE.search(text))
+
+        scores = {}
+        for label in LABELS:
+            prior = math.log((self._docs[label] + 1) / (total_docs + len(LABELS)))
+            label_counts = self._counts[label]
+            denominator = self._totals[label] + self._vocabulary + 1
+            if grams:
+                likelihood = sum(math.log((label_counts[g] + 1) / denominator) for g in grams) / len(grams)
+            else:
+                likelihood = 0.0
+            keywords = sum(w for kw, w in KEYWORD_WEIGHTS[label].items() if kw in text_lower)
+            scores[label] = prior + likelihood * EVIDENCE_SCALE + keywords
+
+        if has_numbers and any(kw in text_lower for kw in KEYWORD_WEIGHTS['business_data']):
+            scores['business_data'] += _DATA_NUMBER_BONUS
+
+        top = max(scores.values())
+        exp_scores = {label: math.exp(score - top) for label, score in scores.items()}
+        norm = sum(exp_scores.values())
+        return {label: value / norm for label, value in exp_scores.items()}
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """
+        Возвращает (метка, уверенность). Метка None — сообщение неоднозначное,
+        решение нужно отдать LLM.
+        """
+        started = time.perf_counter()
+        probabilities = self.probabilities(text)
+        label = max(probabilities, key=probabilities.get)
+        confidence = probabilities[label]
+        self.stats['local_ms_total'] += (time.perf_counter() - started) * 1000
+        if confidence >= self.confidence:
+            self.stats['local_hits'] += 1
+            return label, confidence
+        return None, confidence
+
+    def record_escalation(self, llm_seconds: float):
+        """Учёт неуверенного сообщения, ушедшего в LLM"""
+        self.stats['escalations'] += 1
+        self.stats['llm_ms_total'] += llm_seconds * 1000
+
+    def get_stats(self) -> Dict:
+        """Доля локальных решений и оценка сэкономленного времени"""
+        hits = self.stats['local_hits']
+        escalations = self.stats['escalations']
+        total = hits + escalations
+        avg_llm_ms = self.stats['llm_ms_total'] / escalations if escalations else 0.0
+        avg_local_ms = self.stats['local_ms_total'] / total if total else 0.0
+        return {
+            'classified': total,
+            'local_hits': hits,
+            'escalations': escalations,
+            'hit_rate': round(hits / total, 3) if total else 0,
+            'avg_local_ms': round(avg_local_ms, 3),
+            'avg_llm_ms': round(avg_llm_ms, 1),
+            'saved_ms_estimate': round(hits * max(avg_llm_ms - avg_local_ms, 0.0), 1),
+            'training_examples': self.stats['training_examples'] or sum(self._seed_docs.values()),
+            'confidence_threshold': self.confidence,
+        }
+
+# Глобальный экземпляр классификатора
+message_classifier = MessageClassifier()
+
+if __name__ == "__main__":
+    samples = [
+        ("выручка 600к, расходы 250к, клиентов 900", 'business_data'),
+        ("у нас салон красоты, доход 1.2 млн в месяц", 'business_data'),
+        ("как снизить расходы на аренду?", 'question'),
+        ("почему клиенты не возвращаются?", 'question'),
+        ("привет!", 'general'),
+        ("спасибо, всё понятно", 'general'),
+        ("думаю открыть что-нибудь своё", None),
+    ]
+    for text, expected in samples:
+        label, confidence = message_classifier.predict(text)
+        mark = '✅' if label == expected or (expected is None and label is None) else '⚠️'
+        print(f"{mark} {text!r}: {label or 'LLM'} ({confidence:.2f})")
+
+    iterations = 10000
+    started = time.perf_counter()
+    for i in range(iterations):
+        message_classifier.probabilities(samples[i % len(samples)][0])
+    print(f"⏱ {(time.perf_counter() - started) / iterations * 1e6:.0f} мкс на сообщение")
+    print(message_classifier.get_stats())
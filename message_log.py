@@ -0,0 +1,278 @@
+"""
+Буферизованная запись журнала сообщений (таблица messages) и кольцо последних сообщений.
+
+Database.log_message только кладёт строку в буфер, поэтому ответ пользователю
+не ждёт INSERT. Фоновая задача сбрасывает буфер пачкой, когда набралось
+MESSAGE_LOG_BATCH_SIZE строк или прошло MESSAGE_LOG_FLUSH_MS миллисекунд.
+При сбое БД строки остаются в буфере и повторяются (не больше
+MESSAGE_LOG_MAX_ATTEMPTS раз); буфер ограничен MESSAGE_LOG_MAX_PENDING строками,
+при переполнении теряются самые старые.
+"""
+import asyncio
+import time
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LOG_BATCH_SIZE = int(os.getenv("MESSAGE_LOG_BATCH_SIZE", "100"))
+MESSAGE_LOG_FLUSH_MS = int(os.getenv("MESSAGE_LOG_FLUSH_MS", "200"))
+MESSAGE_LOG_MAX_PENDING = int(os.getenv("MESSAGE_LOG_MAX_PENDING", "10000"))
+MESSAGE_LOG_MAX_ATTEMPTS = int(os.getenv("MESSAGE_LOG_MAX_ATTEMPTS", "5"))
+RECENT_MESSAGES_RING = int(os.getenv("RECENT_MESSAGES_RING", "20"))
+RECENT_MESSAGES_USERS = int(os.getenv("RECENT_MESSAGES_USERS", "10000"))
+
+# Пауза после неудачного сброса растёт до этого предела, секунды
+_MAX_BACKOFF = 5.0
+
+class _PendingRow:
+    __slots__ = ('values', 'attempts')
+
+    def __init__(self, values: tuple):
+        self.values = values
+        self.attempts = 0
+
+class MessageLogBuffer:
+    """Буфер строк messages со сбросом пачками через database.insert_messages"""
+
+    def __init__(self, database, batch_size: int = None, flush_interval_ms: int = None,
+                 max_pending: int = None):
+        self.database = database
+        self.batch_size = batch_size or MESSAGE_LOG_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms or MESSAGE_LOG_FLUSH_MS) / 1000
+        self.max_pending = max_pending or MESSAGE_LOG_MAX_PENDING
+
+        self._pending: Deque[_PendingRow] = deque()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._backoff = 0.0
+
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'dropped': 0,
+            'abandoned': 0,
+            'flush_ms_total': 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, values: tuple):
+        """Поставить строку в очередь записи (без ожидания БД)"""
+        self._pending.append(_PendingRow(values))
+        self.stats['queued'] += 1
+        self._trim()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _trim(self):
+        while len(self._pending) > self.max_pending:
+            self._pending.popleft()
+            self.stats['dropped'] += 1
+            if self.stats['dropped'] % 1000 == 1:
+                logger.warning(f"⚠️ Буфер журнала сообщений переполнен, потеряно строк: {self.stats['dropped']}")
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval + self._backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """Записать всё накопленное; False — часть строк осталась в буфере после сбоя"""
+        async with self._lock:
+            while self._pending:
+                # Строки из упавшей пачки пишем по одной: одна битая строка (например, нарушение
+                # внешнего ключа) не должна тянуть за собой в отброс всю пачку
+                limit = 1 if self._pending[0].attempts else self.batch_size
+                batch: List[_PendingRow] = []
+                while self._pending and len(batch) < limit:
+                    batch.append(self._pending.popleft())
+                if not await self._write(batch):
+                    return False
+            return True
+
+    async def _write(self, batch: List[_PendingRow]) -> bool:
+        started = time.perf_counter()
+        try:
+            await self.database.insert_messages([row.values for row in batch])
+        except Exception as e:
+            self.stats['failed_batches'] += 1
+            self._backoff = min(_MAX_BACKOFF, self._backoff * 2 or self.flush_interval)
+            logger.warning(f"⚠️ Не удалось записать {len(batch)} сообщений в БД, повторим позже: {e}")
+            # Возвращаем в голову очереди с сохранением порядка; безнадёжные строки отбрасываем
+            for row in reversed(batch):
+                row.attempts += 1
+                if row.attempts < MESSAGE_LOG_MAX_ATTEMPTS:
+                    self._pending.appendleft(row)
+                else:
+                    self.stats['abandoned'] += 1
+            self._trim()
+            return False
+        finally:
+            self.stats['flush_ms_total'] += (time.perf_counter() - started) * 1000
+
+        self._backoff = 0.0
+        self.stats['batches'] += 1
+        self.stats['written'] += len(batch)
+        return True
+
+    def get_stats(self) -> Dict:
+        batches = self.stats['batches'] + self.stats['failed_batches']
+        return {
+            'pending': len(self._pending),
+            'batch_size': self.batch_size,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'avg_batch_rows': round(self.stats['written'] / self.stats['batches'], 1) if self.stats['batches'] else 0,
+            'avg_flush_ms': round(self.stats['flush_ms_total'] / batches, 2) if batches else 0,
+            **{key: value for key, value in self.stats.items() if key != 'flush_ms_total'},
+        }
+
+class RecentMessagesRing:
+    """
+    Последние строки messages каждого пользователя в памяти процесса (deque фиксированной длины).
+    Кольцо пользователя "прогревается" первым чтением из БД и дальше пополняется каждым
+    log_message, поэтому повторная подгрузка истории не идёт в БД и не ждёт сброса буфера.
+    """
+
+    def __init__(self, size: int = None, max_users: int = None):
+        self.size = size or RECENT_MESSAGES_RING
+        self.max_users = max_users or RECENT_MESSAGES_USERS
+        self._rings: "OrderedDict[str, Deque[Dict]]" = OrderedDict()
+        # Счётчик записей по пользователю: прогрев ответом, устаревшим из-за параллельной записи, пропускается.
+        # Ведётся только для пользователей с кольцом или с незавершённым прогревом — не больше max_users + прогревы
+        self._writes: Dict[str, int] = {}
+        # Незавершённые прогревы по пользователю (begin_prime без prime)
+        self._priming: Dict[str, int] = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def begin_prime(self, user_id: str) -> int:
+        """Начать прогрев перед чтением из БД; версию записей передать в prime (вызывать всегда, и при ошибке)"""
+        self._priming[user_id] = self._priming.get(user_id, 0) + 1
+        return self._writes.setdefault(user_id, 0)
+
+    def append(self, user_id: str, row: Dict):
+        if user_id in self._writes:
+            self._writes[user_id] += 1
+        ring = self._rings.get(user_id)
+        if ring is not None:
+            ring.append(row)
+            self._rings.move_to_end(user_id)
+
+    def prime(self, user_id: str, rows: Optional[List[Dict]], write_version: int):
+        """Заполнить кольцо строками из БД (от старых к новым); rows=None — прогрев не удался"""
+        try:
+            if rows is None or write_version != self._writes.get(user_id):
+                return
+            self._rings[user_id] = deque(rows[-self.size:], maxlen=self.size)
+            self._rings.move_to_end(user_id)
+            while len(self._rings) > self.max_users:
+                evicted, _ = self._rings.popitem(last=False)
+                if evicted not in self._priming:
+                    self._writes.pop(evicted, None)
+        finally:
+            self._end_prime(user_id)
+
+    def _end_prime(self, user_id: str):
+        pending = self._priming.pop(user_id, 1) - 1
+        if pending:
+            self._priming[user_id] = pending
+        elif user_id not in self._rings:
+            self._writes.pop(user_id, None)
+
+    def get(self, user_id: str, limit: int) -> Optional[List[Dict]]:
+        ring = self._rings.get(user_id)
+        if ring is None or limit > self.size:
+            self.stats['misses'] += 1
+            return None
+        self._rings.move_to_end(user_id)
+        self.stats['hits'] += 1
+        return [dict(row) for row in list(ring)[-limit:]] if limit > 0 else []
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            'users': len(self._rings),
+            'ring_size': self.size,
+            'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0,
+            **self.stats,
+        }
+
+if __name__ == "__main__":
+    class _FakeDatabase:
+        def __init__(self):
+            self.rows = []
+            self.calls = 0
+            self.fail = False
+
+        async def insert_messages(self, rows):
+            self.calls += 1
+            await asyncio.sleep(0.003)
+            if self.fail:
+                raise ConnectionError("БД недоступна")
+            self.rows.extend(rows)
+
+    async def main():
+        fake = _FakeDatabase()
+        buffer = MessageLogBuffer(fake, batch_size=50, flush_interval_ms=20, max_pending=500)
+
+        started = time.perf_counter()
+        for i in range(120):
+            buffer.add((f"user_{i % 7}", None, f"сообщение {i}", "", "user_input"))
+        enqueue_us = (time.perf_counter() - started) / 120 * 1e6
+        await asyncio.sleep(0.1)
+        assert [row[2] for row in fake.rows] == [f"сообщение {i}" for i in range(120)], "порядок нарушен"
+        assert fake.calls <= 4, f"строки не собираются в пачки: {fake.calls} запросов"
+
+        fake.fail = True
+        for i in range(10):
+            buffer.add(("user", None, f"при сбое {i}", "", "user_input"))
+        assert not await buffer.flush() and len(buffer) == 10, "строки потеряны при сбое БД"
+        fake.fail = False
+        assert await buffer.flush() and fake.rows[-1][2] == "при сбое 9"
+
+        class _PoisonDatabase(_FakeDatabase):
+            async def insert_messages(self, rows):
+                if any(row[2] == "битая" for row in rows):
+                    raise ValueError("нарушен внешний ключ")
+                await super().insert_messages(rows)
+
+        poisoned = _PoisonDatabase()
+        buffer = MessageLogBuffer(poisoned, batch_size=50, max_pending=500)
+        for text in ["до", "битая", "после"]:
+            buffer.add(("user", None, text, "", "user_input"))
+        for _ in range(MESSAGE_LOG_MAX_ATTEMPTS + 1):
+            await buffer.flush()
+        assert [row[2] for row in poisoned.rows] == ["до", "после"] and not len(buffer), "битая строка блокирует журнал"
+
+        ring = RecentMessagesRing(size=3, max_users=2)
+        assert ring.get("u", 3) is None
+        version = ring.begin_prime("u")
+        ring.append("u", {'user_message': "параллельная запись"})
+        ring.prime("u", [{'user_message': "из БД"}], version)
+        assert ring.get("u", 3) is None, "кольцо прогрето устаревшим ответом БД"
+        ring.prime("u", [{'user_message': f"из БД {i}"} for i in range(5)], ring.begin_prime("u"))
+        ring.append("u", {'user_message': "новое"})
+        assert [row['user_message'] for row in ring.get("u", 3)] == ["из БД 3", "из БД 4", "новое"]
+
+        # Записи пользователей без кольца и вытесненных не копятся
+        for i in range(1000):
+            ring.append(f"без кольца {i}", {'user_message': "сообщение"})
+        ring.prime("сбой", None, ring.begin_prime("сбой"))
+        for i in range(5):
+            ring.prime(f"v{i}", [], ring.begin_prime(f"v{i}"))
+        assert len(ring._writes) == len(ring._rings) == 2 and not ring._priming, "счётчики записей растут без предела"
+        print(f"⏱ постановка в очередь {enqueue_us:.1f} мкс; {buffer.get_stats()}")
+
+    asyncio.run(main())
@@ -134,24 +134,78 @@ async function loadKPIMetrics(businessId) {
     }
 }
 
+// Chart series state: cursor/ETag of the last response for cheap incremental refresh
+const SERIES_WINDOW = 120;
+const SERIES_REFRESH_MS = 60000;
+let seriesState = { businessId: null, cursor: null, rewritten: null, etag: null, metrics: null };
+
+function seriesMetricsParam() {
+    // Without the metrics grid the selection never changes, so only the charted series are fetched
+    return document.getElementById('allMetricsGrid') ? null : Array.from(selectedMetrics).join(',');
+}
+
 async function loadFinanceHistory(businessId) {
+    seriesState = { businessId: businessId, cursor: null, rewritten: null, etag: null, metrics: seriesMetricsParam() };
+    await fetchFinanceSeries(false);
+}
+
+async function refreshFinanceHistory() {
+    if (!seriesState.businessId || !currentChartData || document.hidden) return;
+    await fetchFinanceSeries(true);
+}
+
+async function fetchFinanceSeries(incremental) {
+    const businessId = seriesState.businessId;
+    const params = new URLSearchParams({ limit: SERIES_WINDOW });
+    if (seriesState.metrics) params.set('metrics', seriesState.metrics);
+    if (incremental && seriesState.cursor !== null) {
+        params.set('since', seriesState.cursor);
+        // Lets the server fall back to a full response if old points were rewritten in place
+        params.set('rewritten', seriesState.rewritten);
+    }
+    const headers = {};
+    if (incremental && seriesState.etag) headers['If-None-Match'] = seriesState.etag;
+
     try {
-        const response = await fetch(`/api/business-history/${businessId}`);
+        const response = await fetch(`/api/business-series/${businessId}?${params}`, { headers });
+        // Nothing changed since the last refresh (or the business was switched meanwhile)
+        if (response.status === 304 || businessId !== seriesState.businessId) return;
         const data = await response.json();
-        if (data.success) {
+        if (!data.success) return;
+
+        seriesState.etag = response.headers.get('ETag');
+        if (data.incremental && currentChartData) {
+            if (!data.data.dates.length) return;
+            appendSeries(currentChartData, data.data);
+        } else {
             currentChartData = data.data;
-            renderFinanceCharts(data.data);
-            
-            // Update all metrics grid if it exists
-            if (document.getElementById('allMetricsGrid')) {
-                buildAllMetricCards(data.latest, data.data);
-            }
+        }
+        seriesState.cursor = data.data.cursor;
+        seriesState.rewritten = data.rewritten_at;
+        renderFinanceCharts(currentChartData);
+
+        // Update all metrics grid if it exists
+        if (document.getElementById('allMetricsGrid')) {
+            buildAllMetricCards(data.latest, currentChartData);
         }
     } catch (error) {
         console.error('Error loading history:', error);
     }
 }
 
+function appendSeries(target, delta) {
+    // New points are appended; the window is trimmed to SERIES_WINDOW from the start
+    const overflow = Math.max(0, target.dates.length + delta.dates.length - SERIES_WINDOW);
+    target.dates = target.dates.concat(delta.dates).slice(overflow);
+    Object.keys(target.series).forEach(key => {
+        target.series[key] = target.series[key].concat(delta.series[key] || []).slice(overflow);
+    });
+    target.cursor = delta.cursor;
+}
+
+setInterval(refreshFinanceHistory, SERIES_REFRESH_MS);
+document.addEventListener('visibilitychange', refreshFinanceHistory);
+
 async function loadAIAnalysis(businessId) {
     try {
         const container = document.getElementById('aiAnalysisContainer');
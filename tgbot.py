@@ -1,15 +1,20 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, WebAppInfo
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from ai import classify_message_type, general_chat, answer_question, extract_business_data, conversation_memory
+from telegram.error import BadRequest, RetryAfter
+from ai import classify_message, general_chat, answer_question, extract_business_data, llm_gateway, LLMCancelledError
+from ai import stream_answer_question, stream_general_chat
 from conversation_manager import conv_manager
 from business_analyzer import business_analyzer
+from benchmark_engine import benchmark_engine
 from database import db
 from metrics_help import get_categories_keyboard, get_metrics_keyboard, get_metric_description, get_category_description
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from datetime import datetime
 import asyncio
-from typing import Dict, List
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List
 from datetime import datetime
 from telegram.helpers import escape_markdown
 from env_utils import is_production, get_log_dir, should_create_files
@@ -105,6 +110,13 @@ def clean_ai_text(text: str) -> str:
 print("Запуск бота....")
 
 class BusinessBot:
+    # Лимит длины сообщения с запасом до 4096 символов Telegram
+    MAX_MESSAGE_LENGTH = 3800
+    # Потоковые ответы: правим сообщение не чаще раза в STREAM_EDIT_INTERVAL секунд (лимиты Telegram на edit)
+    STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1").lower() in ("1", "true", "yes")
+    STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+    STREAM_CURSOR = " ▌"
+
     def __init__(self):
         token = (
             os.getenv("BOT_TOKEN")
@@ -332,9 +344,7 @@ class BusinessBot:
         await update.message.reply_text(text, parse_mode='MarkdownV2')
         
         # Ставим флаг: следующее сообщение пользователя будет обработано как свободный ввод данных
-        if not hasattr(self, 'awaiting_business_data'):
-            self.awaiting_business_data = set()
-        self.awaiting_business_data.add(user_id)
+        conv_manager.mark_awaiting_data(user_id)
 
     async def edit_business_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда для редактирования существующего бизнеса"""
@@ -436,7 +446,7 @@ class BusinessBot:
                 business_name = business.get('business_name', f'Бизнес #{i}')
                 business_id = business.get('business_id')
                 try:
-                    history = await db.get_business_history(business_id, limit=1)
+                    history = await db.get_business_history(business_id, limit=1, columns='health')
                     if history:
                         health_score = history[0].get('overall_health_score', 0)
                         button_text = f"📊 {business_name} (Health: {health_score}/100)"
@@ -552,7 +562,7 @@ class BusinessBot:
         """Показ деталей бизнеса по запросу Inline кнопки"""
         try:
             # Получаем историю
-            history = await db.get_business_history(business_id, limit=1)
+            history = await db.get_business_history(business_id, limit=1, columns='report')
             if not history:
                 await query.edit_message_text("❌ Бизнес не найден")
                 return
@@ -589,7 +599,7 @@ class BusinessBot:
             user_id = str(query.from_user.id)
             
             # Получаем информацию о бизнесе
-            history = await db.get_business_history(business_id, limit=1)
+            history = await db.get_business_history(business_id, limit=1, columns='raw')
             if not history:
                 await query.edit_message_text("❌ Бизнес не найден")
                 return
@@ -660,6 +670,14 @@ class BusinessBot:
             await query.edit_message_text("❌ Не удалось удалить бизнес.")
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Новое сообщение отменяет ещё не отвеченные LLM-запросы предыдущего
+        token = llm_gateway.begin_turn(str(update.effective_user.id))
+        try:
+            await self._process_message(update, context)
+        finally:
+            llm_gateway.end_turn(token)
+
+    async def _process_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_text = update.message.text
         user = update.effective_user
         user_id = str(user.id)
@@ -669,54 +687,37 @@ class BusinessBot:
         await db.save_user(user_id, user.username, user.first_name, user.last_name)
 
         # Если ждём первое сообщение для нового бизнеса – сразу собираем данные без стартового промпта
-        if hasattr(self, 'awaiting_business_data') and user_id in self.awaiting_business_data:
+        if conv_manager.pop_awaiting_data(user_id):
+            conversation = await conv_manager.get_conversation(user_id)
+            await conversation._update_state(conversation.STATES['COLLECTING_DATA'])
+            progress_msg = None
             try:
-                conversation = await conv_manager.get_conversation(user_id)
-                await conversation._update_state(conversation.STATES['COLLECTING_DATA'])
-                progress_msg = None
+                progress_msg = await update.message.reply_text(
+                    "🛠 *Делаю отчёт\\.\\.\\.*",
+                    parse_mode='MarkdownV2'
+                )
+            except Exception:
+                pass
+            response_data = await conversation._handle_data_collection(user_text)
+            if progress_msg:
                 try:
-                    progress_msg = await update.message.reply_text(
-                        "🛠 *Делаю отчёт\\.\\.\\.*",
+                    await progress_msg.edit_text(
+                        safe_markdown_text(response_data['response']),
                         parse_mode='MarkdownV2'
                     )
                 except Exception:
-                    pass
-                response_data = await conversation._handle_data_collection(user_text)
-                if progress_msg:
                     try:
-                        await progress_msg.edit_text(
-                            safe_markdown_text(response_data['response']),
-                            parse_mode='MarkdownV2'
-                        )
+                        await progress_msg.delete()
                     except Exception:
-                        try:
-                            await progress_msg.delete()
-                        except Exception:
-                            pass
-                        await self.send_long_message(update, response_data['response'], 'Markdown')
-                else:
+                        pass
                     await self.send_long_message(update, response_data['response'], 'Markdown')
-            finally:
-                self.awaiting_business_data.discard(user_id)
+            else:
+                await self.send_long_message(update, response_data['response'], 'Markdown')
             return
 
-        try:
-            from ai import conversation_memory as ai_memory
-            if user_id not in ai_memory or len(ai_memory[user_id]) == 0:
-                recent = await db.get_user_recent_messages(user_id, limit=20)
-                history = []
-                for msg in recent:
-                    if msg.get('user_message'):
-                        history.append({"role": "user", "content": msg['user_message']})
-                    if msg.get('bot_response'):
-                        history.append({"role": "assistant", "content": msg['bot_response']})
-                if history:
-                    ai_memory[user_id] = history[-12:]
-        except Exception as e:
-            logger.warning(f"Не удалось гидрировать историю из БД: {e}")
-
-        if user_id in conv_manager.active_sessions:
-            await self._handle_conversation_message(update, user_id, user_text)
+        conversation = await conv_manager.find_conversation(user_id)
+        if conversation is not None:
+            await self._handle_conversation_message(update, user_id, user_text, conversation)
             return
 
         if user_text.startswith('/'):
@@ -728,7 +729,9 @@ class BusinessBot:
         )
 
         try:
-            message_type = await classify_message_type(user_text)
+            message_type, label_source = await classify_message(user_text)
+            # Исходный тип и его источник пишем в messages: классификатор обучается только на метках LLM
+            detected_type = message_type
             logger.info(f"🎯 Определен тип сообщения: {message_type}")
 
             if message_type == "business_data":
@@ -760,7 +763,10 @@ class BusinessBot:
                     logger.error(f"❌ Ошибка обновления на 'обдумываю': {e}")
 
             if message_type == "question":
-                response = await self.handle_question(user_text, user_id)
+                if self.STREAM_RESPONSES:
+                    response = await self.stream_reply(update, thinking_msg, stream_answer_question(user_text, user_id))
+                else:
+                    response = await self.handle_question(user_text, user_id)
                 try:
                     session_id = None if user_id not in conv_manager.active_sessions else conv_manager.active_sessions[user_id].session_id
                     if session_id is None:
@@ -770,13 +776,18 @@ class BusinessBot:
                         session_id=session_id,
                         user_message=user_text,
                         bot_response=response,
-                        message_type='question'
+                        message_type='question',
+                        label_source=label_source
                     )
                 except Exception as e:
                     logger.warning(f"Не удалось записать вопрос в БД: {e}")
-                await self.send_long_message(update, response)
+                if not self.STREAM_RESPONSES:
+                    await self.send_long_message(update, response)
             else:
-                response = await self.handle_general_chat(user_text, user_id)
+                if self.STREAM_RESPONSES:
+                    response = await self.stream_reply(update, thinking_msg, stream_general_chat(user_text, user_id))
+                else:
+                    response = await self.handle_general_chat(user_text, user_id)
                 try:
                     session_id = None if user_id not in conv_manager.active_sessions else conv_manager.active_sessions[user_id].session_id
                     if session_id is None:
@@ -786,19 +797,29 @@ class BusinessBot:
                         session_id=session_id,
                         user_message=user_text,
                         bot_response=response,
-                        message_type='general'
+                        message_type=detected_type,
+                        label_source=label_source
                     )
                 except Exception as e:
                     logger.warning(f"Не удалось записать общение в БД: {e}")
-                await self.send_long_message(update, response, None)
+                if not self.STREAM_RESPONSES:
+                    await self.send_long_message(update, response, None)
             
+            # При потоковом ответе thinking_msg стал сообщением с ответом
+            if not self.STREAM_RESPONSES:
+                try:
+                    await thinking_msg.delete()
+                except Exception:
+                    pass
+
+            logger.info(f"🤖 Ответ бота ({message_type}): {response[:20]}...")
+
+        except LLMCancelledError:
+            logger.info(f"⏭ Ответ пользователю {user_id} отменён: пришло новое сообщение")
             try:
                 await thinking_msg.delete()
             except Exception:
                 pass
-
-            logger.info(f"🤖 Ответ бота ({message_type}): {response[:20]}...")
-
         except Exception as e:
             error_msg = safe_markdown_text("❌ *Произошла ошибка при обработке запроса*. Попробуйте еще раз.")
             logger.error(f"Ошибка обработки сообщения: {e}")
@@ -814,10 +835,9 @@ class BusinessBot:
         return messages.get(message_type, "🤔 *Думаю...*")
 
 
-    async def _handle_conversation_message(self, update: Update, user_id: str, user_text: str):
+    async def _handle_conversation_message(self, update: Update, user_id: str, user_text: str, conversation):
         """Обработка сообщения в рамках активной диалоговой сессии"""
         try:
-            conversation = conv_manager.active_sessions[user_id]
 
             # Прогресс СРАЗУ после сообщения пользователя
             progress_msg = None
@@ -891,13 +911,88 @@ class BusinessBot:
         response = await general_chat(text, user_id)
         return clean_ai_text(response)
 
+    async def stream_reply(self, update: Update, message, chunks: AsyncIterator[str]) -> str:
+        """
+        Потоковый ответ: message редактируется по мере генерации (не чаще STREAM_EDIT_INTERVAL),
+        текст длиннее MAX_MESSAGE_LENGTH продолжается в новых сообщениях. Возвращает полный ответ.
+        Если поток прерван (отмена, ошибка), сообщения-продолжения удаляются; исходное message
+        остается вызывающему — он удаляет его или показывает ошибку.
+        """
+        full_text = ""
+        segment = ""  # текст текущего сообщения
+        next_edit_at = 0.0
+        overflow = []  # сообщения-продолжения, отправленные после переполнения
+        completed = False
+
+        try:
+            async with aclosing(chunks) as stream:
+                async for chunk in stream:
+                    full_text += chunk
+                    segment += chunk
+
+                    while len(segment) > self.MAX_MESSAGE_LENGTH:
+                        head, segment = self._split_stream_segment(segment)
+                        await self._edit_stream_message(message, clean_ai_text(head), final=True)
+                        message = await update.message.reply_text(clean_ai_text(segment) + self.STREAM_CURSOR)
+                        overflow.append(message)
+                        next_edit_at = time.monotonic() + self.STREAM_EDIT_INTERVAL
+
+                    now = time.monotonic()
+                    if now >= next_edit_at and segment.strip():
+                        delay = await self._edit_stream_message(message, clean_ai_text(segment) + self.STREAM_CURSOR)
+                        next_edit_at = now + max(self.STREAM_EDIT_INTERVAL, delay)
+
+            final_text = clean_ai_text(segment).strip() or "Извините, не удалось получить ответ. Попробуйте еще раз."
+            await self._edit_stream_message(message, final_text, final=True)
+            completed = True
+            return clean_ai_text(full_text) or final_text
+        finally:
+            if not completed:
+                # Недописанный ответ с курсором не оставляем
+                for sent in overflow:
+                    try:
+                        await sent.delete()
+                    except Exception:
+                        pass
+
+    def _split_stream_segment(self, text: str):
+        """Разрез потокового текста по абзацу или пробелу не дальше MAX_MESSAGE_LENGTH"""
+        limit = self.MAX_MESSAGE_LENGTH
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        return text[:cut], text[cut:].lstrip()
+
+    async def _edit_stream_message(self, message, text: str, final: bool = False) -> float:
+        """
+        Правка сообщения потокового ответа. Возвращает, сколько секунд Telegram просит подождать.
+        Промежуточные правки при ограничении пропускаются, финальная — повторяется после паузы.
+        """
+        for _ in range(2):
+            try:
+                await message.edit_text(text)
+                return 0.0
+            except RetryAfter as e:
+                retry_after = float(getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)())
+                if not final:
+                    return retry_after
+                await asyncio.sleep(retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    return 0.0
+                logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+                return 0.0
+        return 0.0
+
     # Отправляем ответ с возможным разделением
     async def send_long_message(self, update_or_query_object, text: str, parse_mode: str = None):
         """
         Элегантное разделение длинного сообщения на части и отправка.
         Принимает update или query объект для отправки сообщения.
         """
-        MAX_LENGTH = 3800
+        MAX_LENGTH = self.MAX_MESSAGE_LENGTH
         final_text_to_send = safe_markdown_text(text) if parse_mode == 'MarkdownV2' else text
 
         if len(final_text_to_send) <= MAX_LENGTH:
@@ -1044,26 +1139,27 @@ class BusinessBot:
         """Асинхронный запуск бота (для локальной разработки или инициализации)"""
         print("Bot is starting...")
 
-        import sqlite3
-        import os
-
         # Инициализация БД (для локального запуска)
-        db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'business_bot_v2.db')
-        db.conn = sqlite3.connect(db_path, check_same_thread=False)
         await db.init_db()
+        # Бенчмарки из собственных данных считаются в фоне, до первого запроса пользователя
+        benchmark_engine.ensure_fresh()
 
         await self.app.initialize()
         await self.app.start()
         
-        if is_production():
-            # В продакшене бот запускается через Flask, здесь просто инициализация
-            logger.info("🚀 Запуск в продакшене (Webhook mode)")
-            # Сбрасываем старые вебхуки, если они были
-            await self.app.bot.set_webhook(url=None)
-            # Не запускаем polling, просто ждем
-            await asyncio.Event().wait()
-        else:
-            # Локальный запуск - используем polling
-            logger.info("💻 Запуск локально (Polling mode)")
-            await self.app.updater.start_polling()
-            await asyncio.Event().wait()
+        try:
+            if is_production():
+                # В продакшене бот запускается через Flask, здесь просто инициализация
+                logger.info("🚀 Запуск в продакшене (Webhook mode)")
+                # Сбрасываем старые вебхуки, если они были
+                await self.app.bot.set_webhook(url=None)
+                # Не запускаем polling, просто ждем
+                await asyncio.Event().wait()
+            else:
+                # Локальный запуск - используем polling
+                logger.info("💻 Запуск локально (Polling mode)")
+                await self.app.updater.start_polling()
+                await asyncio.Event().wait()
+        finally:
+            # Остановка (Ctrl+C): дописываем буфер журнала сообщений
+            await db.flush_message_log()
@@ -0,0 +1,188 @@
+"""
+Очередь входящих обновлений Telegram для режима webhook.
+
+/webhook только кладёт JSON обновления в ограниченную очередь и сразу отвечает 200.
+Пул воркеров разбирает очередь через BusinessBot.process_update:
+- обновления одного пользователя обрабатываются строго по порядку, разные пользователи — параллельно;
+- повторная доставка того же update_id (ретраи Telegram) отбрасывается;
+- при переполнении очередь отказывает, и Telegram повторит доставку позже;
+- если у пользователя уже есть обновление в работе, вызывается on_superseded —
+  так новое сообщение может прервать ожидание ответа на предыдущее.
+"""
+import asyncio
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Ключи обновлений Telegram, в которых есть отправитель
+_USER_UPDATE_KEYS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+class WebhookQueue:
+    """Ограниченная очередь обновлений с дедупликацией и порядком внутри пользователя"""
+
+    ACCEPTED = 'accepted'
+    DUPLICATE = 'duplicate'
+    REJECTED = 'rejected'
+
+    def __init__(self, handler: Callable[[Dict], Awaitable[None]], workers: int = None,
+                 max_pending: int = None, dedup_size: int = None,
+                 on_superseded: Optional[Callable[[str, Dict], None]] = None):
+        self.handler = handler
+        self.on_superseded = on_superseded
+        self.workers = workers or int(os.getenv('WEBHOOK_WORKERS', '8'))
+        self.max_pending = max_pending or int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+        self.dedup_size = dedup_size or int(os.getenv('WEBHOOK_DEDUP_SIZE', '10000'))
+
+        # user_key -> очередь (время постановки, обновление)
+        self._pending: Dict[str, Deque] = {}
+        # Пользователи, у которых есть необработанные обновления и нет активного воркера
+        self._ready: Optional[asyncio.Queue] = None
+        self._active: Set[str] = set()
+        self._seen_update_ids: "OrderedDict[int, None]" = OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._pending_count = 0
+
+        self.stats = {
+            'accepted': 0,
+            'duplicates': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+            'max_pending': 0,
+            'wait_ms_total': 0.0,
+            'wait_ms_max': 0.0,
+            'processing_ms_total': 0.0,
+        }
+
+    async def start(self):
+        """Запуск воркеров (вызывается на event loop, где будут обрабатываться обновления)"""
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f'webhook-worker-{i}')
+            for i in range(self.workers)
+        ]
+        logger.info(f"✅ Очередь вебхуков запущена: {self.workers} воркеров, лимит {self.max_pending}")
+
+    async def stop(self):
+        """Остановка воркеров"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, update_json: Dict) -> str:
+        """Поставить обновление в очередь. Возвращает ACCEPTED, DUPLICATE или REJECTED."""
+        update_id = update_json.get('update_id') if isinstance(update_json, dict) else None
+
+        if update_id is not None and update_id in self._seen_update_ids:
+            self.stats['duplicates'] += 1
+            return self.DUPLICATE
+
+        if self._pending_count >= self.max_pending:
+            # update_id не запоминаем: Telegram повторит доставку, и её нужно будет принять
+            self.stats['rejected'] += 1
+            return self.REJECTED
+
+        if update_id is not None:
+            self._seen_update_ids[update_id] = None
+            if len(self._seen_update_ids) > self.dedup_size:
+                self._seen_update_ids.popitem(last=False)
+
+        user_key = self._user_key(update_json)
+        if self.on_superseded and (user_key in self._active or self._pending.get(user_key)):
+            try:
+                self.on_superseded(user_key, update_json)
+            except Exception as e:
+                logger.warning(f"Ошибка on_superseded для {user_key}: {e}")
+
+        user_queue = self._pending.get(user_key)
+        if user_queue is None:
+            user_queue = deque()
+            self._pending[user_key] = user_queue
+        user_queue.append((time.monotonic(), update_json))
+
+        self._pending_count += 1
+        self.stats['accepted'] += 1
+        self.stats['max_pending'] = max(self.stats['max_pending'], self._pending_count)
+
+        # Новый пользователь в очереди готовых; если им уже занят воркер — он заберёт и это обновление
+        if len(user_queue) == 1 and user_key not in self._active:
+            self._ready.put_nowait(user_key)
+        return self.ACCEPTED
+
+    def _user_key(self, update_json: Dict) -> str:
+        """Ключ упорядочивания: id отправителя, иначе id чата, иначе само обновление"""
+        for key in _USER_UPDATE_KEYS:
+            payload = update_json.get(key)
+            if not isinstance(payload, dict):
+                continue
+            sender = payload.get('from') or {}
+            if sender.get('id') is not None:
+                return f"user:{sender['id']}"
+            chat = payload.get('chat') or {}
+            if chat.get('id') is not None:
+                return f"chat:{chat['id']}"
+        return f"update:{update_json.get('update_id')}"
+
+    async def _worker(self, index: int):
+        while True:
+            user_key = await self._ready.get()
+            user_queue = self._pending.get(user_key)
+            if not user_queue:
+                continue
+
+            self._active.add(user_key)
+            enqueued_at, update_json = user_queue.popleft()
+            self._pending_count -= 1
+
+            wait_ms = (time.monotonic() - enqueued_at) * 1000
+            self.stats['wait_ms_total'] += wait_ms
+            self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], wait_ms)
+
+            started = time.monotonic()
+            try:
+                await self.handler(update_json)
+                self.stats['processed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"Ошибка обработки обновления {update_json.get('update_id')}: {e}")
+            finally:
+                self.stats['processing_ms_total'] += (time.monotonic() - started) * 1000
+                self._active.discard(user_key)
+                if user_queue:
+                    # Следующее обновление пользователя — в конец очереди, чтобы не задерживать остальных
+                    self._ready.put_nowait(user_key)
+                else:
+                    self._pending.pop(user_key, None)
+
+    def get_stats(self) -> Dict:
+        """Метрики очереди для мониторинга backpressure"""
+        finished = self.stats['processed'] + self.stats['failed']
+        started = finished + len(self._active)
+        return {
+            'workers': self.workers,
+            'pending': self._pending_count,
+            'pending_users': len(self._pending),
+            'active_workers': len(self._active),
+            'max_pending': self.stats['max_pending'],
+            'queue_limit': self.max_pending,
+            'accepted': self.stats['accepted'],
+            'duplicates': self.stats['duplicates'],
+            'rejected': self.stats['rejected'],
+            'processed': self.stats['processed'],
+            'failed': self.stats['failed'],
+            'avg_wait_ms': round(self.stats['wait_ms_total'] / started, 1) if started else 0,
+            'max_wait_ms': round(self.stats['wait_ms_max'], 1),
+            'avg_processing_ms': round(self.stats['processing_ms_total'] / finished, 1) if finished else 0,
+        }